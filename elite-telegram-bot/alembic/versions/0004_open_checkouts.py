@@ -0,0 +1,27 @@
+"""Reusable open checkout sessions on orders"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004_open_checkouts"
+down_revision = "0003_stripe_events"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("orders", sa.Column("checkout_url", sa.Text(), nullable=True))
+    op.add_column("orders", sa.Column("expires_at", sa.DateTime(timezone=True), nullable=True))
+    op.create_index(
+        "ix_orders_open_checkout",
+        "orders",
+        ["user_id", "sku", "status", "created_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_orders_open_checkout", table_name="orders")
+    op.drop_column("orders", "expires_at")
+    op.drop_column("orders", "checkout_url")
@@ -0,0 +1,25 @@
+"""Incrementally maintained row counters"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005_counters"
+down_revision = "0004_open_checkouts"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "counters",
+        sa.Column("name", sa.String(length=64), primary_key=True),
+        sa.Column("value", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("high_water_id", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("counters")
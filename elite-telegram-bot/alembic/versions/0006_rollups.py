@@ -0,0 +1,27 @@
+"""Time-bucketed rollups"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006_rollups"
+down_revision = "0005_counters"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "rollups",
+        sa.Column("granularity", sa.String(length=8), nullable=False),
+        sa.Column("metric", sa.String(length=32), nullable=False),
+        sa.Column("bucket", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("dimension", sa.String(length=64), nullable=False, server_default=""),
+        sa.Column("value", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("granularity", "metric", "bucket", "dimension"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("rollups")
@@ -0,0 +1,27 @@
+"""Cached referral downline sizes"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007_referral_downlines"
+down_revision = "0006_rollups"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Filled in by the referral count worker's reconcile on its first run.
+    op.add_column(
+        "users",
+        sa.Column("downline_count", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+    op.create_index("ix_users_downline_count", "users", ["downline_count"])
+    op.create_index("ix_users_referred_by_id", "users", ["referred_by_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_users_referred_by_id", table_name="users")
+    op.drop_index("ix_users_downline_count", table_name="users")
+    op.drop_column("users", "downline_count")
@@ -0,0 +1,23 @@
+"""Keyset pagination index for order history"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008_orders_user_created"
+down_revision = "0007_referral_downlines"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_orders_user_created",
+        "orders",
+        ["user_id", sa.text("created_at DESC"), sa.text("id DESC")],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_orders_user_created", table_name="orders")
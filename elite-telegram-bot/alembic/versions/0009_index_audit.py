@@ -0,0 +1,29 @@
+"""Indexes for foreign-key and time-range lookups"""
+
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0009_index_audit"
+down_revision = "0008_orders_user_created"
+branch_labels = None
+depends_on = None
+
+# orders.user_id is already the leading column of ix_orders_user_created, and
+# users.referral_code of its unique constraint; neither needs another index.
+INDEXES = (
+    ("ix_referrals_referrer_id", "referrals", ["referrer_id"]),
+    ("ix_referrals_referred_id", "referrals", ["referred_id"]),
+    ("ix_messages_user_id", "messages", ["user_id"]),
+    ("ix_messages_created_at", "messages", ["created_at"]),
+)
+
+
+def upgrade() -> None:
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade() -> None:
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,26 @@
+"""Compact per-recipient broadcast delivery log"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010_broadcast_deliveries"
+down_revision = "0009_index_audit"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "broadcast_deliveries",
+        sa.Column("broadcast_id", sa.Integer(), sa.ForeignKey("broadcasts.id"), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("status", sa.String(length=8), nullable=False),
+        sa.Column("error_code", sa.SmallInteger(), nullable=True),
+        sqlite_with_rowid=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("broadcast_deliveries")
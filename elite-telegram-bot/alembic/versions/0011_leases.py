@@ -0,0 +1,26 @@
+"""Leases for singleton background jobs"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0011_leases"
+down_revision = "0010_broadcast_deliveries"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "leases",
+        sa.Column("name", sa.String(length=64), primary_key=True),
+        sa.Column("owner", sa.String(length=64), nullable=True),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    # The message archiver used to serialise itself on this counter row.
+    op.execute("DELETE FROM counters WHERE name = 'archive.messages'")
+
+
+def downgrade() -> None:
+    op.drop_table("leases")
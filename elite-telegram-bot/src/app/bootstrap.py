@@ -22,23 +22,40 @@ async def delete_webhook(bot: Bot) -> None:
     logger.info("webhook.deleted")
 
 
+async def backfill_rollups() -> None:
+    from .db import engine
+    from .services.rollups import RollupWorker
+
+    settings = get_settings()
+    try:
+        await RollupWorker(batch_size=settings.rollup_batch_size).backfill()
+    finally:
+        await engine.dispose()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Telegram webhook management")
     parser.add_argument(
         "action",
-        choices=["set-webhook", "delete-webhook"],
+        choices=["set-webhook", "delete-webhook", "backfill-rollups"],
         help="Action to perform",
     )
     args = parser.parse_args()
 
     configure_logging()
 
+    if args.action == "backfill-rollups":
+        # Database only; run with the app stopped.
+        asyncio.run(backfill_rollups())
+        return
+
     settings = get_settings()
 
     if not settings.telegram_enabled:
         raise RuntimeError("Telegram is disabled (telegram_enabled=false)")
 
     settings.validate_telegram()
+    settings.validate_referrals()
 
     # Import bot lazily AFTER config is validated
     from .bot.main import bot
@@ -1,16 +1,22 @@
 from __future__ import annotations
 
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
 from aiogram import Router
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
-from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ...models import MessageRecord, Order, Referral, User
+from ...models import User
 from ...repos.bans import BanRepository
+from ...repos.broadcasts import BroadcastRepository
+from ...repos.counters import CounterRepository
+from ...repos.rollups import RollupRepository
 from ...repos.users import UserRepository
-from ...services.broadcast import BroadcastService
-from ...services.rate_limit import RateLimiter
+from ...services.bans import BanIndex
+from ...services.broadcast import BroadcastWorker
+from ...services.rollups import METRICS, bucket_start
 from ...utils.markdown import escape_markdown_v2
 
 router = Router(name="admin")
@@ -45,8 +51,12 @@ async def cmd_admin(message: Message, user: User) -> None:
         escape_markdown_v2(
             "🛠 *Admin Commands*\n"
             "/stats — system stats\n"
-            "/broadcast <msg> — send announcement\n"
-            "/ban <telegram_id>\n"
+            "/trends [days] — daily signups, orders and referrals\n"
+            "/leaderboard — top referrers by downline\n"
+            "/broadcast <msg> — queue announcement\n"
+            "/broadcasts — active broadcast jobs\n"
+            "/broadcast_pause|resume|cancel <id>\n"
+            "/ban <telegram_id> [30m|12h|7d] [reason]\n"
             "/unban <telegram_id>"
         )
     )
@@ -60,39 +70,94 @@ async def cmd_stats(message: Message, session: AsyncSession, user: User) -> None
         await _not_authorized(message)
         return
 
-    counts = await session.execute(
-        select(
-            func.count(User.id),
-            func.count(Order.id),
-            func.count(Referral.id),
-            func.count(MessageRecord.id),
-        )
-        .select_from(User)
-        .outerjoin(Order)
-        .outerjoin(Referral)
-        .outerjoin(MessageRecord)
-    )
+    counters = await CounterRepository(session).get_all()
+
+    def count(name: str) -> int:
+        counter = counters.get(name)
+        return counter.value if counter else 0
 
-    users, orders, referrals, messages = counts.one()
+    sent, failed = await BroadcastRepository(session).delivery_totals()
 
     text = (
         "📊 *System Stats*\n"
-        f"Users: `{users}`\n"
-        f"Orders: `{orders}`\n"
-        f"Referrals: `{referrals}`\n"
-        f"Messages logged: `{messages}`"
+        f"Users: `{count('users')}`\n"
+        f"Orders: `{count('orders')}`\n"
+        f"Referrals: `{count('referrals')}`\n"
+        f"Broadcast deliveries: `{sent}` sent, `{failed}` failed"
     )
 
     await message.answer(escape_markdown_v2(text))
 
 
+@router.message(Command("trends"))
+async def cmd_trends(
+    message: Message,
+    command: CommandObject | None,
+    session: AsyncSession,
+    user: User,
+) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    arg = command.args.strip() if command and command.args else ""
+    days = min(int(arg), 31) if arg.isdigit() and int(arg) > 0 else 7
+    since = bucket_start(datetime.now(timezone.utc) - timedelta(days=days - 1), "day")
+
+    rollups = RollupRepository(session)
+    per_day: Dict[str, Dict[str, int]] = {}
+    for metric in METRICS:
+        for row in await rollups.series(metric, "day", since):
+            day = per_day.setdefault(bucket_start(row.bucket, "day").strftime("%m-%d"), {})
+            day[metric] = day.get(metric, 0) + row.value
+
+    if not per_day:
+        await message.answer(f"📈 No activity in the last {days} days.")
+        return
+
+    lines = [
+        f"{day}: users `{values.get('new_users', 0)}` · orders `{values.get('orders', 0)}` · "
+        f"paid `{values.get('orders_paid', 0)}` · referrals `{values.get('referral_signups', 0)}`"
+        for day, values in sorted(per_day.items())
+    ]
+    orders = sum(values.get("orders", 0) for values in per_day.values())
+    paid = sum(values.get("orders_paid", 0) for values in per_day.values())
+    conversion = f"{paid / orders:.0%}" if orders else "n/a"
+
+    text = f"📈 *Last {days} days*\n" + "\n".join(lines) + f"\nPaid conversion: `{conversion}`"
+    await message.answer(escape_markdown_v2(text))
+
+
+@router.message(Command("leaderboard"))
+async def cmd_leaderboard(message: Message, session: AsyncSession, user: User) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    top = await UserRepository(session).top_by_downline(10)
+    if not top:
+        await message.answer("🏆 No referrals yet.")
+        return
+
+    lines = [
+        f"{rank}. {referrer.username or referrer.telegram_id} — downline `{referrer.downline_count}`, "
+        f"direct `{referrer.referral_count}`"
+        for rank, referrer in enumerate(top, start=1)
+    ]
+    await message.answer(escape_markdown_v2("🏆 *Top referrers*\n" + "\n".join(lines)))
+
+
 @router.message(Command("broadcast"))
 async def cmd_broadcast(
     message: Message,
     command: CommandObject | None,
     session: AsyncSession,
     user: User,
-    rate_limiter: RateLimiter,
+    broadcast_worker: BroadcastWorker | None = None,
 ) -> None:
     try:
         _ensure_admin(user)
@@ -109,23 +174,158 @@ async def cmd_broadcast(
         await message.answer("❌ Message too long (max 4000 chars).")
         return
 
-    repo = UserRepository(session)
-    service = BroadcastService(
-        session=session,
-        bot=message.bot,
-        rate_limiter=rate_limiter,
-        users=repo,
-        concurrency=10,
+    job = await BroadcastRepository(session).create(text, requested_by=message.chat.id)
+    await session.commit()
+    if broadcast_worker is not None:
+        broadcast_worker.notify()
+
+    await message.answer(
+        f"📣 Broadcast #{job.id} queued.\n"
+        f"/broadcast_pause {job.id} · /broadcast_cancel {job.id}"
     )
 
-    user_ids = await repo.list_user_ids()
 
-    await message.answer("📣 Broadcasting…")
+@router.message(Command("broadcasts"))
+async def cmd_broadcasts(message: Message, session: AsyncSession, user: User) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    jobs = await BroadcastRepository(session).list_active()
+    if not jobs:
+        await message.answer("📭 No active broadcasts.")
+        return
+
+    lines = [
+        f"#{job.id} {job.status} — sent {job.sent}, failed {job.failed}, skipped {job.skipped}"
+        for job in jobs
+    ]
+    await message.answer("📣 Active broadcasts\n\n" + "\n".join(lines))
 
-    summary = await service.send(user_ids, text)
 
-    await message.answer(
-        escape_markdown_v2(
-            "✅ *Broadcast Complete*\n"
-            f"Sent: `{summary.sent}`\n"
-            f"Failed: `{summary.failed}`\n"
+_BROADCAST_TRANSITIONS = {
+    "broadcast_pause": ("paused", ("pending", "running")),
+    "broadcast_resume": ("pending", ("paused",)),
+    "broadcast_cancel": ("cancelled", ("pending", "running", "paused")),
+}
+
+
+@router.message(Command(*_BROADCAST_TRANSITIONS))
+async def cmd_broadcast_control(
+    message: Message,
+    command: CommandObject,
+    session: AsyncSession,
+    user: User,
+    broadcast_worker: BroadcastWorker | None = None,
+) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    arg = command.args.strip() if command.args else ""
+    if not arg.isdigit():
+        await message.answer(f"Usage: /{command.command} <broadcast_id>")
+        return
+
+    status, from_statuses = _BROADCAST_TRANSITIONS[command.command]
+    if not await BroadcastRepository(session).transition(int(arg), status, from_statuses):
+        await message.answer(f"❌ Broadcast #{arg} cannot be {status} from its current state.")
+        return
+
+    await session.commit()
+    if broadcast_worker is not None and status == "pending":
+        broadcast_worker.notify()
+    await message.answer(f"✅ Broadcast #{arg} {status}.")
+
+
+MAX_BAN_DURATION = timedelta(days=3650)
+BAN_USAGE = "Usage: /ban <telegram_id> [30m|12h|7d] [reason] (at most 3650d)"
+
+
+def _parse_duration(value: str) -> Optional[timedelta]:
+    """None if ``value`` is not a duration; ValueError past ``MAX_BAN_DURATION``."""
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit():
+        return None
+    # Checked before building the timedelta, which overflows on huge values.
+    seconds = int(value[:-1]) * units[value[-1]]
+    if seconds > MAX_BAN_DURATION.total_seconds():
+        raise ValueError(value)
+    return timedelta(seconds=seconds)
+
+
+@router.message(Command("ban"))
+async def cmd_ban(
+    message: Message,
+    command: CommandObject | None,
+    session: AsyncSession,
+    user: User,
+    ban_index: BanIndex | None = None,
+) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    args = command.args.split(maxsplit=2) if command and command.args else []
+    if not args or not args[0].isdigit():
+        await message.answer(BAN_USAGE)
+        return
+
+    try:
+        duration = _parse_duration(args[1]) if len(args) > 1 else None
+    except ValueError:
+        await message.answer(BAN_USAGE)
+        return
+    reason = " ".join(args[2:] if duration else args[1:]) or None
+    expires_at = datetime.now(timezone.utc) + duration if duration else None
+
+    target = await UserRepository(session).get_by_telegram_id(int(args[0]))
+    if target is None:
+        await message.answer("❌ User not found.")
+        return
+
+    await BanRepository(session).create_or_update(target.id, reason=reason, expires_at=expires_at)
+    await session.commit()
+    if ban_index is not None:
+        await ban_index.ban(target.id, expires_at)
+
+    until = f" until {expires_at:%Y-%m-%d %H:%M} UTC" if expires_at else ""
+    await message.answer(f"🔨 Banned {target.telegram_id}{until}.")
+
+
+@router.message(Command("unban"))
+async def cmd_unban(
+    message: Message,
+    command: CommandObject | None,
+    session: AsyncSession,
+    user: User,
+    ban_index: BanIndex | None = None,
+) -> None:
+    try:
+        _ensure_admin(user)
+    except PermissionError:
+        await _not_authorized(message)
+        return
+
+    arg = command.args.strip() if command and command.args else ""
+    if not arg.isdigit():
+        await message.answer("Usage: /unban <telegram_id>")
+        return
+
+    target = await UserRepository(session).get_by_telegram_id(int(arg))
+    if target is None:
+        await message.answer("❌ User not found.")
+        return
+
+    await BanRepository(session).remove(target.id)
+    await session.commit()
+    if ban_index is not None:
+        await ban_index.unban(target.id)
+
+    await message.answer(f"✅ Unbanned {target.telegram_id}.")
@@ -7,7 +7,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from ...config import settings
 from ...models import User
-from ...services.referrals import ReferralService
+from ...repos.users import UserRepository
+from ...services.referrals import ReferralCodeCache, ReferralService
 from ...utils.markdown import escape_markdown_v2
 from ..keyboards import referral_keyboard, shop_keyboard
 
@@ -24,11 +25,12 @@ async def cmd_start(
     command: CommandObject | None,
     session: AsyncSession,
     user: User,
+    referral_codes: ReferralCodeCache | None = None,
 ) -> None:
     referral_code = command.args.strip() if command and command.args else None
 
     if referral_code:
-        service = ReferralService(session)
+        service = ReferralService(session, codes=referral_codes)
         await service.process_referral(user, referral_code)
 
     name = escape_markdown_v2(user.first_name or user.username or "friend")
@@ -104,7 +106,7 @@ async def cmd_about(message: Message) -> None:
 # -------------------------
 
 @router.message(Command("profile"))
-async def cmd_profile(message: Message, user: User) -> None:
+async def cmd_profile(message: Message, session: AsyncSession, user: User) -> None:
     username = escape_markdown_v2(
         user.first_name or user.username or str(user.telegram_id)
     )
@@ -114,12 +116,15 @@ async def cmd_profile(message: Message, user: User) -> None:
         f"?start={user.referral_code}"
     )
 
+    # Read live: the cached ``user`` snapshot does not see folded referral counts.
+    referral_count = await UserRepository(session).get_referral_count(user.id)
+
     text = (
         f"👤 *Profile*\n\n"
         f"Name: {username}\n"
         f"Referral code: `{user.referral_code}`\n"
         f"Referral link: {escape_markdown_v2(referral_link)}\n"
-        f"Referrals: *{user.referral_count}*"
+        f"Referrals: *{referral_count}*"
     )
 
     await message.answer(
@@ -9,12 +9,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from ...config import settings
 from ...models import User
+from ...repos.orders import OrderPage
 from ...services.payments import PaymentsService
 from ...utils.markdown import escape_markdown_v2
-from ..keyboards import checkout_keyboard
+from ..keyboards import checkout_keyboard, orders_keyboard
 
 router = Router(name="payments")
 
+ORDERS_PER_PAGE = 10
+
 
 # -------------------------
 # Helpers
@@ -38,6 +41,7 @@ async def _create_checkout(
             success_url=f"{settings.public_base_url}/payments/success",
             cancel_url=f"{settings.public_base_url}/payments/cancel",
         )
+        await session.commit()
         return checkout["url"]
     except ValueError:
         return None
@@ -104,6 +108,14 @@ async def cb_buy(
 # /orders
 # -------------------------
 
+def _render_orders(page: OrderPage) -> str:
+    lines = [
+        f"• `{order.sku}` — *{order.status}*"
+        for order in page.orders
+    ]
+    return escape_markdown_v2("📦 *Your Orders*\n\n" + "\n".join(lines))
+
+
 @router.message(Command("orders"))
 async def cmd_orders(
     message: Message,
@@ -111,20 +123,45 @@ async def cmd_orders(
     user: User,
 ) -> None:
     service = PaymentsService(session, bot=None)
-    orders = await service.orders.list_for_user(user.id)
+    page = await service.orders.page_for_user(user.id, ORDERS_PER_PAGE)
 
-    if not orders:
+    if not page.orders:
         await message.answer("📭 No orders yet.")
         return
 
-    lines = [
-        f"• `{order.sku}` — *{order.status}*"
-        for order in orders
-    ]
+    await message.answer(
+        _render_orders(page),
+        parse_mode="MarkdownV2",
+        reply_markup=orders_keyboard(page.older, page.newer),
+    )
 
-    text = "📦 *Your Orders*\n\n" + "\n".join(lines)
 
-    await message.answer(
-        escape_markdown_v2(text),
+@router.callback_query(lambda q: q.data and q.data.startswith("orders:"))
+async def cb_orders_page(
+    callback: CallbackQuery,
+    session: AsyncSession,
+    user: User,
+) -> None:
+    try:
+        _, direction, cursor = callback.data.split(":", 2)
+        anchor = int(cursor)
+    except ValueError:
+        await callback.answer()
+        return
+
+    service = PaymentsService(session, bot=None)
+    if direction == "newer":
+        page = await service.orders.page_for_user(user.id, ORDERS_PER_PAGE, after=anchor)
+    else:
+        page = await service.orders.page_for_user(user.id, ORDERS_PER_PAGE, before=anchor)
+
+    if not page.orders:
+        await callback.answer("No more orders.")
+        return
+
+    await callback.message.edit_text(
+        _render_orders(page),
         parse_mode="MarkdownV2",
+        reply_markup=orders_keyboard(page.older, page.newer),
     )
+    await callback.answer()
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import Optional
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from ..config import settings
@@ -25,6 +27,17 @@ def checkout_keyboard(url: str) -> InlineKeyboardMarkup:
     )
 
 
+def orders_keyboard(older: Optional[int], newer: Optional[int]) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if newer is not None:
+        buttons.append(InlineKeyboardButton(text="« Newer", callback_data=f"orders:newer:{newer}"))
+    if older is not None:
+        buttons.append(InlineKeyboardButton(text="Older »", callback_data=f"orders:older:{older}"))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
 def referral_keyboard(referral_code: str) -> InlineKeyboardMarkup:
     link = f"https://t.me/{settings.telegram_bot_username}?start={referral_code}"
     return InlineKeyboardMarkup(
@@ -1,13 +1,119 @@
 from aiogram import Bot, Dispatcher
+from app.bot.handlers import admin, base, payments
+from app.bot.middlewares import BanMiddleware, RateLimitMiddleware, UserContextMiddleware
 from app.config import settings
+from app.services.bans import BanIndex
+from app.services.broadcast import BroadcastWorker, DeliveryLogWriter
+from app.services.counters import CounterWorker
+from app.services.ingest import UpdateDeduplicator, UpdateQueue
+from app.services.outbound import ScheduledSendMiddleware, SendScheduler
+from app.services.payments import StripeEventWorker
 from app.services.rate_limit import RateLimiter
+from app.services.referrals import ReferralCodeCache, ReferralCountWorker
+from app.services.retention import DeliveryArchiver, MessageArchiver
+from app.services.rollups import RollupWorker
+from app.services.user_cache import UserCache
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # pragma: no cover
+    Redis = None  # type: ignore
 
 token = settings.telegram_bot_token.get_secret_value() if settings.telegram_bot_token else None
 if not token:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
 bot = Bot(token=token)
+send_scheduler = SendScheduler(
+    global_per_second=settings.telegram_global_messages_per_second,
+    private_interval_seconds=settings.telegram_private_chat_interval_seconds,
+    group_per_minute=settings.telegram_group_messages_per_minute,
+)
+bot.session.middleware(ScheduledSendMiddleware(send_scheduler))
 dispatcher = Dispatcher()
-rate_limiter = RateLimiter()
+dispatcher.include_routers(base.router, payments.router, admin.router)
+redis_client = Redis.from_url(settings.redis_url) if settings.redis_url and Redis is not None else None
+rate_limiter = RateLimiter(redis_client, max_memory_keys=settings.rate_limit_memory_max_keys)
+user_cache = UserCache(
+    maxsize=settings.user_cache_max_entries,
+    ttl_seconds=settings.user_cache_ttl_seconds,
+    redis_client=redis_client,
+    flush_interval_seconds=settings.user_cache_flush_interval_seconds,
+    flush_batch_size=settings.user_cache_flush_batch_size,
+)
+ban_index = BanIndex(
+    redis_client=redis_client,
+    reload_interval_seconds=settings.ban_index_reload_interval_seconds,
+)
+delivery_log_writer = DeliveryLogWriter(
+    batch_size=settings.broadcast_delivery_log_batch_size,
+    flush_interval_seconds=settings.broadcast_delivery_log_flush_interval_seconds,
+    max_attempts=settings.broadcast_delivery_log_max_attempts,
+    max_pending=settings.broadcast_delivery_log_max_pending,
+)
+broadcast_worker = BroadcastWorker(
+    bot,
+    rate_limiter,
+    delivery_log=delivery_log_writer,
+    chunk_size=settings.broadcast_chunk_size,
+    concurrency=settings.broadcast_concurrency,
+    poll_interval_seconds=settings.broadcast_poll_interval_seconds,
+    lease_seconds=settings.broadcast_lease_seconds,
+)
+counter_worker = CounterWorker(
+    refresh_interval_seconds=settings.counters_refresh_interval_seconds,
+    reconcile_interval_seconds=settings.counters_reconcile_interval_seconds,
+)
+referral_code_cache = ReferralCodeCache(
+    maxsize=settings.referral_code_cache_max_entries,
+    ttl_seconds=settings.referral_code_cache_ttl_seconds,
+    negative_ttl_seconds=settings.referral_code_negative_ttl_seconds,
+)
+referral_count_worker = ReferralCountWorker(
+    flush_interval_seconds=settings.referral_count_flush_interval_seconds,
+    reconcile_interval_seconds=settings.referral_count_reconcile_interval_seconds,
+    max_depth=settings.referral_tree_max_depth,
+)
+rollup_worker = RollupWorker(
+    refresh_interval_seconds=settings.rollup_refresh_interval_seconds,
+    batch_size=settings.rollup_batch_size,
+)
+message_archiver = MessageArchiver(
+    settings.messages_archive_dir,
+    retention_days=settings.messages_retention_days,
+    batch_size=settings.messages_archive_batch_size,
+    interval_seconds=settings.messages_archive_interval_seconds,
+    lease_seconds=settings.archive_lease_seconds,
+)
+delivery_archiver = DeliveryArchiver(
+    settings.deliveries_archive_dir,
+    retention_days=settings.deliveries_retention_days,
+    batch_size=settings.deliveries_archive_batch_size,
+    interval_seconds=settings.deliveries_archive_interval_seconds,
+    lease_seconds=settings.archive_lease_seconds,
+)
+stripe_event_worker = StripeEventWorker(
+    bot,
+    workers=settings.stripe_event_workers,
+    max_attempts=settings.stripe_event_max_attempts,
+    recovery_interval_seconds=settings.stripe_event_recovery_interval_seconds,
+)
+update_deduplicator = UpdateDeduplicator(settings.webhook_dedupe_window, redis_client=redis_client)
+update_queue = UpdateQueue(
+    dispatcher,
+    bot,
+    workers=settings.webhook_ingest_workers,
+    maxsize=settings.webhook_ingest_queue_size,
+    context={
+        "rate_limiter": rate_limiter,
+        "broadcast_worker": broadcast_worker,
+        "referral_codes": referral_code_cache,
+    },
+)
+
+for observer in (dispatcher.message, dispatcher.callback_query):
+    observer.outer_middleware(UserContextMiddleware(user_cache))
+    observer.outer_middleware(BanMiddleware(ban_index))
+    observer.outer_middleware(RateLimitMiddleware(rate_limiter))
 
 import os
 from fastapi import FastAPI
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Any, Awaitable, Callable, Dict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from aiogram import BaseMiddleware
 from aiogram.exceptions import CancelHandler
@@ -10,40 +11,57 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from ..config import settings
 from ..repos.bans import BanRepository
 from ..repos.users import UserRepository
+from ..services.bans import BanIndex
 from ..services.rate_limit import RateLimiter
+from ..services.user_cache import UserCache
 
 Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
 
 
 class UserContextMiddleware(BaseMiddleware):
+    def __init__(self, cache: Optional[UserCache] = None) -> None:
+        self.cache = cache
+
     async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
         session: AsyncSession | None = data.get("session")
         telegram_user = getattr(event, "from_user", None)
         if not session or telegram_user is None:
             return await handler(event, data)
-        repo = UserRepository(session)
-        user = await repo.create_or_update(
-            telegram_id=telegram_user.id,
-            username=telegram_user.username,
-            first_name=telegram_user.first_name,
-            last_name=telegram_user.last_name,
-            language_code=telegram_user.language_code,
-            is_admin=telegram_user.id in settings.admin_user_ids,
-        )
+        profile = {
+            "username": telegram_user.username,
+            "first_name": telegram_user.first_name,
+            "last_name": telegram_user.last_name,
+            "language_code": telegram_user.language_code,
+            "is_admin": telegram_user.id in settings.admin_user_ids,
+        }
+        if self.cache is not None:
+            user = await self.cache.resolve(session, telegram_user.id, **profile)
+        else:
+            user = await UserRepository(session).create_or_update(telegram_id=telegram_user.id, **profile)
         data["user"] = user
         return await handler(event, data)
 
 
 class BanMiddleware(BaseMiddleware):
+    def __init__(self, index: Optional[BanIndex] = None) -> None:
+        self.index = index
+
     async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
         session: AsyncSession | None = data.get("session")
         user = data.get("user")
         bot = data.get("bot")
-        if not session or user is None:
+        if self.index is not None:
+            data.setdefault("ban_index", self.index)
+        if user is None:
             return await handler(event, data)
-        repo = BanRepository(session)
-        ban = await repo.get_by_user_id(user.id)
-        if ban:
+        if self.index is not None:
+            banned = self.index.is_banned(user.id)
+        elif session:
+            ban = await BanRepository(session).get_active_by_user_id(user.id, datetime.now(timezone.utc))
+            banned = ban is not None
+        else:
+            banned = False
+        if banned:
             if bot and isinstance(event, Message):
                 await bot.send_message(chat_id=user.telegram_id, text="You are banned from using this bot.")
             raise CancelHandler()
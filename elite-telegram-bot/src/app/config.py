@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from functools import lru_cache
 from typing import Optional, Tuple
 
@@ -30,6 +31,17 @@ class Settings(BaseSettings):
 
     set_webhook_on_start: bool = False  # safe default
 
+    # Ack webhooks immediately and handle updates on a per-chat ordered queue
+    webhook_async_ingest: bool = False
+    webhook_ingest_workers: int = 8
+    webhook_ingest_queue_size: int = 10_000
+    webhook_dedupe_window: int = 65_536
+
+    # Bot API flood limits enforced by the outbound send scheduler
+    telegram_global_messages_per_second: float = 30.0
+    telegram_private_chat_interval_seconds: float = 1.0
+    telegram_group_messages_per_minute: int = 20
+
     # ─── Stripe (OPTIONAL) ──────────────────────────────────────────────────
     stripe_enabled: bool = False
 
@@ -40,12 +52,81 @@ class Settings(BaseSettings):
     price_id_vip_month: Optional[str] = None
     price_id_vip_year: Optional[str] = None
 
+    # Shared async client: bounded in-flight calls and per-call timeouts
+    stripe_max_concurrency: int = 20
+    stripe_timeout_seconds: float = 10.0
+    stripe_connect_timeout_seconds: float = 3.0
+    stripe_max_network_retries: int = 2
+
+    # Checkout sessions are reused per (user, sku) while they have time left
+    checkout_session_ttl_seconds: int = 3600
+    checkout_reuse_min_remaining_seconds: int = 600
+    checkout_cache_max_entries: int = 10_000
+
+    stripe_event_workers: int = 2
+    stripe_event_max_attempts: int = 5
+    stripe_event_recovery_interval_seconds: float = 60.0
+
     # ─── Infrastructure ─────────────────────────────────────────────────────
     database_url: str = "sqlite+aiosqlite:///./data.db"
     redis_url: Optional[str] = None
 
+    # ─── User Cache ─────────────────────────────────────────────────────────
+    user_cache_max_entries: int = 100_000
+    user_cache_ttl_seconds: int = 900
+    user_cache_flush_interval_seconds: float = 2.0
+    user_cache_flush_batch_size: int = 500
+
+    # ─── Rate Limiting ──────────────────────────────────────────────────────
+    rate_limit_memory_max_keys: int = 100_000
+
+    # ─── Bans ───────────────────────────────────────────────────────────────
+    # Resync interval; without Redis pub/sub this bounds how stale a worker gets
+    ban_index_reload_interval_seconds: float = 60.0
+
+    # ─── Broadcasts ─────────────────────────────────────────────────────────
+    broadcast_chunk_size: int = 500
+    broadcast_concurrency: int = 10
+    broadcast_poll_interval_seconds: float = 5.0
+    # Renewed after every chunk: keep it well above the time one chunk takes to send.
+    broadcast_lease_seconds: float = 120.0
+    broadcast_delivery_log_batch_size: int = 1000
+    broadcast_delivery_log_flush_interval_seconds: float = 1.0
+    broadcast_delivery_log_max_attempts: int = 5
+    broadcast_delivery_log_max_pending: int = 100_000
+
+    # ─── Counters ───────────────────────────────────────────────────────────
+    counters_refresh_interval_seconds: float = 30.0
+    counters_reconcile_interval_seconds: float = 3600.0
+
+    # ─── Referrals ──────────────────────────────────────────────────────────
+    referral_code_secret: Optional[SecretStr] = None   # keys the code permutation; keep stable
+    referral_code_cache_max_entries: int = 100_000
+    referral_code_cache_ttl_seconds: float = 3600.0
+    referral_code_negative_ttl_seconds: float = 300.0
+    referral_count_flush_interval_seconds: float = 1.0
+    referral_count_reconcile_interval_seconds: float = 3600.0
+    referral_tree_max_depth: int = 64
+
+    # ─── Rollups ────────────────────────────────────────────────────────────
+    rollup_refresh_interval_seconds: float = 60.0
+    rollup_batch_size: int = 5000
+
+    # ─── Retention ──────────────────────────────────────────────────────────
+    # Archive dirs must survive redeploys: in prod, absolute paths on a mounted volume.
+    archive_lease_seconds: float = 600.0
+    messages_retention_days: int = 30
+    messages_archive_dir: str = "./archive/messages"
+    messages_archive_batch_size: int = 5000
+    messages_archive_interval_seconds: float = 3600.0
+    deliveries_retention_days: int = 30
+    deliveries_archive_dir: str = "./archive/deliveries"
+    deliveries_archive_batch_size: int = 5000
+    deliveries_archive_interval_seconds: float = 3600.0
+
     # ─── Admin / Auth ───────────────────────────────────────────────────────
     admin_user_ids: Tuple[int, ...] = ()
+    admin_api_token: Optional[SecretStr] = None   # X-Admin-Token for /admin/* endpoints
 
     # ─── Validators ─────────────────────────────────────────────────────────
     @field_validator("admin_user_ids", mode="before")
@@ -102,6 +183,44 @@ class Settings(BaseSettings):
         if not self.stripe_secret_key:
             raise RuntimeError("STRIPE_SECRET_KEY is required when stripe_enabled=True")
 
+    def validate_referrals(self) -> None:
+        """
+        Without the secret, anyone can decode a referral code to its telegram id.
+        Required in prod and whenever Telegram is enabled; dev and test fall back
+        to the empty key (the web app logs a warning at startup).
+        """
+        if self.referral_code_secret:
+            return
+        if self.env == "prod" or self.telegram_enabled:
+            raise RuntimeError(
+                "REFERRAL_CODE_SECRET is required in prod or when telegram_enabled=True"
+            )
+
+    def validate_archives(self) -> None:
+        """
+        Archived rows are deleted from the database, so the files are the only copy.
+        In prod they must live on a mounted volume, never the container's working dir.
+        """
+        if self.env != "prod":
+            return
+
+        relative = [
+            name
+            for name, path in (
+                ("MESSAGES_ARCHIVE_DIR", self.messages_archive_dir),
+                ("DELIVERIES_ARCHIVE_DIR", self.deliveries_archive_dir),
+            )
+            if not os.path.isabs(path)
+        ]
+        if relative:
+            raise RuntimeError(
+                f"{', '.join(relative)} must be absolute paths on a persistent volume in prod"
+            )
+
+    def referral_key(self) -> bytes:
+        self.validate_referrals()
+        return self.referral_code_secret.get_secret_value().encode() if self.referral_code_secret else b""
+
 
 @lru_cache(maxsize=1)
 def get_settings() -> Settings:
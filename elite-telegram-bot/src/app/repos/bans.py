@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..models import Ban
@@ -16,13 +17,34 @@ class BanRepository:
         result = await self.session.execute(select(Ban).where(Ban.user_id == user_id))
         return result.scalars().first()
 
-    async def create_or_update(self, user_id: int, reason: Optional[str] = None) -> Ban:
+    async def get_active_by_user_id(self, user_id: int, now: datetime) -> Optional[Ban]:
+        result = await self.session.execute(
+            select(Ban).where(
+                Ban.user_id == user_id,
+                or_(Ban.expires_at.is_(None), Ban.expires_at > now),
+            )
+        )
+        return result.scalars().first()
+
+    async def list_active(self, now: datetime) -> List[Ban]:
+        result = await self.session.execute(
+            select(Ban).where(or_(Ban.expires_at.is_(None), Ban.expires_at > now))
+        )
+        return list(result.scalars())
+
+    async def create_or_update(
+        self,
+        user_id: int,
+        reason: Optional[str] = None,
+        expires_at: Optional[datetime] = None,
+    ) -> Ban:
         ban = await self.get_by_user_id(user_id)
         if ban is None:
-            ban = Ban(user_id=user_id, reason=reason)
+            ban = Ban(user_id=user_id, reason=reason, expires_at=expires_at)
             self.session.add(ban)
         else:
             ban.reason = reason or ban.reason
+            ban.expires_at = expires_at
         return ban
 
     async def remove(self, user_id: int) -> None:
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, exists, func, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import Broadcast, BroadcastDelivery
+
+RUNNABLE_STATUSES = ("pending", "running")
+ACTIVE_STATUSES = ("pending", "running", "paused")
+FINISHED_STATUSES = ("completed", "cancelled")
+
+# (broadcast_id, user_id, status, error_code)
+Delivery = Tuple[int, int, str, Optional[int]]
+
+
+class BroadcastRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def create(self, text: str, requested_by: Optional[int] = None) -> Broadcast:
+        broadcast = Broadcast(text=text, requested_by=requested_by, status="pending")
+        self.session.add(broadcast)
+        await self.session.flush()
+        return broadcast
+
+    async def get(self, broadcast_id: int) -> Optional[Broadcast]:
+        return await self.session.get(Broadcast, broadcast_id)
+
+    async def list_active(self, limit: int = 10) -> List[Broadcast]:
+        result = await self.session.execute(
+            select(Broadcast)
+            .where(Broadcast.status.in_(ACTIVE_STATUSES))
+            .order_by(Broadcast.id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+    async def claim_next(self, owner: str, lease_until: datetime) -> Optional[Broadcast]:
+        """
+        Lease the oldest runnable job for ``owner``.
+        A job stays with its owner while the lease is fresh; expired leases are up for grabs.
+        """
+        now = datetime.now(timezone.utc)
+        claimable = (
+            Broadcast.status.in_(RUNNABLE_STATUSES),
+            or_(
+                Broadcast.lease_owner.is_(None),
+                Broadcast.lease_owner == owner,
+                Broadcast.lease_expires_at < now,
+            ),
+        )
+        candidate = select(Broadcast.id).where(*claimable).order_by(Broadcast.id).limit(1)
+        result = await self.session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == candidate.scalar_subquery(), *claimable)
+            .values(status="running", lease_owner=owner, lease_expires_at=lease_until)
+            .returning(Broadcast.id)
+            .execution_options(synchronize_session=False)
+        )
+        broadcast_id = result.scalar()
+        if broadcast_id is None:
+            return None
+        broadcast = await self.session.get(Broadcast, broadcast_id, populate_existing=True)
+        if broadcast is not None and broadcast.started_at is None:
+            broadcast.started_at = now
+        return broadcast
+
+    async def checkpoint(
+        self,
+        broadcast: Broadcast,
+        last_user_id: int,
+        sent: int,
+        failed: int,
+        skipped: int,
+    ) -> None:
+        broadcast.last_user_id = last_user_id
+        broadcast.sent += sent
+        broadcast.failed += failed
+        broadcast.skipped += skipped
+
+    async def record_deliveries(self, deliveries: Sequence[Delivery]) -> None:
+        """
+        One executemany of the upsert. A batch re-sent after a lease takeover
+        overwrites the earlier outcome instead of failing on the key.
+        """
+        if not deliveries:
+            return
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(BroadcastDelivery)
+        await self.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[BroadcastDelivery.broadcast_id, BroadcastDelivery.user_id],
+                set_={"status": stmt.excluded.status, "error_code": stmt.excluded.error_code},
+            ),
+            [
+                {"broadcast_id": broadcast_id, "user_id": user_id, "status": status, "error_code": code}
+                for broadcast_id, user_id, status, code in deliveries
+            ],
+        )
+
+    async def delivery_totals(self) -> Tuple[int, int]:
+        """(sent, failed) over every broadcast; the per-job tallies outlive the archived rows."""
+        sent, failed = (
+            await self.session.execute(
+                select(func.coalesce(func.sum(Broadcast.sent), 0), func.coalesce(func.sum(Broadcast.failed), 0))
+            )
+        ).one()
+        return int(sent), int(failed)
+
+    async def list_archivable(self, cutoff: datetime, limit: int = 100) -> List[Broadcast]:
+        """Jobs that finished before ``cutoff`` and still have delivery rows."""
+        result = await self.session.execute(
+            select(Broadcast)
+            .where(
+                Broadcast.status.in_(FINISHED_STATUSES),
+                Broadcast.finished_at < cutoff,
+                exists().where(BroadcastDelivery.broadcast_id == Broadcast.id),
+            )
+            .order_by(Broadcast.id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+    async def list_deliveries(self, broadcast_id: int, limit: int = 5000) -> List[Delivery]:
+        """The job's lowest user ids first, a range of the primary key."""
+        result = await self.session.execute(
+            select(
+                BroadcastDelivery.broadcast_id,
+                BroadcastDelivery.user_id,
+                BroadcastDelivery.status,
+                BroadcastDelivery.error_code,
+            )
+            .where(BroadcastDelivery.broadcast_id == broadcast_id)
+            .order_by(BroadcastDelivery.user_id)
+            .limit(limit)
+        )
+        return [tuple(row) for row in result]  # type: ignore[misc]
+
+    async def delete_deliveries(self, broadcast_id: int, up_to_user_id: int) -> int:
+        result = await self.session.execute(
+            delete(BroadcastDelivery)
+            .where(BroadcastDelivery.broadcast_id == broadcast_id, BroadcastDelivery.user_id <= up_to_user_id)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def renew(self, broadcast_id: int, owner: str, lease_until: datetime) -> bool:
+        """Extend the lease; False once the job was paused, cancelled or taken over."""
+        result = await self.session.execute(
+            update(Broadcast)
+            .where(
+                Broadcast.id == broadcast_id,
+                Broadcast.status == "running",
+                Broadcast.lease_owner == owner,
+            )
+            .values(lease_expires_at=lease_until)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
+
+    async def finish(self, broadcast_id: int) -> bool:
+        # Conditional so a cancel that raced the final chunk is not overwritten.
+        result = await self.session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status == "running")
+            .values(
+                status="completed",
+                finished_at=datetime.now(timezone.utc),
+                lease_owner=None,
+                lease_expires_at=None,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
+
+    async def transition(
+        self,
+        broadcast_id: int,
+        status: str,
+        from_statuses: Iterable[str],
+    ) -> bool:
+        values: dict[str, object] = {"status": status}
+        if status == "cancelled":
+            values["finished_at"] = datetime.now(timezone.utc)
+        result = await self.session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status.in_(tuple(from_statuses)))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
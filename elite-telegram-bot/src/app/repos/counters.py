@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import Counter
+
+
+class CounterRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def get_all(self) -> Dict[str, Counter]:
+        result = await self.session.execute(select(Counter))
+        return {counter.name: counter for counter in result.scalars()}
+
+    async def ensure(self, names: Iterable[str]) -> None:
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        rows = [{"name": name, "value": 0, "high_water_id": 0} for name in names]
+        if rows:
+            await self.session.execute(insert(Counter).values(rows).on_conflict_do_nothing())
+
+    async def remove(self, names: Iterable[str]) -> None:
+        await self.session.execute(delete(Counter).where(Counter.name.in_(tuple(names))))
+
+    async def advance(self, name: str, expected_high_water: int, delta: int, high_water: int) -> bool:
+        """
+        Add ``delta`` and move the mark, but only from ``expected_high_water``.
+        A concurrent refresher that got there first makes this a no-op.
+        """
+        return await self._write(name, expected_high_water, value=Counter.value + delta, high_water=high_water)
+
+    async def reset(self, name: str, expected_high_water: int, value: int, high_water: int) -> bool:
+        return await self._write(name, expected_high_water, value=value, high_water=high_water)
+
+    async def _write(self, name: str, expected_high_water: int, value: object, high_water: int) -> bool:
+        result = await self.session.execute(
+            update(Counter)
+            .where(Counter.name == name, Counter.high_water_id == expected_high_water)
+            .values(value=value, high_water_id=high_water)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
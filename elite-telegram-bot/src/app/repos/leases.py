@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from sqlalchemy import or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import Lease
+
+
+class LeaseRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def acquire(self, name: str, owner: str, lease_until: datetime) -> bool:
+        """
+        Take or extend the ``name`` lease for ``owner``.
+        Fails while another owner holds a fresh lease; expired leases are up for grabs.
+        """
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        await self.session.execute(insert(Lease).values(name=name).on_conflict_do_nothing())
+        result = await self.session.execute(
+            update(Lease)
+            .where(
+                Lease.name == name,
+                or_(
+                    Lease.owner.is_(None),
+                    Lease.owner == owner,
+                    Lease.expires_at < datetime.now(timezone.utc),
+                ),
+            )
+            .values(owner=owner, expires_at=lease_until)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
+
+    async def release(self, name: str, owner: str) -> bool:
+        result = await self.session.execute(
+            update(Lease)
+            .where(Lease.name == name, Lease.owner == owner)
+            .values(owner=None, expires_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
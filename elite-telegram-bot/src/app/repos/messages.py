@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Iterable, List
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import MessageRecord
+
+
+class MessageRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def list_before(self, cutoff: datetime, limit: int = 5000) -> List[MessageRecord]:
+        """Oldest rows first, straight off ``ix_messages_created_at``."""
+        result = await self.session.execute(
+            select(MessageRecord)
+            .where(MessageRecord.created_at < cutoff)
+            .order_by(MessageRecord.created_at, MessageRecord.id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+    async def delete_ids(self, ids: Iterable[int]) -> int:
+        result = await self.session.execute(
+            delete(MessageRecord)
+            .where(MessageRecord.id.in_(tuple(ids)))
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import select, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..models import Order
 
 
+@dataclass
+class OrderPage:
+    orders: List[Order]
+    # Cursors are order ids; None when there is nothing further that way.
+    older: Optional[int] = None
+    newer: Optional[int] = None
+
+
 class OrderRepository:
     def __init__(self, session: AsyncSession) -> None:
         self.session = session
@@ -22,11 +31,63 @@ class OrderRepository:
         result = await self.session.execute(select(Order).where(Order.stripe_checkout_id == checkout_id))
         return result.scalars().first()
 
-    async def list_for_user(self, user_id: int) -> List[Order]:
+    async def get_open_checkout(self, user_id: int, sku: str, valid_after: datetime) -> Optional[Order]:
+        """Newest pending order for ``sku`` whose checkout session outlives ``valid_after``."""
         result = await self.session.execute(
-            select(Order).where(Order.user_id == user_id).order_by(Order.created_at.desc())
+            select(Order)
+            .where(
+                Order.user_id == user_id,
+                Order.sku == sku,
+                Order.status == "pending",
+                Order.expires_at > valid_after,
+            )
+            .order_by(Order.created_at.desc())
+            .limit(1)
+        )
+        return result.scalars().first()
+
+    async def page_for_user(
+        self,
+        user_id: int,
+        limit: int = 10,
+        *,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+    ) -> OrderPage:
+        """
+        One page of ``user_id``'s orders, newest first, keyed on ``(created_at, id)``.
+
+        ``before`` pages towards older orders from the order with that id, ``after``
+        back towards newer ones. The anchor's timestamp is read by a subquery, so
+        each page is one range scan of ``ix_orders_user_created`` however deep it is.
+        """
+        key = tuple_(Order.created_at, Order.id)
+        query = select(Order).where(Order.user_id == user_id)
+        anchor = after if after is not None else before
+        if anchor is not None:
+            anchored = select(Order.created_at).where(Order.id == anchor).scalar_subquery()
+            bound = tuple_(anchored, anchor)
+            query = query.where(key > bound if after is not None else key < bound)
+        if after is not None:
+            query = query.order_by(Order.created_at, Order.id)
+        else:
+            query = query.order_by(Order.created_at.desc(), Order.id.desc())
+
+        orders = list((await self.session.execute(query.limit(limit + 1))).scalars())
+        has_more = len(orders) > limit
+        del orders[limit:]
+        if after is not None:
+            orders.reverse()
+            return OrderPage(
+                orders,
+                older=orders[-1].id if orders else None,
+                newer=orders[0].id if orders and has_more else None,
+            )
+        return OrderPage(
+            orders,
+            older=orders[-1].id if orders and has_more else None,
+            newer=orders[0].id if orders and before is not None else None,
         )
-        return list(result.scalars())
 
     async def mark_paid(self, order: Order, payment_intent: str) -> None:
         order.status = "paid"
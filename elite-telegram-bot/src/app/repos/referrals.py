@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+from typing import Dict, Iterable
+
+from sqlalchemy import func, literal, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from ..models import Referral
 
@@ -13,3 +17,60 @@ class ReferralRepository:
         referral = Referral(referrer_id=referrer_id, referred_id=referred_id)
         self.session.add(referral)
         return referral
+
+    async def parent_map(self, user_ids: Iterable[int], up_to_id: int, max_depth: int = 64) -> Dict[int, int]:
+        """
+        child -> referrer edges on the chains above ``user_ids``, using only
+        referrals with ``id <= up_to_id`` (recursive CTE, depth-capped).
+        """
+        chain = (
+            select(
+                Referral.referred_id.label("child"),
+                Referral.referrer_id.label("parent"),
+                literal(1).label("depth"),
+            )
+            .where(Referral.referred_id.in_(tuple(user_ids)), Referral.id <= up_to_id)
+            .cte("chain", recursive=True)
+        )
+        step = aliased(Referral)
+        chain = chain.union_all(
+            select(step.referred_id, step.referrer_id, chain.c.depth + 1)
+            .join(chain, step.referred_id == chain.c.parent)
+            .where(step.id <= up_to_id, chain.c.depth < max_depth)
+        )
+        result = await self.session.execute(select(chain.c.child, chain.c.parent).distinct())
+        return {child: parent for child, parent in result.all()}
+
+    async def referral_counts(self, up_to_id: int, first_id: int, last_id: int) -> Dict[int, int]:
+        """Direct referrals per referrer in ``first_id..last_id``, over referrals with ``id <= up_to_id``."""
+        result = await self.session.execute(
+            select(Referral.referrer_id, func.count())
+            .where(Referral.referrer_id.between(first_id, last_id), Referral.id <= up_to_id)
+            .group_by(Referral.referrer_id)
+        )
+        return {referrer_id: count for referrer_id, count in result.all()}
+
+    async def subtree_sizes(
+        self, up_to_id: int, first_id: int, last_id: int, max_depth: int = 64
+    ) -> Dict[int, int]:
+        """
+        Downline size per referrer in ``first_id..last_id``, over referrals with
+        ``id <= up_to_id``. Walks every subtree in the range: reconcile only.
+        """
+        tree = (
+            select(
+                Referral.referrer_id.label("root"),
+                Referral.referred_id.label("node"),
+                literal(1).label("depth"),
+            )
+            .where(Referral.referrer_id.between(first_id, last_id), Referral.id <= up_to_id)
+            .cte("tree", recursive=True)
+        )
+        step = aliased(Referral)
+        tree = tree.union_all(
+            select(tree.c.root, step.referred_id, tree.c.depth + 1)
+            .join(tree, step.referrer_id == tree.c.node)
+            .where(step.id <= up_to_id, tree.c.depth < max_depth)
+        )
+        result = await self.session.execute(select(tree.c.root, func.count()).group_by(tree.c.root))
+        return {root: size for root, size in result.all()}
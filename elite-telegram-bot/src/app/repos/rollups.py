@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import Rollup
+
+# (granularity, metric, bucket, dimension)
+RollupKey = Tuple[str, str, datetime, str]
+
+
+class RollupRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def increment(self, deltas: Dict[RollupKey, int]) -> None:
+        if not deltas:
+            return
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(Rollup).values(
+            [
+                {"granularity": granularity, "metric": metric, "bucket": bucket, "dimension": dimension, "value": value}
+                for (granularity, metric, bucket, dimension), value in deltas.items()
+            ]
+        )
+        await self.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[Rollup.granularity, Rollup.metric, Rollup.bucket, Rollup.dimension],
+                set_={"value": Rollup.value + stmt.excluded.value},
+            )
+        )
+
+    async def series(
+        self,
+        metric: str,
+        granularity: str,
+        since: datetime,
+        until: Optional[datetime] = None,
+    ) -> List[Rollup]:
+        query = select(Rollup).where(
+            Rollup.granularity == granularity,
+            Rollup.metric == metric,
+            Rollup.bucket >= since,
+        )
+        if until is not None:
+            query = query.where(Rollup.bucket < until)
+        result = await self.session.execute(query.order_by(Rollup.bucket, Rollup.dimension))
+        return list(result.scalars())
+
+    async def clear(self) -> None:
+        await self.session.execute(delete(Rollup))
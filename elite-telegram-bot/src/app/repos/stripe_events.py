@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models import StripeEvent
+
+
+class StripeEventRepository:
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def record(self, event_id: str, event_type: str, payload: Dict[str, Any]) -> bool:
+        """Store a verified event; False when ``event_id`` was already received."""
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        result = await self.session.execute(
+            insert(StripeEvent)
+            .values(id=event_id, type=event_type, payload=payload, status="pending", attempts=0)
+            .on_conflict_do_nothing(index_elements=[StripeEvent.id])
+            .returning(StripeEvent.id)
+        )
+        return result.scalar() is not None
+
+    async def list_pending(self, received_before: Optional[datetime] = None, limit: int = 1000) -> List[str]:
+        query = select(StripeEvent.id).where(StripeEvent.status == "pending")
+        if received_before is not None:
+            query = query.where(StripeEvent.received_at < received_before)
+        result = await self.session.execute(query.order_by(StripeEvent.received_at).limit(limit))
+        return list(result.scalars())
+
+    async def claim(self, event_id: str) -> Optional[StripeEvent]:
+        """
+        Flip a pending event to processed and return it, or None if someone else did.
+        Commit in the same transaction as the side effects: a rollback puts it back.
+        """
+        result = await self.session.execute(
+            update(StripeEvent)
+            .where(StripeEvent.id == event_id, StripeEvent.status == "pending")
+            .values(status="processed", processed_at=datetime.now(timezone.utc))
+            .returning(StripeEvent.id)
+            .execution_options(synchronize_session=False)
+        )
+        if result.scalar() is None:
+            return None
+        return await self.session.get(StripeEvent, event_id, populate_existing=True)
+
+    async def record_failure(self, event_id: str, error: str, max_attempts: int) -> bool:
+        """Count a failed attempt; True while the event stays pending for a retry."""
+        result = await self.session.execute(
+            update(StripeEvent)
+            .where(StripeEvent.id == event_id, StripeEvent.status == "pending")
+            .values(attempts=StripeEvent.attempts + 1, last_error=error[:1000])
+            .returning(StripeEvent.attempts)
+            .execution_options(synchronize_session=False)
+        )
+        attempts = result.scalar()
+        if attempts is None:
+            return False
+        if attempts >= max_attempts:
+            await self.session.execute(
+                update(StripeEvent)
+                .where(StripeEvent.id == event_id)
+                .values(status="failed")
+                .execution_options(synchronize_session=False)
+            )
+            return False
+        return True
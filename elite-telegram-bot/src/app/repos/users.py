@@ -1,12 +1,20 @@
 from __future__ import annotations
 
-from typing import Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import bindparam, exists, false, func, literal, or_, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
 
+from ..config import get_settings
 from ..models import User
-from ..utils.ids import generate_referral_code
+from ..utils.ids import decode_referral_code, encode_referral_code
+
+
+def _referral_key() -> bytes:
+    return get_settings().referral_key()
 
 
 class UserRepository:
@@ -17,38 +25,198 @@ class UserRepository:
         result = await self.session.execute(select(User).where(User.telegram_id == telegram_id))
         return result.scalars().first()
 
+    async def matches(self, user_id: int, telegram_id: int) -> bool:
+        """Whether row ``user_id`` still belongs to ``telegram_id``."""
+        result = await self.session.execute(
+            select(User.id).where(User.id == user_id, User.telegram_id == telegram_id)
+        )
+        return result.scalar() is not None
+
     async def get_by_referral_code(self, code: str) -> Optional[User]:
+        # Issued codes decode straight to the telegram_id; legacy random codes fall through.
+        telegram_id = decode_referral_code(code, _referral_key())
+        if telegram_id is not None:
+            user = await self.get_by_telegram_id(telegram_id)
+            # A code issued under a rotated key decodes to some other id.
+            if user is not None and user.referral_code == encode_referral_code(telegram_id, _referral_key()):
+                return user
         result = await self.session.execute(select(User).where(User.referral_code == code))
         return result.scalars().first()
 
     async def create_or_update(self, telegram_id: int, **kwargs: object) -> User:
-        user = await self.get_by_telegram_id(telegram_id)
-        if user:
-            for key, value in kwargs.items():
-                if hasattr(user, key) and value is not None:
-                    setattr(user, key, value)
+        """
+        Native upsert on ``telegram_id``.
+        None values never overwrite stored columns, and unchanged rows are not rewritten.
+        """
+        values = {key: value for key, value in kwargs.items() if hasattr(User, key) and value is not None}
+        dialect = self.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+
+        # The code is a keyed permutation of telegram_id: unique by construction.
+        referral_code = encode_referral_code(telegram_id, _referral_key())
+        stmt = insert(User).values(telegram_id=telegram_id, referral_code=referral_code, **values)
+        table = User.__table__
+        changed = (
+            or_(*(table.c[key].is_distinct_from(stmt.excluded[key]) for key in values))
+            if values
+            else false()
+        )
+        upsert = stmt.on_conflict_do_update(
+            index_elements=[table.c.telegram_id],
+            set_={**{key: stmt.excluded[key] for key in values}, "updated_at": func.now()},
+            where=changed,
+        )
+
+        if dialect == "postgresql":
+            # Writable CTE: falls back to the current row in the same statement when nothing changed.
+            written = upsert.returning(*table.c).cte("written")
+            current = select(*table.c).where(
+                table.c.telegram_id == telegram_id, ~exists(select(written.c.id))
+            )
+            query = select(User).from_statement(union_all(select(*written.c), current))
         else:
-            referral_code = await self._generate_unique_referral_code()
-            user = User(telegram_id=telegram_id, referral_code=referral_code, **kwargs)
-            self.session.add(user)
-            await self.session.flush()
+            query = select(User).from_statement(upsert.returning(*table.c))
+
+        result = await self.session.execute(query, execution_options={"populate_existing": True})
+        user = result.scalars().first()
+        if user is None:
+            # SQLite cannot return a row the conflict clause chose not to touch.
+            user = await self.get_by_telegram_id(telegram_id)
+            if user is None:
+                # Deleted between the upsert and the read; asserts vanish under -O.
+                raise RuntimeError(f"user telegram_id={telegram_id} vanished during upsert")
         return user
 
-    async def list_user_ids(self) -> list[int]:
-        result = await self.session.execute(select(User.telegram_id))
-        return [row[0] for row in result.all()]
+    async def iter_recipient_batches(
+        self, after_id: int = 0, batch_size: int = 500
+    ) -> AsyncIterator[list[tuple[int, int]]]:
+        """
+        Yield ``(id, telegram_id)`` batches in primary-key order.
+        Keyset pagination: each batch is one indexed range query, so cost per
+        batch is flat and no cursor is held open between batches.
+        """
+        while True:
+            result = await self.session.execute(
+                select(User.id, User.telegram_id)
+                .where(User.id > after_id)
+                .order_by(User.id)
+                .limit(batch_size)
+            )
+            batch = [(row[0], row[1]) for row in result.all()]
+            if not batch:
+                return
+            yield batch
+            after_id = batch[-1][0]
 
-    async def set_referred_by(self, user: User, referrer: User) -> None:
-        if user.id == referrer.id:
-            return
-        user.referred_by_id = referrer.id
+    async def set_referred_by(self, user: User, referrer: User) -> bool:
+        """Attach ``referrer`` once; False if the user already had one (or raced to it)."""
+        return await self.set_referred_by_id(user, referrer.id)
 
-    async def increment_referral_count(self, user: User) -> None:
-        user.referral_count += 1
+    async def set_referred_by_id(self, user: User, referrer_id: int) -> bool:
+        if user.id == referrer_id:
+            return False
+        # Explicit UPDATE: ``user`` may be a detached cache snapshot, not a session-bound row.
+        result = await self.session.execute(
+            update(User)
+            .where(User.id == user.id, User.referred_by_id.is_(None))
+            .values(referred_by_id=referrer_id)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            return False
+        user.referred_by_id = referrer_id
+        return True
 
-    async def _generate_unique_referral_code(self) -> str:
-        while True:
-            code = generate_referral_code()
-            existing = await self.get_by_referral_code(code)
-            if not existing:
-                return code
+    async def get_referral_count(self, user_id: int) -> int:
+        result = await self.session.execute(select(User.referral_count).where(User.id == user_id))
+        return result.scalar() or 0
+
+    async def increment_referral_count(self, user: User, delta: int = 1) -> None:
+        """Atomic in SQL; ``user`` picks up the committed-so-far value."""
+        result = await self.session.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(referral_count=User.referral_count + delta)
+            .returning(User.referral_count)
+            .execution_options(synchronize_session=False)
+        )
+        count = result.scalar_one()
+        if isinstance(user, User):
+            # Not a pending change: a later flush must not write the value back.
+            set_committed_value(user, "referral_count", count)
+        else:
+            user.referral_count = count
+
+    async def increment_referral_counts(self, deltas: Dict[int, int]) -> None:
+        """Atomic ``referral_count = referral_count + delta`` per user, in one executemany."""
+        await self._increment("referral_count", deltas)
+
+    async def increment_downline_counts(self, deltas: Dict[int, int]) -> None:
+        await self._increment("downline_count", deltas)
+
+    async def set_referral_counts(self, values: Dict[int, int]) -> None:
+        await self._set("referral_count", values)
+
+    async def set_downline_counts(self, values: Dict[int, int]) -> None:
+        await self._set("downline_count", values)
+
+    async def get_downline_counts(self, user_ids: Iterable[int]) -> Dict[int, int]:
+        result = await self.session.execute(
+            select(User.id, User.downline_count).where(User.id.in_(tuple(user_ids)))
+        )
+        return {user_id: count for user_id, count in result.all()}
+
+    async def list_counts(self, after_id: int, limit: int = 5000) -> Dict[int, Tuple[int, int]]:
+        """id -> (referral_count, downline_count) for the next ``limit`` users, in id order."""
+        result = await self.session.execute(
+            select(User.id, User.referral_count, User.downline_count)
+            .where(User.id > after_id)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return {user_id: (referrals, downline) for user_id, referrals, downline in result.all()}
+
+    async def list_ancestor_ids(self, user_id: int, max_depth: int = 64) -> List[int]:
+        """Referrer chain above ``user_id``, nearest first (recursive CTE, depth-capped)."""
+        chain = (
+            select(User.referred_by_id.label("id"), literal(1).label("depth"))
+            .where(User.id == user_id, User.referred_by_id.is_not(None))
+            .cte("ancestors", recursive=True)
+        )
+        parent = aliased(User)
+        chain = chain.union_all(
+            select(parent.referred_by_id, chain.c.depth + 1)
+            .join(chain, parent.id == chain.c.id)
+            .where(parent.referred_by_id.is_not(None), chain.c.depth < max_depth)
+        )
+        result = await self.session.execute(select(chain.c.id).order_by(chain.c.depth))
+        return list(result.scalars())
+
+    async def top_by_downline(self, limit: int = 20) -> List[User]:
+        result = await self.session.execute(
+            select(User)
+            .where(User.downline_count > 0)
+            .order_by(User.downline_count.desc(), User.id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+    async def _set(self, column: str, values: Dict[int, int]) -> None:
+        if not values:
+            return
+        table = User.__table__
+        await self.session.execute(
+            update(table).where(table.c.id == bindparam("user_id")).values({column: bindparam("value")}),
+            [{"user_id": user_id, "value": value} for user_id, value in values.items()],
+        )
+
+    async def _increment(self, column: str, deltas: Dict[int, int]) -> None:
+        if not deltas:
+            return
+        table = User.__table__
+        await self.session.execute(
+            update(table)
+            .where(table.c.id == bindparam("user_id"))
+            .values({column: table.c[column] + bindparam("delta")}),
+            [{"user_id": user_id, "delta": delta} for user_id, delta in deltas.items()],
+        )
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, Field, ConfigDict
 
@@ -53,3 +53,53 @@ class OrderRead(BaseModel):
     paid_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
+
+
+class OrderPageRead(BaseModel):
+    items: List[OrderRead]
+    next_cursor: Optional[int] = Field(default=None, description="Pass as ``before`` for older orders")
+    prev_cursor: Optional[int] = Field(default=None, description="Pass as ``after`` for newer orders")
+
+
+# -------------------------
+# Messages
+# -------------------------
+
+class MessageRead(BaseModel):
+    id: int
+    user_id: int
+    command: str
+    status: str
+    detail: Optional[str] = None
+    created_at: datetime
+
+
+# -------------------------
+# Rollups
+# -------------------------
+
+class RollupPoint(BaseModel):
+    bucket: datetime
+    dimension: str = ""
+    value: int
+
+
+class RollupSeries(BaseModel):
+    metric: str
+    granularity: str
+    points: List[RollupPoint]
+
+
+# -------------------------
+# Referral analytics
+# -------------------------
+
+class ReferrerRead(BaseModel):
+    id: int
+    telegram_id: int
+    username: Optional[str] = None
+    referral_count: int
+    downline_count: int
+
+    model_config = ConfigDict(from_attributes=True)
+
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import json
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..logging import logger
+from ..repos.bans import BanRepository
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # pragma: no cover
+    Redis = None  # type: ignore
+
+SessionFactory = Callable[[], AsyncSession]
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    # SQLite hands back naive datetimes even for timezone-aware columns.
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class BanIndex:
+    """
+    In-memory set of active bans keyed by ``users.id``.
+
+    Loaded at startup, so checking a non-banned user never touches the database.
+    /ban and /unban go through ``ban``/``unban``, which update this worker and
+    publish the change on the ``bans`` Redis channel for every other worker.
+    Messages sent while a worker is not subscribed are lost, so each (re)subscribe
+    reloads from the database first. Without Redis, each worker reloads every
+    ``reload_interval_seconds`` instead. Temporary bans sit in a min-heap ordered
+    by ``expires_at``; ``sweep`` pops whatever has lapsed.
+    """
+
+    CHANNEL = "bans"
+
+    def __init__(
+        self,
+        sweep_interval_seconds: float = 60.0,
+        *,
+        redis_client: Optional[Redis] = None,
+        reload_interval_seconds: float = 60.0,
+        session_factory: Optional[SessionFactory] = None,
+    ) -> None:
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.redis = redis_client
+        self.reload_interval_seconds = reload_interval_seconds
+        self._session_factory = session_factory
+        self._bans: Dict[int, Optional[datetime]] = {}
+        self._expiries: List[Tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+        self._sync_task: Optional[asyncio.Task[None]] = None
+
+    def __len__(self) -> int:
+        return len(self._bans)
+
+    async def load(self, session: AsyncSession) -> None:
+        bans = await BanRepository(session).list_active(_utcnow())
+        self._bans.clear()
+        self._expiries.clear()
+        for ban in bans:
+            self.add(ban.user_id, ban.expires_at)
+        logger.info("ban_index.loaded count=%s", len(self._bans))
+
+    async def reload(self) -> None:
+        async with self._new_session() as session:
+            await self.load(session)
+
+    async def ban(self, user_id: int, expires_at: Optional[datetime] = None) -> None:
+        """Record a committed ban here and on every other worker."""
+        self.add(user_id, expires_at)
+        expires_at = _aware(expires_at)
+        await self._publish({"user_id": user_id, "expires_at": expires_at.isoformat() if expires_at else None})
+
+    async def unban(self, user_id: int) -> None:
+        """Record a committed unban here and on every other worker."""
+        self.remove(user_id)
+        await self._publish({"user_id": user_id, "unban": True})
+
+    def is_banned(self, user_id: int) -> bool:
+        if user_id not in self._bans:
+            return False
+        expires_at = self._bans[user_id]
+        if expires_at is not None and expires_at <= _utcnow():
+            # Do not wait for the sweeper to honour an expiry.
+            del self._bans[user_id]
+            return False
+        return True
+
+    def add(self, user_id: int, expires_at: Optional[datetime] = None) -> None:
+        expires_at = _aware(expires_at)
+        self._bans[user_id] = expires_at
+        if expires_at is not None:
+            heapq.heappush(self._expiries, (expires_at, user_id))
+            self._wakeup.set()
+
+    def remove(self, user_id: int) -> None:
+        # Heap entries for removed bans are skipped lazily in ``sweep``.
+        self._bans.pop(user_id, None)
+
+    def sweep(self) -> int:
+        now = _utcnow()
+        expired = 0
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._expiries)
+            if user_id in self._bans and self._bans[user_id] == expires_at:
+                del self._bans[user_id]
+                expired += 1
+        return expired
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="ban-index-sweeper")
+        if self._sync_task is None or self._sync_task.done():
+            sync = self._listen() if self.redis is not None else self._poll()
+            self._sync_task = asyncio.create_task(sync, name="ban-index-sync")
+
+    async def stop(self) -> None:
+        for task in (self._task, self._sync_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._sync_task = None
+
+    # ─── Internals ─────────────────────────────────────────────────────────
+    def _apply(self, raw: Any) -> None:
+        """Apply one message from the channel."""
+        event = json.loads(raw)
+        if event.get("unban"):
+            self.remove(event["user_id"])
+        else:
+            expires_at = event.get("expires_at")
+            self.add(event["user_id"], datetime.fromisoformat(expires_at) if expires_at else None)
+
+    async def _publish(self, event: Dict[str, Any]) -> None:
+        if self.redis is None:
+            return
+        try:
+            await self.redis.publish(self.CHANNEL, json.dumps(event))
+        except Exception:
+            # The ban is committed; other workers pick it up on their next resync.
+            logger.exception("ban_index.publish_failed user_id=%s", event["user_id"])
+
+    async def _listen(self) -> None:
+        assert self.redis is not None
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    await self.reload()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._apply(message["data"])
+            except Exception:
+                logger.exception("ban_index.listen_failed")
+            await asyncio.sleep(self.reload_interval_seconds)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval_seconds)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("ban_index.reload_failed")
+
+    async def _run(self) -> None:
+        while True:
+            self.sweep()
+            timeout = self.sweep_interval_seconds
+            if self._expiries:
+                until_next = (self._expiries[0][0] - _utcnow()).total_seconds()
+                timeout = max(0.0, min(timeout, until_next))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
@@ -1,16 +1,52 @@
 from __future__ import annotations
 
 import asyncio
+import uuid
+from collections import deque
 from dataclasses import dataclass
-from typing import Iterable, Sequence
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Deque, Iterable, List, Optional, Tuple
 
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+    TelegramUnauthorizedError,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..models import MessageRecord
+from ..logging import logger
+from ..repos.broadcasts import BroadcastRepository, Delivery
 from ..repos.users import UserRepository
+from ..services.outbound import Priority, send_priority
 from ..services.rate_limit import RateLimiter
 
+SessionFactory = Callable[[], AsyncSession]
+
+# Bot API error class -> the HTTP status it stands for; anything else is stored as 0.
+ERROR_CODES = (
+    (TelegramForbiddenError, 403),
+    (TelegramBadRequest, 400),
+    (TelegramNotFound, 404),
+    (TelegramRetryAfter, 429),
+    (TelegramUnauthorizedError, 401),
+    (TelegramConflictError, 409),
+    (TelegramEntityTooLarge, 413),
+    (TelegramServerError, 500),
+)
+
+
+def error_code(exc: BaseException) -> int:
+    for error, code in ERROR_CODES:
+        if isinstance(exc, error):
+            return code
+    return 0
+
 
 @dataclass(slots=True)
 class BroadcastSummary:
@@ -19,34 +55,174 @@ class BroadcastSummary:
     skipped: int
 
 
+class DeliveryLogWriter:
+    """
+    Buffered writer for ``broadcast_deliveries``, off the send path.
+
+    Senders only append to an in-memory buffer. A background task writes it in
+    ``batch_size`` executemany batches, every ``flush_interval_seconds`` or as
+    soon as a full batch is waiting, and ``stop`` drains whatever is left. Rows
+    buffered when the process dies are lost; the counters on ``broadcasts`` are
+    checkpointed separately and stay exact.
+
+    Each batch is its own transaction and counts its own attempts: a batch that
+    fails waits in a retry queue, apart from rows recorded since, and is dropped
+    and logged once it has failed ``max_attempts`` times. While the database is
+    down, at most ``max_pending`` rows are held; newer rows beyond that are
+    dropped on ``record`` and logged.
+    """
+
+    def __init__(
+        self,
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        batch_size: int = 1000,
+        flush_interval_seconds: float = 1.0,
+        max_attempts: int = 5,
+        max_pending: int = 100_000,
+    ) -> None:
+        self._session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self._buffer: List[Delivery] = []
+        # Batches that failed to write, oldest first, with their attempt count.
+        self._retry: Deque[Tuple[List[Delivery], int]] = deque()
+        self._retrying = 0
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def record(self, deliveries: Iterable[Delivery]) -> None:
+        rows = list(deliveries)
+        room = max(self.max_pending - self.pending, 0)
+        if len(rows) > room:
+            logger.warning(
+                "delivery_log.overflow dropped=%s pending=%s max_pending=%s",
+                len(rows) - room,
+                self.pending,
+                self.max_pending,
+            )
+            rows = rows[:room]
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer) + self._retrying
+
+    async def flush(self) -> int:
+        """
+        Write retried batches, then new rows, one batch per transaction.
+        Stops at the first batch that fails and re-raises its error.
+        """
+        written = 0
+        while self._retry or self._buffer:
+            if self._retry:
+                batch, attempts = self._retry.popleft()
+                self._retrying -= len(batch)
+            else:
+                batch = self._buffer[: self.batch_size]
+                del self._buffer[: self.batch_size]
+                attempts = 0
+            try:
+                async with self._new_session() as session:
+                    await BroadcastRepository(session).record_deliveries(batch)
+                    await session.commit()
+            except asyncio.CancelledError:
+                # Stopped mid-write: nothing was committed and ``stop`` drains it again.
+                self._requeue(batch, attempts)
+                raise
+            except Exception:
+                attempts += 1
+                if attempts < self.max_attempts:
+                    self._requeue(batch, attempts)
+                    raise
+                logger.exception(
+                    "delivery_log.batch_dropped count=%s attempts=%s", len(batch), attempts
+                )
+                continue
+            written += len(batch)
+        return written
+
+    def _requeue(self, batch: List[Delivery], attempts: int) -> None:
+        if attempts:
+            self._retry.appendleft((batch, attempts))
+            self._retrying += len(batch)
+        else:
+            self._buffer[:0] = batch
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="delivery-log-writer")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("delivery_log.flush_failed pending=%s", self.pending)
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
+
+
 class BroadcastService:
     def __init__(
         self,
         session: AsyncSession,
         bot: Bot,
         rate_limiter: RateLimiter,
-        users: UserRepository,
         *,
         concurrency: int = 10,
+        delivery_log: Optional[DeliveryLogWriter] = None,
     ) -> None:
         self.session = session
         self.bot = bot
         self.rate_limiter = rate_limiter
-        self.users = users
+        self.delivery_log = delivery_log
         self._semaphore = asyncio.Semaphore(concurrency)
 
     async def send(
         self,
-        user_ids: Iterable[int],
+        recipients: Iterable[Tuple[int, int]],
         text: str,
+        broadcast_id: Optional[int] = None,
     ) -> BroadcastSummary:
+        """
+        Send ``text`` to ``(user_id, telegram_id)`` pairs.
+        With a ``broadcast_id``, each outcome is logged to ``broadcast_deliveries``:
+        through the ``delivery_log`` writer if there is one, else in this session.
+        """
         sent = 0
         failed = 0
         skipped = 0
-        records: list[MessageRecord] = []
+        deliveries: List[Delivery] = []
 
-        async def _send_one(telegram_id: int) -> None:
+        async def _send_one(user_id: int, telegram_id: int) -> None:
             nonlocal sent, failed, skipped
+            # Each task runs in its own context copy, so this only tags broadcast traffic.
+            send_priority.set(Priority.BULK)
 
             async with self._semaphore:
                 allowed = await self.rate_limiter.allow_user(
@@ -59,45 +235,167 @@ class BroadcastService:
                     skipped += 1
                     return
 
-                user = await self.users.get_by_telegram_id(telegram_id)
-                if user is None:
-                    skipped += 1
-                    return
-
                 try:
                     await self.bot.send_message(
                         chat_id=telegram_id,
                         text=text,
                         disable_web_page_preview=True,
                     )
-                    records.append(
-                        MessageRecord(
-                            user_id=user.id,
-                            command="broadcast",
-                            status="sent",
-                            detail=text[:250],
-                        )
-                    )
+                    deliveries.append((broadcast_id, user_id, "sent", None))
                     sent += 1
                 except Exception as exc:
-                    records.append(
-                        MessageRecord(
-                            user_id=user.id,
-                            command="broadcast",
-                            status="failed",
-                            detail=str(exc)[:250],
-                        )
-                    )
+                    deliveries.append((broadcast_id, user_id, "failed", error_code(exc)))
                     failed += 1
 
-        tasks = [asyncio.create_task(_send_one(uid)) for uid in user_ids]
+        tasks = [asyncio.create_task(_send_one(*recipient)) for recipient in recipients]
         await asyncio.gather(*tasks, return_exceptions=True)
 
-        if records:
-            self.session.add_all(records)
+        if broadcast_id is not None:
+            if self.delivery_log is not None:
+                self.delivery_log.record(deliveries)
+            else:
+                await BroadcastRepository(self.session).record_deliveries(deliveries)
 
         return BroadcastSummary(
             sent=sent,
             failed=failed,
             skipped=skipped,
         )
+
+
+class BroadcastWorker:
+    """
+    Background runner for persisted broadcast jobs.
+
+    Recipients are streamed in keyset batches after the job's ``last_user_id``
+    checkpoint; each batch commits the checkpoint, and its delivery rows go to the
+    ``delivery_log`` writer (or into the same commit without one). Progress
+    survives restarts, and pause/cancel take effect at the next batch boundary.
+    Memory is bounded by ``chunk_size``.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate_limiter: RateLimiter,
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        delivery_log: Optional[DeliveryLogWriter] = None,
+        chunk_size: int = 500,
+        concurrency: int = 10,
+        poll_interval_seconds: float = 5.0,
+        lease_seconds: float = 120.0,
+    ) -> None:
+        self.bot = bot
+        self.rate_limiter = rate_limiter
+        self._session_factory = session_factory
+        self.delivery_log = delivery_log
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.poll_interval_seconds = poll_interval_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    async def run_once(self) -> bool:
+        """
+        Lease one job and stream it to completion, pause, cancel or lease loss.
+        Returns False when there was nothing to do.
+        """
+        async with self._new_session() as session:
+            jobs = BroadcastRepository(session)
+            job = await jobs.claim_next(self.owner, self._lease_until())
+            if job is None:
+                await session.rollback()
+                return False
+            await session.commit()
+
+            service = BroadcastService(
+                session=session,
+                bot=self.bot,
+                rate_limiter=self.rate_limiter,
+                concurrency=self.concurrency,
+                delivery_log=self.delivery_log,
+            )
+            batches = UserRepository(session).iter_recipient_batches(
+                after_id=job.last_user_id, batch_size=self.chunk_size
+            )
+            async for batch in batches:
+                summary = await service.send(batch, job.text, broadcast_id=job.id)
+                await jobs.checkpoint(
+                    job,
+                    last_user_id=batch[-1][0],
+                    sent=summary.sent,
+                    failed=summary.failed,
+                    skipped=summary.skipped,
+                )
+                still_ours = await jobs.renew(job.id, self.owner, self._lease_until())
+                await session.commit()
+                if not still_ours:
+                    return True
+
+            if await jobs.finish(job.id):
+                await session.commit()
+                await self._report(job.requested_by, job.id, job.sent, job.failed, job.skipped)
+            return True
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="broadcast-worker")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                logger.exception("broadcast_worker.iteration_failed")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _report(
+        self,
+        chat_id: Optional[int],
+        broadcast_id: int,
+        sent: int,
+        failed: int,
+        skipped: int,
+    ) -> None:
+        if chat_id is None:
+            return
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=(
+                    f"✅ Broadcast #{broadcast_id} complete\n"
+                    f"Sent: {sent}\nFailed: {failed}\nSkipped: {skipped}"
+                ),
+            )
+        except Exception:
+            logger.exception("broadcast_worker.report_failed")
+
+    def _lease_until(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+from time import monotonic
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..logging import logger
+from ..models import Order, Referral, User
+from ..repos.counters import CounterRepository
+
+SessionFactory = Callable[[], AsyncSession]
+
+# Counter name -> table it counts. Every table has an increasing integer ``id``.
+TRACKED = {
+    "users": User,
+    "orders": Order,
+    "referrals": Referral,
+}
+
+
+class CounterWorker:
+    """
+    Keeps the ``counters`` table in step with the tracked tables.
+
+    Each counter remembers the highest id it has counted. A refresh counts only
+    rows above that mark — a primary-key range scan whose cost is the number of
+    new rows — and advances the mark in the same transaction. Rows committed out
+    of id order or deleted later are missed; the periodic reconcile recounts
+    from scratch and corrects that drift.
+    """
+
+    def __init__(
+        self,
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        refresh_interval_seconds: float = 30.0,
+        reconcile_interval_seconds: float = 3600.0,
+    ) -> None:
+        self._session_factory = session_factory
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.reconcile_interval_seconds = reconcile_interval_seconds
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def refresh(self) -> Dict[str, int]:
+        """Fold rows added since the last refresh into the counters; returns the deltas."""
+        deltas: Dict[str, int] = {}
+        async with self._new_session() as session:
+            counters = CounterRepository(session)
+            await counters.ensure(TRACKED)
+            current = await counters.get_all()
+            for name, model in TRACKED.items():
+                mark = current[name].high_water_id
+                added, high_water = (
+                    await session.execute(
+                        select(func.count(model.id), func.max(model.id)).where(model.id > mark)
+                    )
+                ).one()
+                if added and await counters.advance(name, mark, added, high_water):
+                    deltas[name] = added
+            await session.commit()
+        return deltas
+
+    async def reconcile(self) -> Dict[str, int]:
+        """Recount every tracked table from scratch; returns the corrections applied."""
+        corrections: Dict[str, int] = {}
+        async with self._new_session() as session:
+            counters = CounterRepository(session)
+            await counters.ensure(TRACKED)
+            current = await counters.get_all()
+            for name, model in TRACKED.items():
+                total, high_water = (
+                    await session.execute(select(func.count(model.id), func.max(model.id)))
+                ).one()
+                counter = current[name]
+                # Counted up to the same mark, the values must agree.
+                drift = total - counter.value - await self._pending(session, model, counter.high_water_id, high_water)
+                if await counters.reset(name, counter.high_water_id, total, high_water or 0) and drift:
+                    corrections[name] = drift
+            await session.commit()
+        if corrections:
+            logger.warning("counters.reconciled corrections=%s", corrections)
+        return corrections
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="counter-worker")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        reconcile_due = 0.0
+        while True:
+            try:
+                if monotonic() >= reconcile_due:
+                    await self.reconcile()
+                    reconcile_due = monotonic() + self.reconcile_interval_seconds
+                else:
+                    await self.refresh()
+            except Exception:
+                logger.exception("counters.refresh_failed")
+            await asyncio.sleep(self.refresh_interval_seconds)
+
+    @staticmethod
+    async def _pending(session: AsyncSession, model: type, after_id: int, up_to: Optional[int]) -> int:
+        if up_to is None or up_to <= after_id:
+            return 0
+        return (
+            await session.execute(
+                select(func.count(model.id)).where(model.id > after_id, model.id <= up_to)
+            )
+        ).scalar_one()
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
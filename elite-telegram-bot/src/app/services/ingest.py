@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import Any, AsyncIterator, Callable, Dict, FrozenSet, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..logging import logger
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # pragma: no cover
+    Redis = None  # type: ignore
+
+SessionFactory = Callable[[], AsyncSession]
+
+
+def chat_key(update: Update) -> int:
+    """Ordering key: the chat (or user) an update belongs to, else the update itself."""
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return int(chat.id)
+    from_user = getattr(event, "from_user", None)
+    if from_user is not None:
+        return int(from_user.id)
+    return update.update_id
+
+
+def handled_update_types(dispatcher: Dispatcher) -> FrozenSet[str]:
+    """Update types some included router handles; empty when no router is included."""
+    return frozenset(dispatcher.resolve_used_update_types())
+
+
+def is_unhandled(payload: Dict[str, Any], update_types: FrozenSet[str]) -> bool:
+    """True when no handler listens to the payload's update type (empty set: accept all)."""
+    return bool(update_types) and update_types.isdisjoint(payload)
+
+
+class UpdateQueue:
+    """
+    Bounded in-process queue that decouples webhook acks from update handling.
+
+    Updates are sharded by chat across ``workers`` lanes. Each lane is drained by a
+    single task, so updates for one chat are handled strictly in arrival order while
+    different chats proceed concurrently. Every update gets its own DB session,
+    committed when the handlers finish.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        *,
+        workers: int = 8,
+        maxsize: int = 10_000,
+        session_factory: Optional[SessionFactory] = None,
+        context: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._session_factory = session_factory
+        self.context = context or {}
+        lane_size = max(1, maxsize // workers)
+        self._lanes: List[asyncio.Queue[Update]] = [asyncio.Queue(lane_size) for _ in range(workers)]
+        self._tasks: List[asyncio.Task[None]] = []
+
+    def submit(self, update: Update) -> bool:
+        """Enqueue without waiting; False when the chat's lane is full."""
+        lane = self._lanes[chat_key(update) % len(self._lanes)]
+        try:
+            lane.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    @property
+    def pending(self) -> int:
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._work(lane), name=f"update-lane-{index}")
+            for index, lane in enumerate(self._lanes)
+        ]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Drain queued updates (up to ``timeout``), then stop the lanes."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(lane.join() for lane in self._lanes)), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("update_queue.drain_timeout pending=%s", self.pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self, lane: asyncio.Queue[Update]) -> None:
+        while True:
+            update = await lane.get()
+            try:
+                await self._process(update)
+            except Exception:
+                logger.exception("update_queue.process_failed update_id=%s", update.update_id)
+            finally:
+                lane.task_done()
+
+    async def _process(self, update: Update) -> None:
+        async with self._new_session() as session:
+            await self.dispatcher.feed_update(self.bot, update, session=session, **self.context)
+            await session.commit()
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
+
+
+class UpdateDeduplicator:
+    """
+    Drops Telegram redeliveries by ``update_id`` before any handler runs.
+
+    update_ids increase monotonically, so the in-process tier is a ring bitmap over
+    the last ``window`` ids: O(1) per check and ``window / 8`` bytes in total. A
+    jump forward past the window resets the ring. Ids below the window are late
+    retries and count as seen; the Redis tier decides for them when there is one.
+    Only after ``idle_reset_seconds`` without updates does a low id reset the ring
+    instead: Telegram re-seeds the counter after a week of silence. The optional
+    Redis tier (SET NX) extends the guarantee across app workers.
+    """
+
+    def __init__(
+        self,
+        window: int = 65_536,
+        *,
+        redis_client: Optional[Redis] = None,
+        redis_ttl_seconds: int = 86_400,
+        idle_reset_seconds: float = 86_400.0,
+    ) -> None:
+        self.window = window
+        self.redis = redis_client
+        self.redis_ttl_seconds = redis_ttl_seconds
+        self.idle_reset_seconds = idle_reset_seconds
+        self._bits = bytearray((window + 7) // 8)
+        self._high: Optional[int] = None
+        self._last_seen_at = 0.0
+
+    async def seen(self, update_id: int) -> bool:
+        """Mark ``update_id`` as received; True if it already was."""
+        local = self._mark(update_id)
+        if local:
+            return True
+        if self.redis is None:
+            # ``None``: below the window, too old to tell; assume it was delivered.
+            return local is None
+        fresh = await self.redis.set(self._redis_key(update_id), 1, nx=True, ex=self.redis_ttl_seconds)
+        return not fresh
+
+    @asynccontextmanager
+    async def claim(self, update_id: Optional[int]) -> AsyncIterator[bool]:
+        """
+        Yields False for a redelivery. If the body raises, the mark is released,
+        so Telegram's retry of an update that was never handled gets through.
+        """
+        if update_id is None:
+            yield True
+            return
+        if await self.seen(update_id):
+            yield False
+            return
+        try:
+            yield True
+        except BaseException:
+            await self.release(update_id)
+            raise
+
+    async def release(self, update_id: int) -> None:
+        """Forget an update whose processing failed so Telegram's retry is accepted."""
+        if self._high is not None and self._high - self.window < update_id <= self._high:
+            self._set_bit(update_id, False)
+        if self.redis is not None:
+            await self.redis.delete(self._redis_key(update_id))
+
+    def _mark(self, update_id: int) -> Optional[bool]:
+        """True if seen, False if newly marked, None if below the window."""
+        high = self._high
+        now = monotonic()
+        idle = now - self._last_seen_at >= self.idle_reset_seconds
+        self._last_seen_at = now
+        if high is not None and update_id <= high - self.window and not idle:
+            return None
+        if high is None or update_id > high + self.window or update_id <= high - self.window:
+            self._bits = bytearray(len(self._bits))
+            self._high = update_id
+        elif update_id > high:
+            for stale in range(high + 1, update_id + 1):
+                self._set_bit(stale, False)
+            self._high = update_id
+        elif self._get_bit(update_id):
+            return True
+        self._set_bit(update_id, True)
+        return False
+
+    def _get_bit(self, update_id: int) -> bool:
+        slot = update_id % self.window
+        return bool(self._bits[slot >> 3] & (1 << (slot & 7)))
+
+    def _set_bit(self, update_id: int, value: bool) -> None:
+        slot = update_id % self.window
+        if value:
+            self._bits[slot >> 3] |= 1 << (slot & 7)
+        else:
+            self._bits[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    @staticmethod
+    def _redis_key(update_id: int) -> str:
+        return f"telegram:update:{update_id}"
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import itertools
+from contextvars import ContextVar
+from enum import IntEnum
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+
+from ..logging import logger
+
+T = TypeVar("T")
+ChatId = Union[int, str]
+
+
+class Priority(IntEnum):
+    TRANSACTIONAL = 0
+    BULK = 1
+
+
+# Outbound calls inherit their lane from the calling context; bulk senders opt in.
+send_priority: ContextVar[Priority] = ContextVar("send_priority", default=Priority.TRANSACTIONAL)
+
+
+class SendScheduler:
+    """
+    Process-wide pacing for outbound Telegram messages.
+
+    Enforces the Bot API flood limits: a global rate (~30 msg/s), one message per
+    second per private chat and ``group_per_minute`` per group. Waiting senders are
+    granted in priority order, so transactional messages overtake bulk traffic.
+    A 429 ``retry_after`` pauses the whole pipeline for the requested time.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_per_second: float = 30.0,
+        private_interval_seconds: float = 1.0,
+        group_per_minute: int = 20,
+        max_retries: int = 3,
+    ) -> None:
+        self.global_interval = 1.0 / global_per_second
+        self.private_interval = private_interval_seconds
+        self.group_interval = 60.0 / group_per_minute
+        self.max_retries = max_retries
+        self._waiters: List[Tuple[int, int, ChatId, asyncio.Future[None]]] = []
+        self._seq = itertools.count()
+        self._chat_ready: Dict[ChatId, float] = {}
+        self._global_ready = 0.0
+        self._kick = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def submit(
+        self,
+        chat_id: ChatId,
+        call: Callable[[], Awaitable[T]],
+        priority: Optional[Priority] = None,
+    ) -> T:
+        lane = send_priority.get() if priority is None else priority
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, lane)
+            try:
+                return await call()
+            except TelegramRetryAfter as exc:
+                self._back_off(chat_id, exc.retry_after)
+                logger.warning("send_scheduler.retry_after chat_id=%s seconds=%s", chat_id, exc.retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ─── Internals ─────────────────────────────────────────────────────────
+    async def _acquire(self, chat_id: ChatId, priority: Priority) -> None:
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, (int(priority), next(self._seq), chat_id, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump(), name="send-scheduler")
+        self._kick.set()
+        await future
+
+    def _interval_for(self, chat_id: ChatId) -> float:
+        # Negative ids and @usernames are groups/channels; positive ids are private chats.
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.private_interval
+        return self.group_interval
+
+    def _back_off(self, chat_id: ChatId, retry_after: float) -> None:
+        until = monotonic() + retry_after
+        self._global_ready = max(self._global_ready, until)
+        self._chat_ready[chat_id] = max(self._chat_ready.get(chat_id, 0.0), until)
+
+    async def _pump(self) -> None:
+        while True:
+            self._waiters = [waiter for waiter in self._waiters if not waiter[3].done()]
+            if not self._waiters:
+                self._kick.clear()
+                await self._kick.wait()
+                continue
+
+            now = monotonic()
+            wait = self._global_ready - now
+            if wait <= 0:
+                wait = self._grant_next(now)
+                if wait is None:
+                    continue
+
+            self._kick.clear()
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant_next(self, now: float) -> Optional[float]:
+        """Grant the highest-priority waiter whose chat is free; else return the wait time."""
+        earliest = float("inf")
+        for index, (_, _, chat_id, future) in enumerate(self._waiters):
+            ready_at = self._chat_ready.get(chat_id, 0.0)
+            if ready_at <= now:
+                del self._waiters[index]
+                future.set_result(None)
+                self._global_ready = now + self.global_interval
+                self._chat_ready[chat_id] = now + self._interval_for(chat_id)
+                if len(self._chat_ready) > 10_000:
+                    self._chat_ready = {k: v for k, v in self._chat_ready.items() if v > now}
+                return None
+            earliest = min(earliest, ready_at)
+        return earliest - now
+
+
+class ScheduledSendMiddleware(BaseRequestMiddleware):
+    """Routes every chat-bound send through the process-wide ``SendScheduler``."""
+
+    def __init__(self, scheduler: SendScheduler) -> None:
+        self.scheduler = scheduler
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[Any],
+        bot: Bot,
+        method: TelegramMethod[Any],
+    ) -> Response[Any]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(("Send", "Copy", "Forward")):
+            return await make_request(bot, method)
+        return await self.scheduler.submit(chat_id, lambda: make_request(bot, method))
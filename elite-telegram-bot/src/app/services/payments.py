@@ -1,28 +1,169 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any, Dict, Optional
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
-import stripe
 from aiogram import Bot
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
 
 from ..config import get_settings
+from ..logging import logger
 from ..models import Order, User
 from ..repos.orders import OrderRepository
+from ..repos.stripe_events import StripeEventRepository
+from ..utils.cache import TTLCache
+from .rollups import record_paid_order
+from .stripe_client import StripeGateway, get_stripe_gateway
+
+SessionFactory = Callable[[], AsyncSession]
+CheckoutKey = Tuple[int, str]
+
+
+@dataclass(frozen=True)
+class OpenCheckout:
+    session_id: str
+    url: str
+    expires_at: datetime
+
+
+# A created checkout and how long it may be reused.
+Pending = Tuple[OpenCheckout, datetime]
+
+
+class CheckoutSessionCache:
+    """
+    Open Stripe checkout sessions per ``(user_id, sku)``.
+
+    Entries live until shortly before the session expires, so repeated buy clicks
+    get the same URL without a Stripe call. Concurrent misses for one key share a
+    single in-flight creation instead of each opening a session. A created session
+    is cached and handed to those waiters only once the creating ``session`` commits
+    its order; if it rolls back instead, the waiters start over.
+
+    The cache is per process: a webhook handled elsewhere cannot invalidate it, so
+    callers re-check the order behind a hit (see ``PaymentsService``).
+    """
+
+    _SESSION_KEY = "checkout_cache.pending"
+
+    def __init__(self, maxsize: int = 10_000, ttl_seconds: float = 3600.0) -> None:
+        self._open: TTLCache[CheckoutKey, OpenCheckout] = TTLCache(maxsize, ttl_seconds)
+        self._inflight: Dict[CheckoutKey, asyncio.Future[Optional[OpenCheckout]]] = {}
+
+    def get(self, key: CheckoutKey) -> Optional[OpenCheckout]:
+        return self._open.get(key)
+
+    def put(self, key: CheckoutKey, checkout: OpenCheckout, usable_until: datetime) -> None:
+        ttl = (usable_until - datetime.now(timezone.utc)).total_seconds()
+        if ttl > 0:
+            self._open.set(key, checkout, ttl_seconds=min(ttl, self._open.ttl_seconds))
+
+    def invalidate(self, key: CheckoutKey) -> None:
+        self._open.pop(key)
+
+    async def get_or_create(
+        self,
+        key: CheckoutKey,
+        create: Callable[[], Awaitable[Pending]],
+        session: AsyncSession,
+    ) -> OpenCheckout:
+        cached = self._open.get(key)
+        if cached is not None:
+            return cached
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            shared = await asyncio.shield(inflight)
+            if shared is None:
+                # The creator rolled back; its order never existed.
+                return await self.get_or_create(key, create, session)
+            return shared
+
+        future: asyncio.Future[Optional[OpenCheckout]] = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            checkout, usable_until = await create()
+        except Exception as exc:
+            del self._inflight[key]
+            future.set_exception(exc)
+            # Waiters re-raise it; mark retrieved so an unshared failure is not logged.
+            future.exception()
+            raise
+        except BaseException:
+            del self._inflight[key]
+            future.cancel()
+            raise
+        self._track(session, key, (checkout, usable_until))
+        return checkout
+
+    def _track(self, session: AsyncSession, key: CheckoutKey, created: Pending) -> None:
+        """Hold ``checkout`` until ``session`` ends: shared on commit, dropped otherwise."""
+        pending = session.info.get(self._SESSION_KEY)
+        if pending is None:
+            pending = session.info[self._SESSION_KEY] = {}
+            event.listen(session.sync_session, "after_commit", self._after_commit)
+            # Also fires on rollback and on close without a commit.
+            event.listen(
+                session.sync_session, "after_transaction_end", self._after_transaction_end
+            )
+        pending[key] = created
+
+    def _after_commit(self, session: Session) -> None:
+        pending: Dict[CheckoutKey, Pending] = session.info.pop(self._SESSION_KEY, {})
+        for key, (checkout, usable_until) in pending.items():
+            self.put(key, checkout, usable_until)
+            self._resolve(key, checkout)
+
+    def _after_transaction_end(self, session: Session, transaction: SessionTransaction) -> None:
+        if transaction.parent is not None:
+            return
+        pending: Dict[CheckoutKey, Pending] = session.info.pop(self._SESSION_KEY, {})
+        for key in pending:
+            self._resolve(key, None)
+
+    def _resolve(self, key: CheckoutKey, checkout: Optional[OpenCheckout]) -> None:
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(checkout)
+
+
+@lru_cache(maxsize=1)
+def get_checkout_cache() -> CheckoutSessionCache:
+    settings = get_settings()
+    return CheckoutSessionCache(
+        maxsize=settings.checkout_cache_max_entries,
+        ttl_seconds=settings.checkout_session_ttl_seconds,
+    )
 
 
 class PaymentsService:
-    def __init__(self, session, bot: Optional[Bot] = None) -> None:
+    def __init__(
+        self,
+        session,
+        bot: Optional[Bot] = None,
+        gateway: Optional[StripeGateway] = None,
+        checkouts: Optional[CheckoutSessionCache] = None,
+    ) -> None:
         self.session = session
         self.orders = OrderRepository(session)
         self.bot = bot
+        self._gateway = gateway
+        self.checkouts = checkouts or get_checkout_cache()
+        # Notifications wait for ``send_notifications`` so they go out after the commit.
+        self.outbox: List[Tuple[int, str]] = []
 
         # Lazy, cached settings (safe at runtime)
         self.settings = get_settings()
 
-        # Configure Stripe only if available
-        if self.settings.stripe_secret_key:
-            stripe.api_key = self.settings.stripe_secret_key.get_secret_value()
+    @property
+    def gateway(self) -> Optional[StripeGateway]:
+        if self._gateway is None:
+            self._gateway = get_stripe_gateway()
+        return self._gateway
 
     async def create_checkout_session(
         self,
@@ -31,27 +172,70 @@ class PaymentsService:
         success_url: str,
         cancel_url: str,
     ) -> Dict[str, Any]:
-        if not self.settings.stripe_secret_key:
+        gateway = self.gateway
+        if gateway is None:
             raise ValueError("Stripe not configured")
 
         price_id = self._price_id_for_sku(sku)
         if not price_id:
             raise ValueError("SKU not available")
 
+        async def open_checkout() -> Pending:
+            return await self._open_checkout(gateway, user, sku, price_id, success_url, cancel_url)
+
+        key = (user.id, sku)
+        cached = self.checkouts.get(key)
+        if cached is not None:
+            order = await self.orders.get_by_checkout_id(cached.session_id)
+            if order is not None and order.status == "pending":
+                return {"url": cached.url, "session_id": cached.session_id}
+            # Paid or expired through a webhook another process handled.
+            self.checkouts.invalidate(key)
+
+        checkout = await self.checkouts.get_or_create(key, open_checkout, self.session)
+        return {"url": checkout.url, "session_id": checkout.session_id}
+
+    async def _open_checkout(
+        self,
+        gateway: StripeGateway,
+        user: User,
+        sku: str,
+        price_id: str,
+        success_url: str,
+        cancel_url: str,
+    ) -> Pending:
+        """
+        Reuse the user's open session for ``sku`` if it has time left, else create one.
+        The new order is left for the caller to commit; the cache waits for that commit.
+        """
+        now = datetime.now(timezone.utc)
+        margin = timedelta(seconds=self.settings.checkout_reuse_min_remaining_seconds)
+
+        order = await self.orders.get_open_checkout(user.id, sku, valid_after=now + margin)
+        if order is not None and order.checkout_url and order.expires_at:
+            expires_at = order.expires_at
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            checkout = OpenCheckout(order.stripe_checkout_id, order.checkout_url, expires_at)
+            return checkout, expires_at - margin
+
         metadata = {
             "user_id": str(user.id),
             "telegram_id": str(user.telegram_id),
             "sku": sku,
         }
+        expires_at = now + timedelta(seconds=self.settings.checkout_session_ttl_seconds)
 
-        checkout_session = await asyncio.to_thread(
-            stripe.checkout.Session.create,
-            mode="payment",
-            line_items=[{"price": price_id, "quantity": 1}],
-            success_url=success_url,
-            cancel_url=cancel_url,
-            client_reference_id=str(user.telegram_id),
-            metadata=metadata,
+        checkout_session = await gateway.create_checkout_session(
+            {
+                "mode": "payment",
+                "line_items": [{"price": price_id, "quantity": 1}],
+                "success_url": success_url,
+                "cancel_url": cancel_url,
+                "client_reference_id": str(user.telegram_id),
+                "metadata": metadata,
+                "expires_at": int(expires_at.timestamp()),
+            }
         )
 
         await self.orders.create(
@@ -59,14 +243,13 @@ class PaymentsService:
             sku=sku,
             price_id=price_id,
             stripe_checkout_id=checkout_session["id"],
-            metadata=metadata,
+            checkout_url=checkout_session["url"],
+            expires_at=expires_at,
+            extra_data=metadata,
             status="pending",
         )
-
-        return {
-            "url": checkout_session["url"],
-            "session_id": checkout_session["id"],
-        }
+        checkout = OpenCheckout(checkout_session["id"], checkout_session["url"], expires_at)
+        return checkout, expires_at - margin
 
     async def handle_checkout_event(
         self, payload: Dict[str, Any]
@@ -83,9 +266,13 @@ class PaymentsService:
         if not order:
             return None
 
+        # The session is spent either way; the next buy click needs a fresh one.
+        self.checkouts.invalidate((order.user_id, order.sku))
+
         if event_type == "checkout.session.completed" and payment_intent:
             if order.status != "paid":
                 await self.orders.mark_paid(order, payment_intent)
+                await record_paid_order(self.session, order)
                 await self._notify_user(order, "Payment received. Thank you!")
         elif event_type in {
             "checkout.session.expired",
@@ -98,20 +285,25 @@ class PaymentsService:
 
         return order
 
+    async def send_notifications(self) -> None:
+        outbox, self.outbox = self.outbox, []
+        for chat_id, message in outbox:
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=message)
+            except Exception:
+                logger.exception("payments.notify_failed chat_id=%s", chat_id)
+
     async def _notify_user(self, order: Order, message: str) -> None:
         if not self.bot:
             return
 
         telegram_id = (
-            order.metadata.get("telegram_id") if order.metadata else None
+            order.extra_data.get("telegram_id") if order.extra_data else None
         )
         if not telegram_id:
             return
 
-        await self.bot.send_message(
-            chat_id=int(telegram_id),
-            text=message,
-        )
+        self.outbox.append((int(telegram_id), message))
 
     def _price_id_for_sku(self, sku: str) -> Optional[str]:
         mapping = {
@@ -121,3 +313,125 @@ class PaymentsService:
         }
         return mapping.get(sku)
 
+
+
+class StripeEventWorker:
+    """
+    Applies verified Stripe events off the webhook request path.
+
+    The webhook stores each event in ``stripe_events`` keyed by the Stripe event id
+    and only queues ids it inserted, so redeliveries are acked without work. A worker
+    claims an event (pending -> processed) in the same transaction as the order
+    transition: a crash or error rolls both back, and a second claimer finds nothing
+    to do. Anything left pending — failures, a full queue, a restart — is picked up
+    again by the periodic recovery sweep.
+    """
+
+    def __init__(
+        self,
+        bot: Optional[Bot],
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        workers: int = 2,
+        maxsize: int = 10_000,
+        max_attempts: int = 5,
+        recovery_interval_seconds: float = 60.0,
+    ) -> None:
+        self.bot = bot
+        self._session_factory = session_factory
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.recovery_interval_seconds = recovery_interval_seconds
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize)
+        self._queued: Set[str] = set()
+        self._tasks: List[asyncio.Task[None]] = []
+
+    def submit(self, event_id: str) -> bool:
+        """Queue without waiting; False when full (recovery will catch it later)."""
+        if event_id in self._queued:
+            return True
+        try:
+            self._queue.put_nowait(event_id)
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(event_id)
+        return True
+
+    async def recover(self, received_before: Optional[datetime] = None) -> int:
+        """Queue events still pending in the database; returns how many were queued."""
+        async with self._new_session() as session:
+            event_ids = await StripeEventRepository(session).list_pending(received_before)
+        return sum(1 for event_id in event_ids if event_id not in self._queued and self.submit(event_id))
+
+    async def process(self, event_id: str) -> bool:
+        """Apply one event; False if it was already handled elsewhere."""
+        async with self._new_session() as session:
+            events = StripeEventRepository(session)
+            try:
+                event = await events.claim(event_id)
+                if event is None:
+                    await session.rollback()
+                    return False
+                service = PaymentsService(session=session, bot=self.bot)
+                await service.handle_checkout_event(event.payload)
+                await session.commit()
+            except Exception as exc:
+                await session.rollback()
+                retry = await events.record_failure(event_id, repr(exc), self.max_attempts)
+                await session.commit()
+                logger.exception("stripe_events.process_failed event_id=%s retry=%s", event_id, retry)
+                return False
+
+        await service.send_notifications()
+        return True
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._work(), name=f"stripe-events-{index}")
+            for index in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._recover_periodically(), name="stripe-events-recovery"))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Drain queued events (up to ``timeout``), then stop the workers."""
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning("stripe_events.drain_timeout pending=%s", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self) -> None:
+        while True:
+            event_id = await self._queue.get()
+            try:
+                await self.process(event_id)
+            except Exception:
+                logger.exception("stripe_events.worker_failed event_id=%s", event_id)
+            finally:
+                self._queued.discard(event_id)
+                self._queue.task_done()
+
+    async def _recover_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.recovery_interval_seconds)
+            try:
+                # Skip events younger than one interval: their webhook just queued them.
+                cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.recovery_interval_seconds)
+                recovered = await self.recover(cutoff)
+                if recovered:
+                    logger.info("stripe_events.recovered count=%s", recovered)
+            except Exception:
+                logger.exception("stripe_events.recovery_failed")
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
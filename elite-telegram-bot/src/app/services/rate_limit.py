@@ -1,19 +1,44 @@
 from __future__ import annotations
 
-from collections import deque
-from time import time
-from typing import Deque, Dict, Optional
+from time import monotonic
+from typing import Optional
+
+from ..utils.cache import TTLCache
 
 try:
     from redis.asyncio import Redis
 except ImportError:  # pragma: no cover
     Redis = None  # type: ignore
 
+# GCRA: one integer (the theoretical arrival time, in microseconds) per key.
+# Clocked by the Redis server so every app worker agrees on "now".
+# KEYS[1] = key, ARGV[1] = emission interval (us), ARGV[2] = window (us)
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+  tat = now
+end
+if tat - now > window - interval then
+  return 0
+end
+tat = tat + interval
+redis.call('SET', KEYS[1], tat, 'PX', math.ceil((tat - now) / 1000))
+return 1
+"""
+
 
 class RateLimiter:
-    def __init__(self, redis_client: Optional[Redis] = None) -> None:
+    def __init__(self, redis_client: Optional[Redis] = None, *, max_memory_keys: int = 100_000) -> None:
         self.redis = redis_client
-        self._memory_buckets: Dict[str, Deque[float]] = {}
+        # GCRA state for the in-process backend: key -> theoretical arrival time.
+        # Entries expire once idle long enough to be indistinguishable from a fresh key,
+        # and the LRU cap bounds memory regardless of how many keys are seen.
+        self._memory_tats: TTLCache[str, float] = TTLCache(max_memory_keys, ttl_seconds=60)
+        self._gcra = redis_client.register_script(_GCRA_SCRIPT) if redis_client else None
 
     async def allow(self, key: str, limit: int, window_seconds: int) -> bool:
         if limit <= 0:
@@ -31,28 +56,18 @@ class RateLimiter:
         return await self.allow(key, limit, window_seconds)
 
     async def _allow_redis(self, key: str, limit: int, window_seconds: int) -> bool:
-        assert self.redis is not None
-        now_ms = int(time() * 1000)
-        window_ms = window_seconds * 1000
-        async with self.redis.pipeline(transaction=True) as pipe:
-            pipe.zremrangebyscore(key, 0, now_ms - window_ms)
-            pipe.zadd(key, {str(now_ms): now_ms})
-            pipe.zcard(key)
-            pipe.expire(key, window_seconds * 2)
-            removed, _, count, _ = await pipe.execute()  # type: ignore[misc]
-        if count is None:
-            return True
-        if int(count) > limit:
-            await self.redis.zrem(key, str(now_ms))
-            return False
-        return True
+        # Single EVALSHA round trip; the script object reloads itself on NOSCRIPT.
+        assert self._gcra is not None
+        window_us = window_seconds * 1_000_000
+        allowed = await self._gcra(keys=[key], args=[window_us // limit, window_us])
+        return bool(allowed)
 
     def _allow_memory(self, key: str, limit: int, window_seconds: int) -> bool:
-        bucket = self._memory_buckets.setdefault(key, deque())
-        now = time()
-        while bucket and now - bucket[0] > window_seconds:
-            bucket.popleft()
-        if len(bucket) >= limit:
+        now = monotonic()
+        interval = window_seconds / limit
+        tat = max(self._memory_tats.get(key) or now, now)
+        if tat - now > window_seconds - interval + 1e-9:
             return False
-        bucket.append(now)
+        tat += interval
+        self._memory_tats.set(key, tat, ttl_seconds=tat - now)
         return True
@@ -1,27 +1,270 @@
 from __future__ import annotations
 
-from typing import Optional
+import asyncio
+from collections import Counter as Tally
+from time import monotonic
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
 
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..models import User
+from ..logging import logger
+from ..models import Referral, User
+from ..repos.counters import CounterRepository
 from ..repos.referrals import ReferralRepository
 from ..repos.users import UserRepository
+from ..utils.cache import TTLCache
+from ..utils.ids import is_plausible_referral_code, normalize_referral_code
+
+SessionFactory = Callable[[], AsyncSession]
+
+
+class ReferralCodeCache:
+    """
+    Referral code -> referrer id, answered from memory for hot and junk codes alike.
+
+    Known codes sit in a TTL/LRU cache; codes that matched nobody sit in a smaller,
+    shorter-lived negative cache. Malformed codes (bad shape or check character)
+    are rejected before either tier, so scrapers cannot fill the negative cache
+    with junk that never reaches the database anyway.
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = 100_000,
+        ttl_seconds: float = 3600.0,
+        negative_maxsize: int = 50_000,
+        negative_ttl_seconds: float = 300.0,
+    ) -> None:
+        self._codes: TTLCache[str, int] = TTLCache(maxsize, ttl_seconds)
+        self._missing: TTLCache[str, bool] = TTLCache(negative_maxsize, negative_ttl_seconds)
+
+    async def resolve(self, users: UserRepository, code: str) -> Optional[int]:
+        # Keyed on the normalized form, so case and dash variants share one entry.
+        code = normalize_referral_code(code)
+        if not is_plausible_referral_code(code):
+            return None
+        referrer_id = self._codes.get(code)
+        if referrer_id is not None:
+            return referrer_id
+        if code in self._missing:
+            return None
+
+        referrer = await users.get_by_referral_code(code)
+        if referrer is None:
+            self._missing.set(code, True)
+            return None
+        self._codes.set(code, referrer.id)
+        return referrer.id
 
 
 class ReferralService:
-    def __init__(self, session: AsyncSession) -> None:
+    def __init__(self, session: AsyncSession, codes: Optional[ReferralCodeCache] = None) -> None:
         self.users = UserRepository(session)
         self.referrals = ReferralRepository(session)
+        self.codes = codes
 
     async def process_referral(self, user: User, referral_code: Optional[str]) -> None:
         if not referral_code:
             return
         if user.referred_by_id:
             return
-        referrer = await self.users.get_by_referral_code(referral_code)
-        if not referrer or referrer.id == user.id:
+        referrer_id = await self._resolve(referral_code)
+        if referrer_id is None or referrer_id == user.id:
+            return
+        # Cycle guard: a user cannot join the downline of someone in their own downline.
+        if user.id in await self.users.list_ancestor_ids(referrer_id):
             return
-        await self.users.set_referred_by(user, referrer)
-        await self.users.increment_referral_count(referrer)
-        await self.referrals.create(referrer_id=referrer.id, referred_id=user.id)
+        if not await self.users.set_referred_by_id(user, referrer_id):
+            return
+        # ``referral_count`` is folded in from this row by ReferralCountWorker, so a
+        # viral referrer's row is not rewritten once per signup.
+        await self.referrals.create(referrer_id=referrer_id, referred_id=user.id)
+
+    async def _resolve(self, referral_code: str) -> Optional[int]:
+        if self.codes is not None:
+            return await self.codes.resolve(self.users, referral_code)
+        referrer = await self.users.get_by_referral_code(referral_code)
+        return referrer.id if referrer else None
+
+
+class ReferralCountWorker:
+    """
+    Folds new ``referrals`` rows into ``users.referral_count`` and ``downline_count``.
+
+    The referrals table is the durable buffer: each flush counts rows above an id
+    high-water mark (``counters`` row ``fold.referral_count``), groups them by
+    referrer and applies one atomic ``+ delta`` per referrer. Thousands of signups
+    for one link become a single row update per interval, and a crash loses
+    nothing because the mark only moves in the same transaction.
+
+    Each new edge also adds the joining user's subtree to every ancestor of the
+    referrer. Ancestors come from one recursive CTE per batch over already-folded
+    edges; edges within the batch are chained in memory, in id order. ``reconcile``
+    recounts both columns from referrals up to the mark to repair drift, one
+    ``batch_size`` range of user ids per transaction, and writes only rows that differ.
+    """
+
+    MARK = "fold.referral_count"
+
+    def __init__(
+        self,
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        flush_interval_seconds: float = 1.0,
+        reconcile_interval_seconds: float = 3600.0,
+        batch_size: int = 5000,
+        max_depth: int = 64,
+    ) -> None:
+        self._session_factory = session_factory
+        self.flush_interval_seconds = flush_interval_seconds
+        self.reconcile_interval_seconds = reconcile_interval_seconds
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def flush(self) -> int:
+        """Apply all unfolded referrals; returns how many rows were folded."""
+        folded = 0
+        while True:
+            count = await self._fold_batch()
+            folded += count
+            if count < self.batch_size:
+                return folded
+
+    async def reconcile(self) -> int:
+        """Recount both columns from referrals up to the mark; returns values corrected."""
+        referral_fixes = downline_fixes = 0
+        after_id: Optional[int] = 0
+        while after_id is not None:
+            after_id, referrals, downlines = await self._reconcile_batch(after_id)
+            referral_fixes += referrals
+            downline_fixes += downlines
+
+        if referral_fixes or downline_fixes:
+            logger.warning(
+                "referral_counts.reconciled referral_counts=%s downlines=%s", referral_fixes, downline_fixes
+            )
+        return referral_fixes + downline_fixes
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="referral-count-worker")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        # Reconcile once at startup too: it also fills in columns added by a migration.
+        reconcile_due = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            try:
+                await self.flush()
+                if monotonic() >= reconcile_due:
+                    await self.reconcile()
+                    reconcile_due = monotonic() + self.reconcile_interval_seconds
+            except Exception:
+                logger.exception("referral_counts.flush_failed")
+
+    async def _fold_batch(self) -> int:
+        async with self._new_session() as session:
+            counters = CounterRepository(session)
+            await counters.ensure([self.MARK])
+            mark = (await counters.get_all())[self.MARK].high_water_id
+            rows = (
+                await session.execute(
+                    select(Referral.id, Referral.referrer_id, Referral.referred_id)
+                    .where(Referral.id > mark)
+                    .order_by(Referral.id)
+                    .limit(self.batch_size)
+                )
+            ).all()
+            if not rows:
+                return 0
+            if not await counters.advance(self.MARK, mark, len(rows), rows[-1][0]):
+                # Another worker folded this page first.
+                await session.rollback()
+                return 0
+
+            users = UserRepository(session)
+            await users.increment_referral_counts(Tally(referrer_id for _, referrer_id, _ in rows))
+            await users.increment_downline_counts(await self._downline_deltas(session, rows, mark))
+            await session.commit()
+            return len(rows)
+
+    async def _reconcile_batch(self, after_id: int) -> Tuple[Optional[int], int, int]:
+        """
+        Recount the next range of users.
+        Returns (its last id, or None when done; referral fixes; downline fixes).
+        """
+        async with self._new_session() as session:
+            counters = CounterRepository(session)
+            await counters.ensure([self.MARK])
+            mark = (await counters.get_all())[self.MARK].high_water_id
+            # A no-op write on the mark row holds off concurrent folds until we commit.
+            if not await counters.advance(self.MARK, mark, 0, mark):
+                # A fold moved the mark under us: recount this range against the new one.
+                await session.rollback()
+                return after_id, 0, 0
+
+            users = UserRepository(session)
+            current = await users.list_counts(after_id, self.batch_size)
+            if not current:
+                return None, 0, 0
+            first_id, last_id = min(current), max(current)
+            referrals = ReferralRepository(session)
+            counts = await referrals.referral_counts(mark, first_id, last_id)
+            sizes = await referrals.subtree_sizes(mark, first_id, last_id, self.max_depth)
+
+            referral_fixes = {
+                user_id: counts.get(user_id, 0)
+                for user_id, (referral_count, _) in current.items()
+                if referral_count != counts.get(user_id, 0)
+            }
+            downline_fixes = {
+                user_id: sizes.get(user_id, 0)
+                for user_id, (_, downline_count) in current.items()
+                if downline_count != sizes.get(user_id, 0)
+            }
+            await users.set_referral_counts(referral_fixes)
+            await users.set_downline_counts(downline_fixes)
+            await session.commit()
+            return last_id, len(referral_fixes), len(downline_fixes)
+
+    async def _downline_deltas(self, session: AsyncSession, rows: Sequence[Any], mark: int) -> Dict[int, int]:
+        edges = [(referrer_id, referred_id) for _, referrer_id, referred_id in rows]
+        joined = {referred_id for _, referred_id in edges}
+        parents = await ReferralRepository(session).parent_map(
+            {referrer_id for referrer_id, _ in edges} | joined, mark, self.max_depth
+        )
+        subtree = await UserRepository(session).get_downline_counts(joined)
+
+        added: Tally[int] = Tally()
+        for referrer_id, referred_id in edges:
+            weight = 1 + subtree.get(referred_id, 0) + added[referred_id]
+            node: Optional[int] = referrer_id
+            seen = {referred_id}
+            for _ in range(self.max_depth):
+                if node is None or node in seen:
+                    break
+                added[node] += weight
+                seen.add(node)
+                node = parents.get(node)
+            parents[referred_id] = referrer_id
+        return added
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import os
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..logging import logger
+from ..models import MessageRecord
+from ..repos.broadcasts import BroadcastRepository, Delivery
+from ..repos.leases import LeaseRepository
+from ..repos.messages import MessageRepository
+
+SessionFactory = Callable[[], AsyncSession]
+
+
+def _utc(moment: datetime) -> datetime:
+    # SQLite hands back naive datetimes even for timezone-aware columns.
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def _to_json(record: MessageRecord) -> Dict[str, Any]:
+    return {
+        "id": record.id,
+        "user_id": record.user_id,
+        "command": record.command,
+        "status": record.status,
+        "detail": record.detail,
+        "created_at": _utc(record.created_at).isoformat(),
+    }
+
+
+def _append(files: Dict[Path, List[Dict[str, Any]]]) -> None:
+    for path, rows in files.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        payload = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+        # One write of a complete gzip member: concurrent appends cannot interleave.
+        with open(path, "ab") as archive:
+            archive.write(gzip.compress(payload.encode()))
+            archive.flush()
+            os.fsync(archive.fileno())
+
+
+async def _hold(session: AsyncSession, name: str, owner: str, seconds: float) -> bool:
+    lease_until = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return await LeaseRepository(session).acquire(name, owner, lease_until)
+
+
+class MessageArchiver:
+    """
+    Moves ``messages`` rows past the retention window into per-day archive files.
+
+    Each batch is read oldest-first off ``ix_messages_created_at`` and appended to
+    ``messages-YYYY-MM-DD.ndjson.gz`` as one more gzip member, so a file is never
+    rewritten. A run holds the ``archive.messages`` row in ``leases``, so one
+    archiver works at a time. Rows are deleted only after the file is synced, in the
+    transaction that renews the lease, so an archiver whose lease lapsed cannot delete
+    a batch another one took over. A crash between the two steps archives that batch
+    twice; ``read`` drops repeated ids.
+
+    ``archive_dir`` must outlive the container: on Railway, a mounted volume.
+
+    Nothing writes ``messages`` any more; this drains the rows logged before
+    broadcast outcomes moved to ``broadcast_deliveries``.
+    """
+
+    LEASE = "archive.messages"
+
+    def __init__(
+        self,
+        archive_dir: str,
+        *,
+        retention_days: int = 30,
+        batch_size: int = 5000,
+        interval_seconds: float = 3600.0,
+        lease_seconds: float = 600.0,
+        session_factory: Optional[SessionFactory] = None,
+    ) -> None:
+        self.archive_dir = Path(archive_dir)
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._session_factory = session_factory
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def archive(self, now: Optional[datetime] = None) -> int:
+        """Archive every row older than the window; returns how many were moved."""
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=self.retention_days)
+        if not await self._acquire():
+            return 0
+        moved = 0
+        try:
+            while True:
+                count = await self._archive_batch(cutoff)
+                moved += count
+                if count < self.batch_size:
+                    break
+        finally:
+            await self._release()
+        if moved:
+            logger.info("messages.archived count=%s cutoff=%s", moved, cutoff.isoformat())
+        return moved
+
+    async def read(
+        self,
+        since: datetime,
+        until: datetime,
+        *,
+        user_id: Optional[int] = None,
+        limit: int = 1000,
+    ) -> List[Dict[str, Any]]:
+        """
+        Archived rows with ``since <= created_at < until``, oldest first: the files
+        are streamed in the order they were written and reading stops at ``limit``.
+        """
+        return await asyncio.to_thread(self._read, _utc(since), _utc(until), user_id, limit)
+
+    def path_for(self, day: date) -> Path:
+        return self.archive_dir / f"messages-{day.isoformat()}.ndjson.gz"
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="message-archiver")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ─── Internals ─────────────────────────────────────────────────────────
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.archive()
+            except Exception:
+                logger.exception("messages.archive_failed")
+            await asyncio.sleep(self.interval_seconds)
+
+    async def _archive_batch(self, cutoff: datetime) -> int:
+        async with self._new_session() as session:
+            records = await MessageRepository(session).list_before(cutoff, self.batch_size)
+            if not records:
+                return 0
+
+            by_day: Dict[date, List[Dict[str, Any]]] = defaultdict(list)
+            for record in records:
+                by_day[_utc(record.created_at).date()].append(_to_json(record))
+            await asyncio.to_thread(_append, {self.path_for(day): rows for day, rows in by_day.items()})
+
+            if not await _hold(session, self.LEASE, self.owner, self.lease_seconds):
+                # Another archiver took over; whatever it moves, our copy is a duplicate.
+                await session.rollback()
+                logger.warning("messages.archive_lease_lost owner=%s", self.owner)
+                return 0
+            ids = [record.id for record in records]
+            await MessageRepository(session).delete_ids(ids)
+            await session.commit()
+            return len(ids)
+
+    def _read(self, since: datetime, until: datetime, user_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        # Batches are appended oldest first (created_at, id), so file order is the
+        # result order; only ids already returned need remembering to drop repeats.
+        rows: List[Dict[str, Any]] = []
+        seen: Set[int] = set()
+        day = since.date()
+        while day <= until.date():
+            path = self.path_for(day)
+            if path.exists():
+                with gzip.open(path, "rt") as archive:
+                    for line in archive:
+                        row = json.loads(line)
+                        if row["id"] in seen or (user_id is not None and row["user_id"] != user_id):
+                            continue
+                        if since <= datetime.fromisoformat(row["created_at"]) < until:
+                            rows.append(row)
+                            seen.add(row["id"])
+                            if len(rows) >= limit:
+                                return rows
+            day += timedelta(days=1)
+        return rows
+
+    async def _acquire(self) -> bool:
+        async with self._new_session() as session:
+            held = await _hold(session, self.LEASE, self.owner, self.lease_seconds)
+            await session.commit()
+        return held
+
+    async def _release(self) -> None:
+        async with self._new_session() as session:
+            await LeaseRepository(session).release(self.LEASE, self.owner)
+            await session.commit()
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
+
+
+class DeliveryArchiver:
+    """
+    Moves the ``broadcast_deliveries`` rows of long-finished broadcasts into archive files.
+
+    A job's rows go to ``deliveries-YYYY-MM-DD.ndjson.gz`` for the day it finished,
+    lowest user id first, one primary-key range per batch. As with messages, a batch
+    is deleted only after its file is synced, under the ``archive.deliveries`` lease;
+    a crash in between archives it twice, and the repeated ``(broadcast_id, user_id)``
+    rows are identical. The sent and failed totals stay on the ``broadcasts`` row.
+    """
+
+    LEASE = "archive.deliveries"
+
+    def __init__(
+        self,
+        archive_dir: str,
+        *,
+        retention_days: int = 30,
+        batch_size: int = 5000,
+        interval_seconds: float = 3600.0,
+        lease_seconds: float = 600.0,
+        session_factory: Optional[SessionFactory] = None,
+    ) -> None:
+        self.archive_dir = Path(archive_dir)
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._session_factory = session_factory
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def archive(self, now: Optional[datetime] = None) -> int:
+        """Archive the rows of every job finished before the window; returns how many were moved."""
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=self.retention_days)
+        if not await self._acquire():
+            return 0
+        try:
+            moved = await self._archive_all(cutoff)
+        finally:
+            await self._release()
+        if moved:
+            logger.info("deliveries.archived count=%s cutoff=%s", moved, cutoff.isoformat())
+        return moved
+
+    def path_for(self, day: date) -> Path:
+        return self.archive_dir / f"deliveries-{day.isoformat()}.ndjson.gz"
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="delivery-archiver")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ─── Internals ─────────────────────────────────────────────────────────
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.archive()
+            except Exception:
+                logger.exception("deliveries.archive_failed")
+            await asyncio.sleep(self.interval_seconds)
+
+    async def _archive_all(self, cutoff: datetime) -> int:
+        moved = 0
+        while True:
+            async with self._new_session() as session:
+                jobs = [
+                    (job.id, _utc(job.finished_at).date())
+                    for job in await BroadcastRepository(session).list_archivable(cutoff)
+                    if job.finished_at is not None
+                ]
+            if not jobs:
+                return moved
+            for broadcast_id, day in jobs:
+                while True:
+                    count = await self._archive_batch(broadcast_id, day)
+                    if count is None:
+                        return moved
+                    moved += count
+                    if count < self.batch_size:
+                        break
+
+    async def _archive_batch(self, broadcast_id: int, day: date) -> Optional[int]:
+        """Rows moved, or None once the lease was lost."""
+        async with self._new_session() as session:
+            repo = BroadcastRepository(session)
+            deliveries: List[Delivery] = await repo.list_deliveries(broadcast_id, self.batch_size)
+            if not deliveries:
+                return 0
+            rows = [
+                {"broadcast_id": job, "user_id": user_id, "status": status, "error_code": code}
+                for job, user_id, status, code in deliveries
+            ]
+            await asyncio.to_thread(_append, {self.path_for(day): rows})
+            if not await _hold(session, self.LEASE, self.owner, self.lease_seconds):
+                await session.rollback()
+                logger.warning("deliveries.archive_lease_lost owner=%s", self.owner)
+                return None
+            await repo.delete_deliveries(broadcast_id, deliveries[-1][1])
+            await session.commit()
+            return len(deliveries)
+
+    async def _acquire(self) -> bool:
+        async with self._new_session() as session:
+            held = await _hold(session, self.LEASE, self.owner, self.lease_seconds)
+            await session.commit()
+        return held
+
+    async def _release(self) -> None:
+        async with self._new_session() as session:
+            await LeaseRepository(session).release(self.LEASE, self.owner)
+            await session.commit()
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter as Tally
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..logging import logger
+from ..models import Order, Referral, User
+from ..repos.counters import CounterRepository
+from ..repos.rollups import RollupKey, RollupRepository
+
+SessionFactory = Callable[[], AsyncSession]
+
+GRANULARITIES = ("hour", "day")
+METRICS = ("new_users", "orders", "orders_paid", "referral_signups")
+
+
+@dataclass(frozen=True)
+class Source:
+    """An append-only table folded into a metric, bucketed by ``created_at``."""
+
+    model: Any
+    dimension: Optional[Any] = None
+
+
+# Insert-driven metrics are folded in by id high-water mark. ``orders_paid`` is a
+# status change, so it is counted where the order is marked paid instead.
+SOURCES: Dict[str, Source] = {
+    "new_users": Source(User),
+    "orders": Source(Order, Order.sku),
+    "referral_signups": Source(Referral),
+}
+
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    if moment.tzinfo is None:
+        # SQLite hands back naive datetimes even for timezone-aware columns.
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def add_to_buckets(
+    deltas: Dict[RollupKey, int],
+    metric: str,
+    moment: datetime,
+    dimension: str = "",
+    value: int = 1,
+) -> None:
+    for granularity in GRANULARITIES:
+        key = (granularity, metric, bucket_start(moment, granularity), dimension)
+        deltas[key] = deltas.get(key, 0) + value
+
+
+async def record_paid_order(session: AsyncSession, order: Order) -> None:
+    """Count a paid order in the caller's transaction, next to the status change."""
+    deltas: Dict[RollupKey, int] = {}
+    add_to_buckets(deltas, "orders_paid", order.paid_at or datetime.now(timezone.utc), order.sku)
+    await RollupRepository(session).increment(deltas)
+
+
+class RollupWorker:
+    """
+    Folds new rows into hourly and daily ``rollups``.
+
+    Each source keeps an id high-water mark in ``counters`` (``rollup.<metric>``).
+    A refresh reads the rows above the mark in ``batch_size`` pages, aggregates
+    them per bucket in memory and commits the increments together with the new
+    mark, so work per refresh is proportional to what was added since the last
+    one. ``backfill`` rebuilds everything from the raw tables.
+    """
+
+    def __init__(
+        self,
+        *,
+        session_factory: Optional[SessionFactory] = None,
+        refresh_interval_seconds: float = 60.0,
+        batch_size: int = 5000,
+    ) -> None:
+        self._session_factory = session_factory
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def refresh(self) -> Dict[str, int]:
+        """Fold every source up to date; returns rows folded per metric."""
+        folded: Tally[str] = Tally()
+        for metric, source in SOURCES.items():
+            while True:
+                count = await self._fold_batch(metric, source)
+                folded[metric] += count
+                if count < self.batch_size:
+                    break
+        return {metric: count for metric, count in folded.items() if count}
+
+    async def backfill(self) -> Dict[str, int]:
+        """
+        Rebuild all rollups from the raw tables.
+        Run it with the app stopped: paid orders recorded meanwhile would be counted twice.
+        """
+        async with self._new_session() as session:
+            await RollupRepository(session).clear()
+            await CounterRepository(session).remove(self._mark(metric) for metric in SOURCES)
+            await session.commit()
+
+        folded = await self.refresh()
+        folded["orders_paid"] = await self._backfill_paid()
+        logger.info("rollups.backfilled folded=%s", folded)
+        return folded
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="rollup-worker")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("rollups.refresh_failed")
+            await asyncio.sleep(self.refresh_interval_seconds)
+
+    async def _fold_batch(self, metric: str, source: Source) -> int:
+        model = source.model
+        name = self._mark(metric)
+        async with self._new_session() as session:
+            counters = CounterRepository(session)
+            await counters.ensure([name])
+            mark = (await counters.get_all())[name].high_water_id
+
+            columns = [model.id, model.created_at]
+            if source.dimension is not None:
+                columns.append(source.dimension)
+            rows = (
+                await session.execute(
+                    select(*columns).where(model.id > mark).order_by(model.id).limit(self.batch_size)
+                )
+            ).all()
+            if not rows:
+                return 0
+
+            deltas: Dict[RollupKey, int] = {}
+            for row in rows:
+                dimension = str(row[2]) if source.dimension is not None else ""
+                add_to_buckets(deltas, metric, row[1], dimension)
+            if not await counters.advance(name, mark, len(rows), rows[-1][0]):
+                # Another worker folded this page first.
+                await session.rollback()
+                return 0
+            await RollupRepository(session).increment(deltas)
+            await session.commit()
+            return len(rows)
+
+    async def _backfill_paid(self) -> int:
+        total = 0
+        after_id = 0
+        while True:
+            async with self._new_session() as session:
+                rows = (
+                    await session.execute(
+                        select(Order.id, Order.paid_at, Order.sku)
+                        .where(Order.id > after_id, Order.paid_at.is_not(None))
+                        .order_by(Order.id)
+                        .limit(self.batch_size)
+                    )
+                ).all()
+                if not rows:
+                    return total
+                deltas: Dict[RollupKey, int] = {}
+                for _, paid_at, sku in rows:
+                    add_to_buckets(deltas, "orders_paid", paid_at, sku)
+                await RollupRepository(session).increment(deltas)
+                await session.commit()
+            total += len(rows)
+            after_id = rows[-1][0]
+
+    @staticmethod
+    def _mark(metric: str) -> str:
+        return f"rollup.{metric}"
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import httpx
+import stripe
+
+from ..config import get_settings
+
+
+class StripeGateway:
+    """
+    Process-wide Stripe API client.
+
+    Requests go through ``StripeClient`` over a single ``httpx.AsyncClient``, so
+    calls run on the event loop (no thread pool) and reuse keep-alive connections.
+    A semaphore caps in-flight calls and every call carries connect/read timeouts,
+    so a burst of checkouts queues here instead of piling onto Stripe.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        max_concurrency: int = 20,
+        timeout_seconds: float = 10.0,
+        connect_timeout_seconds: float = 3.0,
+        max_network_retries: int = 2,
+    ) -> None:
+        self.http_client = stripe.HTTPXClient(
+            timeout=httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds),
+        )
+        self.client = stripe.StripeClient(
+            api_key,
+            http_client=self.http_client,
+            max_network_retries=max_network_retries,
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def create_checkout_session(self, params: Dict[str, Any]) -> stripe.checkout.Session:
+        async with self._slots:
+            return await self.client.v1.checkout.sessions.create_async(params)
+
+    async def close(self) -> None:
+        await self.http_client.close_async()
+
+
+@lru_cache(maxsize=1)
+def get_stripe_gateway() -> Optional[StripeGateway]:
+    """The shared gateway, or None when no Stripe key is configured."""
+    settings = get_settings()
+    if not settings.stripe_secret_key:
+        return None
+    return StripeGateway(
+        settings.stripe_secret_key.get_secret_value(),
+        max_concurrency=settings.stripe_max_concurrency,
+        timeout_seconds=settings.stripe_timeout_seconds,
+        connect_timeout_seconds=settings.stripe_connect_timeout_seconds,
+        max_network_retries=settings.stripe_max_network_retries,
+    )
+
+
+async def close_stripe_gateway() -> None:
+    if get_stripe_gateway.cache_info().currsize:
+        gateway = get_stripe_gateway()
+        if gateway is not None:
+            await gateway.close()
+        get_stripe_gateway.cache_clear()
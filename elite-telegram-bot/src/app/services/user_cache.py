@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Callable, Coroutine, Dict, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, event, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from ..logging import logger
+from ..models import User
+from ..repos.users import UserRepository
+from ..utils.cache import TTLCache
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # pragma: no cover
+    Redis = None  # type: ignore
+
+SessionFactory = Callable[[], AsyncSession]
+
+PROFILE_FIELDS = ("username", "first_name", "last_name", "language_code", "is_admin")
+
+
+@dataclass(slots=True)
+class UserSnapshot:
+    """Compact, detached view of a user row; what handlers receive as ``user``."""
+
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    language_code: Optional[str]
+    is_admin: bool
+    referral_code: str
+    referred_by_id: Optional[int]
+    referral_count: int
+
+    @classmethod
+    def from_model(cls, user: User) -> "UserSnapshot":
+        return cls(**{f.name: getattr(user, f.name) for f in fields(cls)})
+
+    def apply_profile(self, profile: Dict[str, Any]) -> bool:
+        """Apply non-None profile values; return True if anything changed."""
+        changed = False
+        for key, value in profile.items():
+            if value is not None and getattr(self, key) != value:
+                setattr(self, key, value)
+                changed = True
+        return changed
+
+
+# (snapshot, its fields when handed out or None for a new user)
+Tracked = Tuple[UserSnapshot, Optional[Dict[str, Any]]]
+
+
+class UserCache:
+    """
+    Read-through user cache with write-behind profile updates.
+
+    L1 is a bounded in-process LRU with TTL; L2 is an optional Redis tier shared
+    between workers. Profile changes seen on cached users are queued and written
+    to the database in batches by ``flush``.
+
+    Every snapshot handed out is tied to the request's session. A newly created
+    user is cached only after that session commits, because a rolled-back insert
+    frees its id for someone else. Changes a handler makes to a snapshot, such as
+    ``referred_by_id``, reach both tiers after the commit and are undone on rollback.
+    """
+
+    _SESSION_KEY = "user_cache.snapshots"
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = 100_000,
+        ttl_seconds: float = 900,
+        redis_client: Optional[Redis] = None,
+        session_factory: Optional[SessionFactory] = None,
+        flush_interval_seconds: float = 2.0,
+        flush_batch_size: int = 500,
+    ) -> None:
+        self._local: TTLCache[int, UserSnapshot] = TTLCache(maxsize, ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.redis = redis_client
+        self._session_factory = session_factory
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_batch_size = flush_batch_size
+        self._dirty: Dict[int, UserSnapshot] = {}
+        self._task: Optional[asyncio.Task[None]] = None
+        self._publishing: Set[asyncio.Task[None]] = set()
+
+    async def resolve(
+        self, session: AsyncSession, telegram_id: int, **profile: Any
+    ) -> UserSnapshot:
+        users = UserRepository(session)
+        snapshot = self._local.get(telegram_id)
+        if snapshot is None:
+            snapshot = await self._get_redis(telegram_id)
+            # Another worker's snapshot: make sure its row is still this user's.
+            if snapshot is not None and await users.matches(snapshot.id, telegram_id):
+                self._local.set(telegram_id, snapshot)
+            else:
+                snapshot = None
+
+        if snapshot is None:
+            user = await users.create_or_update(telegram_id=telegram_id, **profile)
+            snapshot = UserSnapshot.from_model(user)
+            self._track(session, snapshot, before=None)
+            return snapshot
+
+        if snapshot.apply_profile(profile):
+            self._dirty[telegram_id] = snapshot
+            await self._set_redis(snapshot)
+        self._track(session, snapshot, before=asdict(snapshot))
+        return snapshot
+
+    async def put(self, snapshot: UserSnapshot) -> None:
+        self._local.set(snapshot.telegram_id, snapshot)
+        await self._set_redis(snapshot)
+
+    async def invalidate(self, telegram_id: int) -> None:
+        self._local.pop(telegram_id)
+        if self.redis:
+            await self.redis.delete(self._redis_key(telegram_id))
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    # ─── Write-behind ──────────────────────────────────────────────────────
+    async def flush(self) -> int:
+        if not self._dirty:
+            return 0
+        batch, self._dirty = self._dirty, {}
+        rows = [
+            {
+                "b_id": snap.id,
+                "b_telegram_id": snap.telegram_id,
+                **{key: getattr(snap, key) for key in PROFILE_FIELDS},
+            }
+            for snap in batch.values()
+        ]
+        # Keyed on both ids: a snapshot whose row is gone never lands on another user.
+        stmt = (
+            update(User.__table__)
+            .where(User.id == bindparam("b_id"), User.telegram_id == bindparam("b_telegram_id"))
+            .values({key: bindparam(key) for key in PROFILE_FIELDS})
+        )
+        try:
+            async with self._new_session() as session:
+                for start in range(0, len(rows), self.flush_batch_size):
+                    await session.execute(stmt, rows[start : start + self.flush_batch_size])
+                await session.commit()
+        except Exception:
+            # Re-queue unless a newer change for the same user arrived meanwhile.
+            for telegram_id, snap in batch.items():
+                self._dirty.setdefault(telegram_id, snap)
+            raise
+        return len(rows)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="user-cache-flush")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("user_cache.flush_failed")
+
+    # ─── Session hooks ─────────────────────────────────────────────────────
+    def _track(
+        self, session: AsyncSession, snapshot: UserSnapshot, before: Optional[Dict[str, Any]]
+    ) -> None:
+        """Hold ``snapshot`` until ``session`` ends; ``before`` is None for a new user."""
+        tracked = session.info.get(self._SESSION_KEY)
+        if tracked is None:
+            tracked = session.info[self._SESSION_KEY] = {}
+            event.listen(session.sync_session, "after_commit", self._after_commit)
+            event.listen(session.sync_session, "after_rollback", self._after_rollback)
+        tracked.setdefault(snapshot.telegram_id, (snapshot, before))
+
+    def _after_commit(self, session: Session) -> None:
+        tracked: Dict[int, Tracked] = session.info.pop(self._SESSION_KEY, {})
+        for snapshot, before in tracked.values():
+            if before is None or asdict(snapshot) != before:
+                self._local.set(snapshot.telegram_id, snapshot)
+                self._spawn(self._set_redis(snapshot))
+
+    def _after_rollback(self, session: Session) -> None:
+        tracked: Dict[int, Tracked] = session.info.pop(self._SESSION_KEY, {})
+        for snapshot, before in tracked.values():
+            if before is not None:
+                for key, value in before.items():
+                    if key not in PROFILE_FIELDS:
+                        setattr(snapshot, key, value)
+
+    def _spawn(self, publish: Coroutine[Any, Any, None]) -> None:
+        # Commit hooks are synchronous; the Redis write runs as its own task.
+        task = asyncio.get_running_loop().create_task(publish)
+        self._publishing.add(task)
+        task.add_done_callback(self._published)
+
+    def _published(self, task: asyncio.Task[None]) -> None:
+        self._publishing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("user_cache.publish_failed error=%r", task.exception())
+
+    def _new_session(self) -> AsyncSession:
+        if self._session_factory is None:
+            from ..db import AsyncSessionLocal
+
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory()
+
+    # ─── Redis tier ────────────────────────────────────────────────────────
+    @staticmethod
+    def _redis_key(telegram_id: int) -> str:
+        return f"user:snapshot:{telegram_id}"
+
+    async def _get_redis(self, telegram_id: int) -> Optional[UserSnapshot]:
+        if not self.redis:
+            return None
+        raw = await self.redis.get(self._redis_key(telegram_id))
+        if raw is None:
+            return None
+        return UserSnapshot(**json.loads(raw))
+
+    async def _set_redis(self, snapshot: UserSnapshot) -> None:
+        if not self.redis:
+            return
+        await self.redis.set(
+            self._redis_key(snapshot.telegram_id),
+            json.dumps(asdict(snapshot)),
+            ex=int(self.ttl_seconds),
+        )
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Bounded LRU mapping with per-entry expiry.
+    Expired entries are dropped lazily on access and when making room.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float) -> None:
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._data[key] = (monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._evict()
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def _evict(self) -> None:
+        # Oldest entries sit at the front; drop stale ones first, then LRU.
+        now = monotonic()
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.maxsize:
+                break
+            del self._data[key]
@@ -1,13 +1,96 @@
 from __future__ import annotations
 
+import hashlib
 import secrets
 import string
+from typing import Optional
 
+# Crockford base32: no I, L, O or U, so codes survive being read aloud or retyped.
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_CROCKFORD_VALUES = {char: value for value, char in enumerate(_CROCKFORD)}
+_CROCKFORD_VALUES.update({"O": 0, "I": 1, "L": 1})
 
-def generate_referral_code(length: int = 8) -> str:
-    alphabet = string.ascii_uppercase + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+_HALF_BITS = 30
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_FEISTEL_ROUNDS = 4
+_CODE_DIGITS = 2 * _HALF_BITS // 5   # 12 payload characters + 1 check character
+
+# Codes issued before the permutation: ``generate_referral_code()`` with its defaults.
+_LEGACY_ALPHABET = string.ascii_uppercase + string.digits
+_LEGACY_CHARS = frozenset(_LEGACY_ALPHABET)
+_LEGACY_LENGTH = 8
+
+
+def generate_referral_code(length: int = _LEGACY_LENGTH) -> str:
+    return ''.join(secrets.choice(_LEGACY_ALPHABET) for _ in range(length))
 
 
 def generate_request_id() -> str:
     return secrets.token_hex(8)
+
+
+def _round(value: int, key: bytes, index: int) -> int:
+    digest = hashlib.blake2b(
+        value.to_bytes(4, "big"), digest_size=4, key=key[:64], person=b"refcode%d" % index
+    ).digest()
+    return int.from_bytes(digest, "big") & _HALF_MASK
+
+
+def _feistel(value: int, key: bytes, reverse: bool = False) -> int:
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    rounds = range(_FEISTEL_ROUNDS - 1, -1, -1) if reverse else range(_FEISTEL_ROUNDS)
+    for index in rounds:
+        if reverse:
+            left, right = right ^ _round(left, key, index), left
+        else:
+            left, right = right, left ^ _round(right, key, index)
+    return (left << _HALF_BITS) | right
+
+
+def _check_digit(digits: list[int]) -> int:
+    # Position-weighted, so swapped neighbours are caught as well as typos.
+    return sum((position + 1) * digit for position, digit in enumerate(digits)) % 32
+
+
+def encode_referral_code(number: int, key: bytes = b"") -> str:
+    """
+    Collision-free referral code for a non-negative id below 2**60.
+    A keyed Feistel permutation hides the id; the code is 13 Crockford base32 characters.
+    """
+    if not 0 <= number <= (1 << 2 * _HALF_BITS) - 1:
+        raise ValueError("number out of range")
+    permuted = _feistel(number, key)
+    digits = [(permuted >> (5 * shift)) & 31 for shift in range(_CODE_DIGITS - 1, -1, -1)]
+    return "".join(_CROCKFORD[digit] for digit in digits + [_check_digit(digits)])
+
+
+def normalize_referral_code(code: str) -> str:
+    """The form codes are compared in: upper-case, no surrounding space or dashes."""
+    return code.strip().upper().replace("-", "")
+
+
+def is_plausible_referral_code(code: str) -> bool:
+    """Cheap shape check: issued codes must carry a valid check character."""
+    code = normalize_referral_code(code)
+    if len(code) == _CODE_DIGITS + 1:
+        digits = [_CROCKFORD_VALUES.get(char) for char in code]
+        return None not in digits and _check_digit(digits[:-1]) == digits[-1]  # type: ignore[arg-type]
+    # Legacy random codes: exactly their generated length and alphabet.
+    return len(code) == _LEGACY_LENGTH and _LEGACY_CHARS.issuperset(code)
+
+
+def decode_referral_code(code: str, key: bytes = b"") -> Optional[int]:
+    """Inverse of ``encode_referral_code``; None for anything malformed or mistyped."""
+    code = normalize_referral_code(code)
+    if len(code) != _CODE_DIGITS + 1:
+        return None
+    try:
+        digits = [_CROCKFORD_VALUES[char] for char in code]
+    except KeyError:
+        return None
+    if _check_digit(digits[:-1]) != digits[-1]:
+        return None
+    permuted = 0
+    for digit in digits[:-1]:
+        permuted = (permuted << 5) | digit
+    return _feistel(permuted, key, reverse=True)
@@ -1,12 +1,24 @@
 from __future__ import annotations
 
+import hmac
 import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, FrozenSet, List, Literal, Optional
+
 import stripe
 
-from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
+from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
 from aiogram import Bot, Dispatcher
 from aiogram.types import Update
 
@@ -16,20 +28,89 @@ from ..schemas import (
     CheckoutSessionRequest,
     CheckoutSessionResponse,
     HealthResponse,
+    MessageRead,
+    OrderPageRead,
+    OrderRead,
+    ReferrerRead,
+    RollupPoint,
+    RollupSeries,
 )
-from ..services.payments import PaymentsService
+from ..repos.orders import OrderRepository
+from ..repos.rollups import RollupRepository
+from ..repos.stripe_events import StripeEventRepository
+from ..repos.users import UserRepository
+from ..services.ingest import handled_update_types, is_unhandled
+from ..services.payments import PaymentsService, StripeEventWorker
 from ..services.rate_limit import RateLimiter
+from ..services.retention import MessageArchiver
+from ..services.rollups import METRICS, bucket_start
+from ..services.stripe_client import close_stripe_gateway
 from .deps import (
+    get_ban_index,
     get_bot,
+    get_broadcast_worker,
+    get_counter_worker,
+    get_delivery_archiver,
+    get_delivery_log_writer,
     get_db_session,
     get_dispatcher,
+    get_message_archiver,
     get_rate_limiter,
+    get_referral_code_cache,
+    get_referral_count_worker,
+    get_rollup_worker,
+    get_send_scheduler,
+    get_stripe_event_worker,
+    get_update_deduplicator,
+    get_update_queue,
+    get_user_cache,
 )
-from ..db import close_engine
+from ..db import AsyncSessionLocal, close_engine
 
 configure_logging()
 
-app = FastAPI(title="Elite Telegram Bot", version="0.1.0")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson when it is installed."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+app = FastAPI(title="Elite Telegram Bot", version="0.1.0", default_response_class=FastJSONResponse)
+
+
+def _loads(body: bytes) -> Any:
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+@dataclass(frozen=True, slots=True)
+class TelegramWebhookConfig:
+    """Webhook settings validated once and kept in the shape the hot path needs."""
+
+    enabled: bool
+    secret: bytes
+    async_ingest: bool
+    # Update types some handler listens to; empty means "accept everything".
+    update_types: FrozenSet[str]
+
+
+@lru_cache(maxsize=1)
+def telegram_webhook_config() -> TelegramWebhookConfig:
+    settings = get_settings()
+    if not settings.telegram_enabled:
+        return TelegramWebhookConfig(False, b"", False, frozenset())
+    settings.validate_telegram()
+    assert settings.telegram_webhook_secret_token is not None
+    return TelegramWebhookConfig(
+        enabled=True,
+        secret=settings.telegram_webhook_secret_token.get_secret_value().encode(),
+        async_ingest=settings.webhook_async_ingest,
+        update_types=handled_update_types(get_dispatcher()),
+    )
+
 
 # ─────────────────────────────────────────────────────────────
 # STARTUP / SHUTDOWN
@@ -37,11 +118,40 @@ app = FastAPI(title="Elite Telegram Bot", version="0.1.0")
 @app.on_event("startup")
 async def on_startup() -> None:
     settings = get_settings()
+    settings.validate_referrals()
+    settings.validate_archives()
+    if not settings.referral_code_secret and settings.env != "test":
+        logger.warning("startup.referral_code_secret_missing env=%s", settings.env)
+    telegram_webhook_config()
+
+    if settings.stripe_enabled:
+        stripe_event_worker = get_stripe_event_worker()
+        stripe_event_worker.start()
+        recovered = await stripe_event_worker.recover()
+        logger.info("startup.stripe_events_recovered count=%s", recovered)
 
     if not settings.telegram_enabled:
         logger.info("startup.telegram_disabled")
         return
 
+    get_user_cache().start()
+
+    ban_index = get_ban_index()
+    async with AsyncSessionLocal() as db_session:
+        await ban_index.load(db_session)
+    ban_index.start()
+
+    get_delivery_log_writer().start()
+    get_broadcast_worker().start()
+    get_counter_worker().start()
+    get_referral_count_worker().start()
+    get_rollup_worker().start()
+    get_message_archiver().start()
+    get_delivery_archiver().start()
+
+    if settings.webhook_async_ingest:
+        get_update_queue().start()
+
     if not settings.set_webhook_on_start:
         logger.info("startup.webhook_autoset_disabled")
         return
@@ -63,6 +173,20 @@ async def on_startup() -> None:
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    await get_update_queue().stop()
+    await get_stripe_event_worker().stop()
+    await get_broadcast_worker().stop()
+    # After the broadcast worker, so its last batch is in the buffer being drained.
+    await get_delivery_log_writer().stop()
+    await get_counter_worker().stop()
+    await get_referral_count_worker().stop()
+    await get_rollup_worker().stop()
+    await get_message_archiver().stop()
+    await get_delivery_archiver().stop()
+    await get_ban_index().stop()
+    await get_user_cache().stop()
+    await get_send_scheduler().stop()
+    await close_stripe_gateway()
     await close_engine()
     logger.info("shutdown.complete")
 
@@ -95,37 +219,63 @@ async def telegram_webhook(
         alias="X-Telegram-Bot-Api-Secret-Token",
     ),
 ) -> JSONResponse:
-    settings = get_settings()
+    config = telegram_webhook_config()
 
-    if not settings.telegram_enabled:
+    if not config.enabled:
         raise HTTPException(status_code=403, detail="Telegram disabled")
 
-    settings.validate_telegram()
-
-    expected = settings.telegram_webhook_secret_token.get_secret_value()
-    if secret_token != expected:
+    if not hmac.compare_digest((secret_token or "").encode(), config.secret):
         logger.warning("telegram_webhook.invalid_secret")
         raise HTTPException(status_code=401, detail="Invalid secret token")
 
     if not await rate_limiter.allow_global("telegram", limit=300, window_seconds=1):
         raise HTTPException(status_code=429, detail="Too many updates")
 
-    update = Update.model_validate(await request.json())
-
     try:
-        await dispatcher.feed_webhook_update(
-            bot=bot,
-            update=update,
-            data={
-                "session": session,
-                "rate_limiter": rate_limiter,
-            },
-        )
-    except Exception as exc:
-        logger.exception("telegram_webhook.error", error=str(exc))
-        raise HTTPException(status_code=500, detail="Failed to process update") from exc
-
-    return JSONResponse({"ok": True})
+        payload = _loads(await request.body())
+    except ValueError as exc:
+        # orjson.JSONDecodeError and json.JSONDecodeError both subclass ValueError.
+        raise HTTPException(status_code=400, detail="Invalid update") from exc
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid update")
+
+    # Nothing listens to this update type: ack without building the model.
+    if is_unhandled(payload, config.update_types):
+        return FastJSONResponse({"ok": True})
+
+    deduplicator = get_update_deduplicator()
+    update_id = payload.get("update_id")
+    # Every failure below releases the mark, so Telegram's retry is not taken for a duplicate.
+    async with deduplicator.claim(update_id if isinstance(update_id, int) else None) as fresh:
+        if not fresh:
+            logger.info("telegram_webhook.duplicate update_id=%s", update_id)
+            return FastJSONResponse({"ok": True})
+
+        try:
+            update = Update.model_validate(payload)
+        except ValidationError as exc:
+            raise HTTPException(status_code=400, detail="Invalid update") from exc
+
+        if config.async_ingest:
+            # Ack now; handlers run on the update queue with their own session.
+            if not get_update_queue().submit(update):
+                raise HTTPException(status_code=503, detail="Update queue full")
+            return FastJSONResponse({"ok": True})
+
+        try:
+            await dispatcher.feed_webhook_update(
+                bot=bot,
+                update=update,
+                session=session,
+                rate_limiter=rate_limiter,
+                broadcast_worker=get_broadcast_worker(),
+                referral_codes=get_referral_code_cache(),
+            )
+        except Exception as exc:
+            logger.exception("telegram_webhook.error", error=str(exc))
+            raise HTTPException(status_code=500, detail="Failed to process update") from exc
+
+    return FastJSONResponse({"ok": True})
 
 
 # ─────────────────────────────────────────────────────────────
@@ -134,8 +284,8 @@ async def telegram_webhook(
 @app.post("/webhook/stripe")
 async def stripe_webhook(
     request: Request,
-    bot: Bot = Depends(get_bot),
     session: AsyncSession = Depends(get_db_session),
+    worker: StripeEventWorker = Depends(get_stripe_event_worker),
 ) -> JSONResponse:
     settings = get_settings()
 
@@ -157,10 +307,16 @@ async def stripe_webhook(
         logger.warning("stripe_webhook.invalid_signature", error=str(exc))
         raise HTTPException(status_code=400, detail="Invalid signature") from exc
 
-    service = PaymentsService(session=session, bot=bot)
-    await service.handle_checkout_event(event.to_dict())
+    # The event id is the idempotency key: redeliveries are acked without requeueing.
+    if not await StripeEventRepository(session).record(event.id, event.type, event.to_dict()):
+        logger.info("stripe_webhook.duplicate event_id=%s", event.id)
+        return FastJSONResponse({"received": True})
+    await session.commit()
 
-    return JSONResponse({"received": True})
+    if not worker.submit(event.id):
+        logger.warning("stripe_webhook.queue_full event_id=%s", event.id)
+
+    return FastJSONResponse({"received": True})
 
 
 # ─────────────────────────────────────────────────────────────
@@ -192,8 +348,124 @@ async def create_checkout_session(
         success_url=payload.success_url,
         cancel_url=payload.cancel_url,
     )
+    await session.commit()
 
     return CheckoutSessionResponse(
         url=checkout["url"],
         session_id=checkout["session_id"],
     )
+
+
+# ─────────────────────────────────────────────────────────────
+# ADMIN
+# ─────────────────────────────────────────────────────────────
+def require_admin_token(
+    admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
+) -> None:
+    expected = get_settings().admin_api_token
+    if expected is None:
+        raise HTTPException(status_code=403, detail="Admin API disabled")
+    if not hmac.compare_digest((admin_token or "").encode(), expected.get_secret_value().encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+@app.get(
+    "/admin/rollups/{metric}",
+    response_model=RollupSeries,
+    dependencies=[Depends(require_admin_token)],
+)
+async def read_rollups(
+    metric: str,
+    granularity: Literal["hour", "day"] = "day",
+    since: Optional[datetime] = Query(default=None, description="Defaults to 48 hours or 30 days back"),
+    until: Optional[datetime] = None,
+    session: AsyncSession = Depends(get_db_session),
+) -> RollupSeries:
+    if metric not in METRICS:
+        raise HTTPException(status_code=404, detail="Unknown metric")
+
+    if since is None:
+        window = timedelta(hours=48) if granularity == "hour" else timedelta(days=30)
+        since = bucket_start(datetime.now(timezone.utc) - window, granularity)
+
+    rows = await RollupRepository(session).series(metric, granularity, since, until)
+    return RollupSeries(
+        metric=metric,
+        granularity=granularity,
+        points=[RollupPoint(bucket=row.bucket, dimension=row.dimension, value=row.value) for row in rows],
+    )
+
+
+@app.get(
+    "/admin/referrals/leaderboard",
+    response_model=List[ReferrerRead],
+    dependencies=[Depends(require_admin_token)],
+)
+async def referral_leaderboard(
+    limit: int = Query(default=20, ge=1, le=100),
+    session: AsyncSession = Depends(get_db_session),
+) -> List[ReferrerRead]:
+    users = await UserRepository(session).top_by_downline(limit)
+    return [ReferrerRead.model_validate(user) for user in users]
+
+
+@app.get(
+    "/admin/referrals/{telegram_id}/downline",
+    response_model=ReferrerRead,
+    dependencies=[Depends(require_admin_token)],
+)
+async def referral_downline(
+    telegram_id: int,
+    session: AsyncSession = Depends(get_db_session),
+) -> ReferrerRead:
+    # Cached sizes only: direct referrals and the whole downline, no tree walk.
+    user = await UserRepository(session).get_by_telegram_id(telegram_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return ReferrerRead.model_validate(user)
+
+
+@app.get(
+    "/admin/users/{telegram_id}/orders",
+    response_model=OrderPageRead,
+    dependencies=[Depends(require_admin_token)],
+)
+async def user_orders(
+    telegram_id: int,
+    limit: int = Query(default=20, ge=1, le=100),
+    before: Optional[int] = Query(default=None, description="Cursor: orders older than this order id"),
+    after: Optional[int] = Query(default=None, description="Cursor: orders newer than this order id"),
+    session: AsyncSession = Depends(get_db_session),
+) -> OrderPageRead:
+    if before is not None and after is not None:
+        raise HTTPException(status_code=422, detail="Pass either before or after, not both")
+    user = await UserRepository(session).get_by_telegram_id(telegram_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    page = await OrderRepository(session).page_for_user(user.id, limit, before=before, after=after)
+    return OrderPageRead(
+        items=[OrderRead.model_validate(order) for order in page.orders],
+        next_cursor=page.older,
+        prev_cursor=page.newer,
+    )
+
+
+@app.get(
+    "/admin/messages/archive",
+    response_model=List[MessageRead],
+    dependencies=[Depends(require_admin_token)],
+)
+async def archived_messages(
+    since: datetime,
+    until: datetime,
+    user_id: Optional[int] = None,
+    limit: int = Query(default=1000, ge=1, le=10_000),
+    archiver: MessageArchiver = Depends(get_message_archiver),
+) -> List[MessageRead]:
+    since, until = (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc) for moment in (since, until))
+    if until <= since:
+        raise HTTPException(status_code=422, detail="until must be after since")
+    if until - since > timedelta(days=31):
+        raise HTTPException(status_code=422, detail="Range is limited to 31 days")
+    rows = await archiver.read(since, until, user_id=user_id, limit=limit)
+    return [MessageRead(**row) for row in rows]
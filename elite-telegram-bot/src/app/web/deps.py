@@ -4,9 +4,37 @@ from typing import AsyncGenerator
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..bot.main import bot, dispatcher, rate_limiter
+from ..bot.main import (
+    ban_index,
+    bot,
+    broadcast_worker,
+    counter_worker,
+    delivery_archiver,
+    delivery_log_writer,
+    dispatcher,
+    message_archiver,
+    rate_limiter,
+    referral_code_cache,
+    referral_count_worker,
+    rollup_worker,
+    send_scheduler,
+    stripe_event_worker,
+    update_deduplicator,
+    update_queue,
+    user_cache,
+)
 from ..db import get_session
+from ..services.bans import BanIndex
+from ..services.broadcast import BroadcastWorker, DeliveryLogWriter
+from ..services.counters import CounterWorker
+from ..services.ingest import UpdateDeduplicator, UpdateQueue
+from ..services.outbound import SendScheduler
+from ..services.payments import StripeEventWorker
 from ..services.rate_limit import RateLimiter
+from ..services.referrals import ReferralCodeCache, ReferralCountWorker
+from ..services.retention import DeliveryArchiver, MessageArchiver
+from ..services.rollups import RollupWorker
+from ..services.user_cache import UserCache
 
 
 async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
@@ -24,3 +52,59 @@ def get_dispatcher():
 
 def get_rate_limiter() -> RateLimiter:
     return rate_limiter
+
+
+def get_user_cache() -> UserCache:
+    return user_cache
+
+
+def get_ban_index() -> BanIndex:
+    return ban_index
+
+
+def get_broadcast_worker() -> BroadcastWorker:
+    return broadcast_worker
+
+
+def get_delivery_log_writer() -> DeliveryLogWriter:
+    return delivery_log_writer
+
+
+def get_counter_worker() -> CounterWorker:
+    return counter_worker
+
+
+def get_referral_code_cache() -> ReferralCodeCache:
+    return referral_code_cache
+
+
+def get_referral_count_worker() -> ReferralCountWorker:
+    return referral_count_worker
+
+
+def get_rollup_worker() -> RollupWorker:
+    return rollup_worker
+
+
+def get_message_archiver() -> MessageArchiver:
+    return message_archiver
+
+
+def get_delivery_archiver() -> DeliveryArchiver:
+    return delivery_archiver
+
+
+def get_send_scheduler() -> SendScheduler:
+    return send_scheduler
+
+
+def get_update_queue() -> UpdateQueue:
+    return update_queue
+
+
+def get_update_deduplicator() -> UpdateDeduplicator:
+    return update_deduplicator
+
+
+def get_stripe_event_worker() -> StripeEventWorker:
+    return stripe_event_worker
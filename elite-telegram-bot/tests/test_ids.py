@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import pytest
+from pydantic import SecretStr
+
+from app.config import Settings
+from app.utils.ids import (
+    decode_referral_code,
+    encode_referral_code,
+    generate_referral_code,
+    is_plausible_referral_code,
+)
+
+
+def test_referral_code_round_trip() -> None:
+    codes = {encode_referral_code(number, b"key") for number in range(1000)}
+    assert len(codes) == 1000
+    for number in (0, 7_123_456_789, 2**52):
+        code = encode_referral_code(number, b"key")
+        assert len(code) == 13
+        assert decode_referral_code(code, b"key") == number
+        assert decode_referral_code(code.lower(), b"key") == number
+
+    code = encode_referral_code(42, b"key")
+    assert decode_referral_code(code[1] + code[0] + code[2:], b"key") is None
+    assert decode_referral_code("ABC123", b"key") is None
+
+
+def test_plausible_referral_codes() -> None:
+    code = encode_referral_code(42, b"key")
+    assert is_plausible_referral_code(code)
+    assert is_plausible_referral_code(f"{code[:4].lower()}-{code[4:]}")
+    assert not is_plausible_referral_code(code[:-1] + ("0" if code[-1] != "0" else "1"))
+    # Legacy codes: exactly eight upper-case letters or digits.
+    assert is_plausible_referral_code(generate_referral_code())
+    assert is_plausible_referral_code("legacy01")
+    for junk in ("LEGACY1", "LEGACY012", "LEGACY0_", "ÄBCDEFGH", ""):
+        assert not is_plausible_referral_code(junk)
+
+
+def test_referral_key_required_in_prod_and_with_telegram() -> None:
+    with pytest.raises(RuntimeError):
+        Settings(env="prod", referral_code_secret=None).referral_key()
+    with pytest.raises(RuntimeError):
+        Settings(env="dev", telegram_enabled=True, referral_code_secret=None).referral_key()
+    assert Settings(env="prod", referral_code_secret=SecretStr("k")).referral_key() == b"k"
+    dev = Settings(env="dev", telegram_enabled=False, referral_code_secret=None)
+    assert dev.referral_key() == b""
+    assert Settings(env="test", referral_code_secret=None).referral_key() == b""
+
+
+def test_archive_dirs_must_be_absolute_in_prod() -> None:
+    with pytest.raises(RuntimeError, match="MESSAGES_ARCHIVE_DIR"):
+        Settings(env="prod", deliveries_archive_dir="/data/archive/deliveries").validate_archives()
+    Settings(env="dev").validate_archives()
+    Settings(
+        env="prod",
+        messages_archive_dir="/data/archive/messages",
+        deliveries_archive_dir="/data/archive/deliveries",
+    ).validate_archives()
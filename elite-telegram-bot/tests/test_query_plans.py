@@ -0,0 +1,413 @@
+"""
+EXPLAIN QUERY PLAN for every repository query against a seeded database.
+
+Each public repository method is called once with the statements it issues
+captured, then every captured statement is explained with its own parameters.
+A plan step that scans a whole table fails the suite unless the method is in
+``FULL_SCAN_ALLOWED``. A repository method missing from ``CALLS`` fails too, so
+new queries are covered by default.
+"""
+
+from __future__ import annotations
+
+import importlib
+import inspect
+import pkgutil
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import pytest
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+import app.repos
+from app.db import Base
+from app.models import (
+    Ban,
+    Broadcast,
+    Counter,
+    MessageRecord,
+    Order,
+    Referral,
+    Rollup,
+    StripeEvent,
+    User,
+)
+from app.repos.bans import BanRepository
+from app.repos.broadcasts import BroadcastRepository
+from app.repos.counters import CounterRepository
+from app.repos.leases import LeaseRepository
+from app.repos.messages import MessageRepository
+from app.repos.orders import OrderRepository
+from app.repos.referrals import ReferralRepository
+from app.repos.rollups import RollupRepository
+from app.repos.stripe_events import StripeEventRepository
+from app.repos.users import UserRepository
+
+DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+USERS = 5_000
+ORDERS_PER_USER = 4
+MESSAGES_PER_USER = 4
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+# Whole-table reads by design; keep each entry justified.
+FULL_SCAN_ALLOWED = {
+    "BanRepository.list_active": "startup snapshot for BanIndex",
+    "BroadcastRepository.delivery_totals": "one row per broadcast job, read by /stats",
+    "CounterRepository.get_all": "one row per tracked counter",
+}
+
+Call = Callable[[AsyncSession], Awaitable[Any]]
+
+
+async def _first_batch(session: AsyncSession) -> Any:
+    async for batch in UserRepository(session).iter_recipient_batches(after_id=100, batch_size=50):
+        return batch
+
+
+async def _user(session: AsyncSession, user_id: int = 10) -> User:
+    user = await session.get(User, user_id)
+    assert user is not None
+    return user
+
+
+async def _order(session: AsyncSession) -> Order:
+    order = await session.get(Order, 1)
+    assert order is not None
+    return order
+
+
+async def _broadcast(session: AsyncSession) -> Broadcast:
+    broadcast = await session.get(Broadcast, 1)
+    assert broadcast is not None
+    return broadcast
+
+
+CALLS: Dict[str, Call] = {
+    # Users
+    "UserRepository.get_by_telegram_id": lambda s: UserRepository(s).get_by_telegram_id(1_000_010),
+    "UserRepository.matches": lambda s: UserRepository(s).matches(10, 1_000_010),
+    "UserRepository.get_by_referral_code": lambda s: (
+        UserRepository(s).get_by_referral_code("LEGACY10")
+    ),
+    "UserRepository.create_or_update": lambda s: (
+        UserRepository(s).create_or_update(1_000_010, username="new")
+    ),
+    "UserRepository.iter_recipient_batches": _first_batch,
+    "UserRepository.set_referred_by": lambda s: _set_referred_by(s),
+    "UserRepository.set_referred_by_id": lambda s: (
+        UserRepository(s).set_referred_by_id(User(id=2), 1)
+    ),
+    "UserRepository.get_referral_count": lambda s: UserRepository(s).get_referral_count(10),
+    "UserRepository.increment_referral_count": lambda s: _increment_referral_count(s),
+    "UserRepository.increment_referral_counts": lambda s: (
+        UserRepository(s).increment_referral_counts({1: 1, 2: 2})
+    ),
+    "UserRepository.increment_downline_counts": lambda s: (
+        UserRepository(s).increment_downline_counts({1: 1})
+    ),
+    "UserRepository.set_referral_counts": lambda s: (
+        UserRepository(s).set_referral_counts({1: 3, 2: 0})
+    ),
+    "UserRepository.set_downline_counts": lambda s: (
+        UserRepository(s).set_downline_counts({1: 5, 2: 0})
+    ),
+    "UserRepository.get_downline_counts": lambda s: (
+        UserRepository(s).get_downline_counts([1, 2, 3])
+    ),
+    "UserRepository.list_counts": lambda s: UserRepository(s).list_counts(100, 50),
+    "UserRepository.list_ancestor_ids": lambda s: UserRepository(s).list_ancestor_ids(4_000),
+    "UserRepository.top_by_downline": lambda s: UserRepository(s).top_by_downline(20),
+    # Referrals
+    "ReferralRepository.create": lambda s: (
+        ReferralRepository(s).create(referrer_id=1, referred_id=USERS)
+    ),
+    "ReferralRepository.parent_map": lambda s: (
+        ReferralRepository(s).parent_map([4_000, 4_001], USERS)
+    ),
+    "ReferralRepository.referral_counts": lambda s: (
+        ReferralRepository(s).referral_counts(USERS, 1, 100)
+    ),
+    "ReferralRepository.subtree_sizes": lambda s: (
+        ReferralRepository(s).subtree_sizes(USERS, 1, 100)
+    ),
+    # Orders
+    "OrderRepository.create": lambda s: OrderRepository(s).create(
+        user_id=1, sku="vip_month", price_id="price", stripe_checkout_id="cs_new"
+    ),
+    "OrderRepository.get_by_checkout_id": lambda s: (
+        OrderRepository(s).get_by_checkout_id("cs_10_1")
+    ),
+    "OrderRepository.get_open_checkout": lambda s: (
+        OrderRepository(s).get_open_checkout(10, "vip_month", NOW)
+    ),
+    "OrderRepository.page_for_user": lambda s: OrderRepository(s).page_for_user(10, 2, before=40),
+    "OrderRepository.mark_paid": lambda s: _mark_order(s, paid=True),
+    "OrderRepository.mark_failed": lambda s: _mark_order(s, paid=False),
+    # Bans
+    "BanRepository.get_by_user_id": lambda s: BanRepository(s).get_by_user_id(10),
+    "BanRepository.get_active_by_user_id": lambda s: (
+        BanRepository(s).get_active_by_user_id(10, NOW)
+    ),
+    "BanRepository.list_active": lambda s: BanRepository(s).list_active(NOW),
+    "BanRepository.create_or_update": lambda s: (
+        BanRepository(s).create_or_update(11, reason="spam")
+    ),
+    "BanRepository.remove": lambda s: BanRepository(s).remove(20),
+    # Counters
+    "CounterRepository.get_all": lambda s: CounterRepository(s).get_all(),
+    "CounterRepository.ensure": lambda s: CounterRepository(s).ensure(["users", "orders"]),
+    "CounterRepository.remove": lambda s: CounterRepository(s).remove(["stale"]),
+    "CounterRepository.advance": lambda s: CounterRepository(s).advance("users", 0, 1, 1),
+    "CounterRepository.reset": lambda s: CounterRepository(s).reset("orders", 0, 0, 0),
+    # Leases
+    "LeaseRepository.acquire": lambda s: LeaseRepository(s).acquire("archive.messages", "a", NOW),
+    "LeaseRepository.release": lambda s: LeaseRepository(s).release("archive.messages", "a"),
+    # Messages
+    "MessageRepository.list_before": lambda s: MessageRepository(s).list_before(NOW, 100),
+    "MessageRepository.delete_ids": lambda s: MessageRepository(s).delete_ids([1, 2, 3]),
+    # Rollups
+    "RollupRepository.increment": lambda s: (
+        RollupRepository(s).increment({("day", "signups", NOW, ""): 1})
+    ),
+    "RollupRepository.series": lambda s: (
+        RollupRepository(s).series("signups", "day", NOW - timedelta(days=30))
+    ),
+    "RollupRepository.clear": lambda s: RollupRepository(s).clear(),
+    # Stripe events
+    "StripeEventRepository.record": lambda s: (
+        StripeEventRepository(s).record("evt_new", "checkout", {})
+    ),
+    "StripeEventRepository.list_pending": lambda s: StripeEventRepository(s).list_pending(NOW),
+    "StripeEventRepository.claim": lambda s: StripeEventRepository(s).claim("evt_1"),
+    "StripeEventRepository.record_failure": lambda s: (
+        StripeEventRepository(s).record_failure("evt_2", "boom", 1)
+    ),
+    # Broadcasts
+    "BroadcastRepository.create": lambda s: BroadcastRepository(s).create("hello"),
+    "BroadcastRepository.get": lambda s: BroadcastRepository(s).get(1),
+    "BroadcastRepository.list_active": lambda s: BroadcastRepository(s).list_active(),
+    "BroadcastRepository.claim_next": lambda s: (
+        BroadcastRepository(s).claim_next("worker", NOW + timedelta(minutes=1))
+    ),
+    "BroadcastRepository.checkpoint": lambda s: _checkpoint(s),
+    "BroadcastRepository.record_deliveries": lambda s: BroadcastRepository(s).record_deliveries(
+        [(1, 1, "sent", None), (1, 2, "failed", 403)]
+    ),
+    "BroadcastRepository.delivery_totals": lambda s: BroadcastRepository(s).delivery_totals(),
+    "BroadcastRepository.list_archivable": lambda s: BroadcastRepository(s).list_archivable(NOW),
+    "BroadcastRepository.list_deliveries": lambda s: BroadcastRepository(s).list_deliveries(1, 100),
+    "BroadcastRepository.delete_deliveries": lambda s: (
+        BroadcastRepository(s).delete_deliveries(1, 100)
+    ),
+    "BroadcastRepository.renew": lambda s: BroadcastRepository(s).renew(1, "worker", NOW),
+    "BroadcastRepository.finish": lambda s: BroadcastRepository(s).finish(1),
+    "BroadcastRepository.transition": lambda s: (
+        BroadcastRepository(s).transition(2, "paused", ["running"])
+    ),
+}
+
+
+async def _set_referred_by(session: AsyncSession) -> bool:
+    users = UserRepository(session)
+    return await users.set_referred_by(await _user(session, 3), await _user(session, 1))
+
+
+async def _increment_referral_count(session: AsyncSession) -> None:
+    await UserRepository(session).increment_referral_count(await _user(session))
+
+
+async def _mark_order(session: AsyncSession, paid: bool) -> None:
+    order = await _order(session)
+    if paid:
+        await OrderRepository(session).mark_paid(order, "pi_test")
+    else:
+        await OrderRepository(session).mark_failed(order)
+
+
+async def _checkpoint(session: AsyncSession) -> None:
+    await BroadcastRepository(session).checkpoint(await _broadcast(session), 100, 10, 1, 0)
+
+
+def _repository_methods() -> List[str]:
+    names = []
+    for module_info in pkgutil.iter_modules(app.repos.__path__):
+        module = importlib.import_module(f"app.repos.{module_info.name}")
+        for cls_name, cls in inspect.getmembers(module, inspect.isclass):
+            if not cls_name.endswith("Repository") or cls.__module__ != module.__name__:
+                continue
+            for name, member in inspect.getmembers(cls, inspect.isfunction):
+                if name.startswith("_"):
+                    continue
+                if inspect.iscoroutinefunction(member) or inspect.isasyncgenfunction(member):
+                    names.append(f"{cls_name}.{name}")
+    return sorted(names)
+
+
+async def _seed(session: AsyncSession) -> None:
+    users = []
+    referrals = []
+    for user_id in range(1, USERS + 1):
+        # A ternary referral tree: user n was referred by user (n + 1) // 3.
+        parent = (user_id + 1) // 3 if user_id > 1 else None
+        users.append(
+            {
+                "id": user_id,
+                "telegram_id": 1_000_000 + user_id,
+                "referral_code": f"LEGACY{user_id}",
+                "referred_by_id": parent,
+                "referral_count": 0,
+                "downline_count": user_id % 7,
+            }
+        )
+        if parent is not None:
+            referrals.append({"id": user_id - 1, "referrer_id": parent, "referred_id": user_id})
+    await session.execute(insert(User), users)
+    await session.execute(insert(Referral), referrals)
+
+    await session.execute(
+        insert(Order),
+        [
+            {
+                "user_id": user_id,
+                "sku": "vip_month",
+                "price_id": "price",
+                "stripe_checkout_id": f"cs_{user_id}_{n}",
+                "status": "paid" if n else "pending",
+                "expires_at": NOW + timedelta(hours=n),
+            }
+            for user_id in range(1, USERS + 1)
+            for n in range(ORDERS_PER_USER)
+        ],
+    )
+    await session.execute(
+        insert(MessageRecord),
+        [
+            {"user_id": user_id, "command": "broadcast", "status": "sent"}
+            for user_id in range(1, USERS + 1)
+            for _ in range(MESSAGES_PER_USER)
+        ],
+    )
+    await session.execute(insert(Ban), [{"user_id": user_id} for user_id in range(1, USERS, 100)])
+    await session.execute(
+        insert(StripeEvent),
+        [
+            {
+                "id": f"evt_{n}",
+                "type": "checkout",
+                "payload": {},
+                "status": "pending" if n % 10 else "processed",
+            }
+            for n in range(1, 2_001)
+        ],
+    )
+    await session.execute(
+        insert(Rollup),
+        [
+            {
+                "granularity": "day",
+                "metric": metric,
+                "bucket": NOW - timedelta(days=day),
+                "dimension": "",
+                "value": day,
+            }
+            for metric in ("signups", "orders", "referrals")
+            for day in range(365)
+        ],
+    )
+    await session.execute(
+        insert(Broadcast),
+        [
+            {"text": "hi", "status": "completed" if n > 2 else "running", "lease_owner": "worker"}
+            for n in range(1, 501)
+        ],
+    )
+    await session.execute(
+        insert(Counter),
+        [{"name": name} for name in ("users", "orders", "referrals", "messages")],
+    )
+    # No ANALYZE: sqlite_stat1 keeps only average rows per key, so a status column that
+    # is 99% "completed" looks unselective and the planner would scan instead. Postgres
+    # tracks the skew; the default heuristics are the closer stand-in.
+    await session.commit()
+
+
+@pytest.fixture()
+async def seeded() -> AsyncSession:
+    engine = create_async_engine(DATABASE_URL, echo=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    TestSession = async_sessionmaker(engine, expire_on_commit=False)
+    async with TestSession() as session:
+        await _seed(session)
+        yield session
+    await engine.dispose()
+
+
+def test_every_repository_method_is_explained() -> None:
+    assert sorted(CALLS) == _repository_methods()
+
+
+# "SCAN orders", "SCAN TABLE orders" (older SQLite) or "SCAN referrals_1" for an alias.
+# An AUTOMATIC index is built by scanning the table on every execution, so it counts too.
+STEP_RE = re.compile(r"^(SCAN|SEARCH) (?:TABLE )?(\w+?)(?:_\d+)?\b(.*)")
+
+
+async def _explain(session: AsyncSession, name: str, call: Call) -> List[Tuple[str, str]]:
+    """(statement, plan step) for each full-table scan the call's statements plan."""
+    captured: List[Tuple[str, Any]] = []
+
+    def capture(
+        conn: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        if not statement.startswith("EXPLAIN"):
+            captured.append((statement, parameters[0] if executemany else parameters))
+
+    sync_engine = session.get_bind()
+    event.listen(sync_engine, "before_cursor_execute", capture)
+    try:
+        await call(session)
+        await session.flush()
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", capture)
+
+    assert captured, f"{name} issued no SQL"
+    tables = set(Base.metadata.tables)
+    scans = []
+    conn = await session.connection()
+    for statement, parameters in captured:
+        plan = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)).all()
+        for row in plan:
+            match = STEP_RE.match(row[-1])
+            if match is None or match.group(2) not in tables:
+                continue
+            if match.group(1) == "SCAN" or "AUTOMATIC" in match.group(3):
+                scans.append((statement, row[-1]))
+    await session.rollback()
+    return scans
+
+
+async def test_repository_queries_use_indexes(seeded: AsyncSession) -> None:
+    failures = []
+    for name, call in CALLS.items():
+        scans = await _explain(seeded, name, call)
+        if scans and name not in FULL_SCAN_ALLOWED:
+            failures.extend(
+                f"{name}: {step}\n    {' '.join(statement.split())}" for statement, step in scans
+            )
+    assert not failures, "full table scans:\n" + "\n".join(failures)
+
+
+async def test_allowlist_is_not_stale(seeded: AsyncSession) -> None:
+    for name in FULL_SCAN_ALLOWED:
+        assert name in CALLS, f"{name} is allowlisted but no longer exists"
+        assert await _explain(
+            seeded, name, CALLS[name]
+        ), f"{name} no longer scans; drop it from the allowlist"
@@ -4,6 +4,7 @@ import pytest
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from app.db import Base
+from app.models import User
 from app.repos.orders import OrderRepository
 from app.repos.referrals import ReferralRepository
 from app.repos.users import UserRepository
@@ -55,3 +56,55 @@ async def test_order_repository(session: AsyncSession) -> None:
     assert fetched is not None
     await orders_repo.mark_paid(fetched, payment_intent="pi_test")
     assert fetched.status == "paid"
+
+
+@pytest.mark.asyncio()
+async def test_user_upsert_keeps_existing_values(session: AsyncSession) -> None:
+    users = UserRepository(session)
+    created = await users.create_or_update(telegram_id=7, username="neo", first_name="Thomas")
+    renamed = await users.create_or_update(telegram_id=7, username="the_one", first_name=None)
+    unchanged = await users.create_or_update(telegram_id=7, username="the_one")
+
+    assert renamed.id == created.id == unchanged.id
+    assert unchanged.username == "the_one"
+    assert unchanged.first_name == "Thomas"
+    assert unchanged.referral_code == created.referral_code
+
+
+@pytest.mark.asyncio()
+async def test_referral_code_lookup(session: AsyncSession) -> None:
+    users = UserRepository(session)
+    alice = await users.create_or_update(telegram_id=7_000_000_001, username="alice")
+    legacy = User(telegram_id=5, referral_code="LEGACY01")
+    session.add(legacy)
+    await session.flush()
+
+    assert len(alice.referral_code) == 13
+    assert await users.get_by_referral_code(alice.referral_code) is alice
+    assert await users.get_by_referral_code(alice.referral_code.lower()) is alice
+    assert await users.get_by_referral_code("LEGACY01") is legacy
+    assert await users.get_by_referral_code("NOPE") is None
+
+
+@pytest.mark.asyncio()
+async def test_order_history_keyset_pages(session: AsyncSession) -> None:
+    users = UserRepository(session)
+    user = await users.create_or_update(telegram_id=42, username="vip")
+    other = await users.create_or_update(telegram_id=43, username="other")
+    orders_repo = OrderRepository(session)
+    for n in range(7):
+        await orders_repo.create(user_id=user.id, sku="vip_month", price_id="price", stripe_checkout_id=f"cs_{n}")
+    await orders_repo.create(user_id=other.id, sku="vip_month", price_id="price", stripe_checkout_id="cs_other")
+    await session.commit()
+
+    # Same-second created_at values: the id breaks ties.
+    first = await orders_repo.page_for_user(user.id, 3)
+    second = await orders_repo.page_for_user(user.id, 3, before=first.older)
+    last = await orders_repo.page_for_user(user.id, 3, before=second.older)
+    ids = [order.id for page in (first, second, last) for order in page.orders]
+
+    assert ids == sorted(ids, reverse=True) and len(ids) == 7
+    assert first.newer is None and last.older is None
+    back = await orders_repo.page_for_user(user.id, 3, after=last.newer)
+    assert [order.id for order in back.orders] == [order.id for order in second.orders]
+    assert back.newer == second.newer and back.older == second.older
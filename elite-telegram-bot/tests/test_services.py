@@ -0,0 +1,972 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Callable
+
+import pytest
+from aiogram import Dispatcher, Router
+from aiogram.types import Update
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.db import Base
+from app.models import (
+    Broadcast,
+    BroadcastDelivery,
+    Counter,
+    MessageRecord,
+    Order,
+    Referral,
+    StripeEvent,
+    User,
+)
+from app.repos.bans import BanRepository
+from app.repos.broadcasts import BroadcastRepository
+from app.repos.leases import LeaseRepository
+from app.repos.orders import OrderRepository
+from app.repos.rollups import RollupRepository
+from app.repos.stripe_events import StripeEventRepository
+from app.repos.users import UserRepository
+from app.services.bans import BanIndex
+from app.services.broadcast import BroadcastWorker, DeliveryLogWriter
+from app.services.counters import CounterWorker
+from app.services.ingest import UpdateDeduplicator, UpdateQueue, handled_update_types, is_unhandled
+from app.services.outbound import Priority, SendScheduler
+from app.services.payments import CheckoutSessionCache, PaymentsService, StripeEventWorker
+from app.services.rate_limit import RateLimiter
+from app.services.referrals import ReferralCodeCache, ReferralCountWorker, ReferralService
+from app.services.retention import DeliveryArchiver, MessageArchiver
+from app.services.rollups import RollupWorker
+from app.services.user_cache import UserCache
+
+DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+class FakeGateway:
+    def __init__(self) -> None:
+        self.calls: list[dict[str, object]] = []
+
+    async def create_checkout_session(self, params: dict[str, object]) -> dict[str, str]:
+        self.calls.append(params)
+        index = len(self.calls)
+        return {"id": f"cs_{index}", "url": f"https://checkout.test/{index}"}
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: object) -> None:
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture()
+async def session_factory() -> async_sessionmaker[AsyncSession]:
+    engine = create_async_engine(DATABASE_URL, echo=False, poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio()
+async def test_user_cache_write_behind(session_factory: async_sessionmaker[AsyncSession]) -> None:
+    cache = UserCache(maxsize=10, ttl_seconds=60, session_factory=session_factory)
+
+    async with session_factory() as session:
+        first = await cache.resolve(session, 7, username="neo", first_name="Thomas")
+        await session.commit()
+        again = await cache.resolve(session, 7, username="neo", first_name="Thomas")
+        assert again is first
+        assert cache.pending == 0
+
+        renamed = await cache.resolve(session, 7, username="the_one", first_name=None)
+        assert renamed.username == "the_one"
+        assert renamed.first_name == "Thomas"
+        assert cache.pending == 1
+
+    assert await cache.flush() == 1
+    assert cache.pending == 0
+
+    async with session_factory() as session:
+        stored = (await session.execute(select(User).where(User.telegram_id == 7))).scalar_one()
+        assert stored.username == "the_one"
+
+
+@pytest.mark.asyncio()
+async def test_user_cache_fills_only_after_commit(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    cache = UserCache(maxsize=10, ttl_seconds=60, session_factory=session_factory)
+
+    async with session_factory() as session:
+        lost = await cache.resolve(session, 111, username="a1")
+        await session.rollback()
+    async with session_factory() as session:
+        other = await cache.resolve(session, 222, username="a2")
+        await session.commit()
+    # The rolled-back insert freed its id and user 222 took it.
+    assert other.id == lost.id
+
+    async with session_factory() as session:
+        again = await cache.resolve(session, 111, username="b1")
+        await session.commit()
+    assert again.id != other.id
+    await cache.flush()
+    async with session_factory() as session:
+        query = select(User.telegram_id, User.username).order_by(User.id)
+        rows = (await session.execute(query)).all()
+    assert rows == [(222, "a2"), (111, "b1")]
+
+
+@pytest.mark.asyncio()
+async def test_user_cache_publishes_committed_changes(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeAsyncRedis()
+    cache = UserCache(
+        maxsize=10, ttl_seconds=60, redis_client=redis, session_factory=session_factory
+    )
+
+    async with session_factory() as session:
+        referrer = await cache.resolve(session, 1)
+        user = await cache.resolve(session, 2)
+        await session.commit()
+
+    async with session_factory() as session:
+        user = await cache.resolve(session, 2)
+        assert await UserRepository(session).set_referred_by_id(user, referrer.id)  # type: ignore[arg-type]
+        await session.rollback()
+    assert user.referred_by_id is None
+
+    async with session_factory() as session:
+        user = await cache.resolve(session, 2)
+        assert await UserRepository(session).set_referred_by_id(user, referrer.id)  # type: ignore[arg-type]
+        await session.commit()
+    await asyncio.sleep(0)
+
+    # A second worker starts from the Redis tier.
+    other = UserCache(
+        maxsize=10, ttl_seconds=60, redis_client=redis, session_factory=session_factory
+    )
+    async with session_factory() as session:
+        assert (await other.resolve(session, 2)).referred_by_id == referrer.id
+    await redis.aclose()
+
+
+@pytest.mark.asyncio()
+async def test_ban_index_honours_expiry(session_factory: async_sessionmaker[AsyncSession]) -> None:
+    now = datetime.now(timezone.utc)
+    async with session_factory() as session:
+        users = UserRepository(session)
+        bans = BanRepository(session)
+        forever = await users.create_or_update(telegram_id=1)
+        lapsed = await users.create_or_update(telegram_id=2)
+        await bans.create_or_update(forever.id, reason="spam")
+        await bans.create_or_update(lapsed.id, expires_at=now - timedelta(minutes=1))
+        await session.commit()
+
+        index = BanIndex()
+        await index.load(session)
+
+    assert index.is_banned(forever.id)
+    assert not index.is_banned(lapsed.id)
+
+    index.add(lapsed.id, now + timedelta(hours=1))
+    index.add(99, now - timedelta(seconds=1))
+    assert index.sweep() == 1
+    assert index.is_banned(lapsed.id)
+
+    index.remove(forever.id)
+    assert not index.is_banned(forever.id)
+
+
+async def _eventually(check: Callable[[], bool], timeout: float = 2.0) -> bool:
+    deadline = monotonic() + timeout
+    while not check():
+        if monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+@pytest.mark.asyncio()
+async def test_ban_index_syncs_across_workers(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    async with session_factory() as session:
+        target = await UserRepository(session).create_or_update(telegram_id=1)
+        await BanRepository(session).create_or_update(target.id)
+        await session.commit()
+
+    server = fakeredis.FakeServer()
+    here, there = (
+        BanIndex(
+            redis_client=fakeredis.FakeAsyncRedis(server=server), session_factory=session_factory
+        )
+        for _ in range(2)
+    )
+    here.start()
+    there.start()
+    try:
+        # Each subscribe starts from the database.
+        assert await _eventually(lambda: there.is_banned(target.id))
+        await here.unban(target.id)
+        assert await _eventually(lambda: not there.is_banned(target.id))
+        await here.ban(target.id, datetime.now(timezone.utc) + timedelta(hours=1))
+        assert await _eventually(lambda: there.is_banned(target.id))
+    finally:
+        await here.stop()
+        await there.stop()
+
+
+@pytest.mark.asyncio()
+async def test_ban_index_reloads_without_redis(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    index = BanIndex(reload_interval_seconds=0.01, session_factory=session_factory)
+    index.start()
+    try:
+        async with session_factory() as session:
+            target = await UserRepository(session).create_or_update(telegram_id=1)
+            # Banned by another worker: only the database knows.
+            await BanRepository(session).create_or_update(target.id)
+            await session.commit()
+        assert await _eventually(lambda: index.is_banned(target.id))
+    finally:
+        await index.stop()
+
+
+@pytest.mark.asyncio()
+async def test_broadcast_worker_resumes_from_checkpoint(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    async with session_factory() as session:
+        users = UserRepository(session)
+        created = [await users.create_or_update(telegram_id=tid) for tid in range(100, 105)]
+        jobs = BroadcastRepository(session)
+        job = await jobs.create("hello", requested_by=1)
+        # Simulate a crash after the first two recipients were checkpointed.
+        await jobs.checkpoint(job, last_user_id=created[1].id, sent=2, failed=0, skipped=0)
+        assert await jobs.transition(job.id, "paused", ("pending",))
+        await session.commit()
+
+    bot = FakeBot()
+    worker = BroadcastWorker(bot, RateLimiter(), session_factory=session_factory, chunk_size=2)  # type: ignore[arg-type]
+    assert not await worker.run_once()
+
+    async with session_factory() as session:
+        assert await BroadcastRepository(session).transition(job.id, "pending", ("paused",))
+        await session.commit()
+    assert await worker.run_once()
+    assert not await worker.run_once()
+
+    async with session_factory() as session:
+        stored = await session.get(Broadcast, job.id)
+        assert stored is not None
+        assert stored.status == "completed"
+        assert stored.sent == 5
+        assert stored.last_user_id == created[-1].id
+        deliveries = (await session.execute(select(BroadcastDelivery))).scalars().all()
+        assert {(d.broadcast_id, d.user_id, d.status) for d in deliveries} == {
+            (job.id, user.id, "sent") for user in created[2:]
+        }
+        assert (await session.execute(select(MessageRecord))).first() is None
+    assert [chat_id for chat_id, _ in bot.sent] == [102, 103, 104, 1]
+
+
+@pytest.mark.asyncio()
+async def test_delivery_log_writer_batches_and_drains(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    async with session_factory() as session:
+        users = UserRepository(session)
+        created = [await users.create_or_update(telegram_id=tid) for tid in range(200, 205)]
+        job = await BroadcastRepository(session).create("hello")
+        await session.commit()
+
+    log = DeliveryLogWriter(
+        session_factory=session_factory, batch_size=2, flush_interval_seconds=60
+    )
+    worker = BroadcastWorker(
+        FakeBot(), RateLimiter(), session_factory=session_factory, delivery_log=log, chunk_size=2  # type: ignore[arg-type]
+    )
+    assert await worker.run_once()
+
+    async def stored() -> set[tuple[int, str]]:
+        async with session_factory() as session:
+            rows = (await session.execute(select(BroadcastDelivery))).scalars().all()
+        return {(row.user_id, row.status) for row in rows}
+
+    # Buffered, not written in the send transaction.
+    assert log.pending == 5
+    assert await stored() == set()
+
+    log.start()
+    log.record([(job.id, created[0].id, "failed", 403)])
+    await log.stop()
+    assert log.pending == 0
+    assert await stored() == (
+        {(user.id, "sent") for user in created[1:]} | {(created[0].id, "failed")}
+    )
+
+
+@pytest.mark.asyncio()
+async def test_delivery_log_writer_drops_batch_after_max_attempts() -> None:
+    def unavailable() -> AsyncSession:
+        raise ConnectionError("database down")
+
+    log = DeliveryLogWriter(session_factory=unavailable, max_attempts=2)  # type: ignore[arg-type]
+    log.record([(1, 1, "sent", None), (1, 2, "failed", 403)])
+
+    with pytest.raises(ConnectionError):
+        await log.flush()
+    # Re-queued for the next flush.
+    assert log.pending == 2
+    assert await log.flush() == 0
+    assert log.pending == 0
+
+
+@pytest.mark.asyncio()
+async def test_delivery_log_writer_counts_attempts_per_batch(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    async with session_factory() as session:
+        users = UserRepository(session)
+        created = [await users.create_or_update(telegram_id=tid) for tid in range(210, 213)]
+        job = await BroadcastRepository(session).create("hello")
+        await session.commit()
+
+    database_up = False
+
+    def factory() -> AsyncSession:
+        if not database_up:
+            raise ConnectionError("database down")
+        return session_factory()
+
+    log = DeliveryLogWriter(session_factory=factory, max_attempts=2)
+    log.record([(job.id, created[0].id, "sent", None)])
+    with pytest.raises(ConnectionError):
+        await log.flush()
+
+    # The older batch runs out of attempts; rows recorded since keep their own count.
+    log.record([(job.id, user.id, "sent", None) for user in created[1:]])
+    with pytest.raises(ConnectionError):
+        await log.flush()
+    assert log.pending == 2
+
+    database_up = True
+    assert await log.flush() == 2
+    async with session_factory() as session:
+        rows = (await session.execute(select(BroadcastDelivery))).scalars().all()
+    assert {row.user_id for row in rows} == {user.id for user in created[1:]}
+
+
+@pytest.mark.asyncio()
+async def test_delivery_log_writer_drops_rows_beyond_max_pending() -> None:
+    log = DeliveryLogWriter(max_pending=3)
+    log.record([(1, user_id, "sent", None) for user_id in range(2)])
+    log.record([(1, user_id, "sent", None) for user_id in range(2, 5)])
+    assert log.pending == 3
+
+
+@pytest.mark.asyncio()
+async def test_send_scheduler_priority_and_chat_pacing() -> None:
+    scheduler = SendScheduler(global_per_second=1000, private_interval_seconds=0.05)
+    order: list[tuple[str, int, float]] = []
+
+    async def send(label: str, chat_id: int, priority: Priority) -> None:
+        async def call() -> None:
+            order.append((label, chat_id, monotonic()))
+
+        await scheduler.submit(chat_id, call, priority=priority)
+
+    await asyncio.gather(
+        send("bulk", 1, Priority.BULK),
+        send("bulk", 1, Priority.BULK),
+        send("bulk", 2, Priority.BULK),
+        send("receipt", 3, Priority.TRANSACTIONAL),
+    )
+    await scheduler.stop()
+
+    assert [(label, chat_id) for label, chat_id, _ in order] == [
+        ("receipt", 3),
+        ("bulk", 1),
+        ("bulk", 2),
+        ("bulk", 1),
+    ]
+    first, second = [at for _, chat_id, at in order if chat_id == 1]
+    assert second - first >= 0.05
+
+
+@pytest.mark.asyncio()
+async def test_memory_rate_limiter_is_bounded() -> None:
+    limiter = RateLimiter(max_memory_keys=3)
+
+    assert [await limiter.allow("burst", limit=3, window_seconds=60) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    for user_id in range(10):
+        assert await limiter.allow_user(user_id, "messages", limit=1, window_seconds=60)
+    assert len(limiter._memory_tats) == 3
+
+
+@pytest.mark.asyncio()
+async def test_redis_rate_limiter_gcra() -> None:
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    redis = fakeredis.FakeAsyncRedis()
+    limiter = RateLimiter(redis)
+
+    # Ten per second: a burst of ten, then one more every 100 ms.
+    allowed = [await limiter.allow("burst", limit=10, window_seconds=1) for _ in range(11)]
+    assert allowed == [True] * 10 + [False]
+    assert await limiter.allow("other", limit=10, window_seconds=1)
+    await asyncio.sleep(0.15)
+    assert await limiter.allow("burst", limit=10, window_seconds=1)
+    assert not await limiter.allow("burst", limit=10, window_seconds=1)
+
+    # A flushed script cache (failover, SCRIPT FLUSH) is reloaded on NOSCRIPT.
+    await redis.script_flush()
+    assert await limiter.allow("fresh", limit=1, window_seconds=60)
+    assert not await limiter.allow("fresh", limit=1, window_seconds=60)
+    assert 0 < await redis.pttl("fresh") <= 60_000
+    await redis.aclose()
+
+
+@pytest.mark.asyncio()
+async def test_update_queue_orders_per_chat(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    handled: list[tuple[int, int]] = []
+
+    class FakeDispatcher:
+        async def feed_update(self, bot: object, update: Update, **kwargs: object) -> None:
+            assert "session" in kwargs
+            await asyncio.sleep(random.random() / 100)
+            handled.append((update.message.chat.id, update.update_id))  # type: ignore[union-attr]
+
+    queue = UpdateQueue(FakeDispatcher(), FakeBot(), workers=3, session_factory=session_factory)  # type: ignore[arg-type]
+    queue.start()
+    for update_id in range(30):
+        chat_id = update_id % 4 + 1
+        update = Update.model_validate(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": "hi",
+                },
+            }
+        )
+        assert queue.submit(update)
+    await queue.stop()
+
+    assert len(handled) == 30
+    for chat_id in range(1, 5):
+        per_chat = [update_id for chat, update_id in handled if chat == chat_id]
+        assert per_chat == sorted(per_chat)
+
+
+@pytest.mark.asyncio()
+async def test_update_deduplicator_window() -> None:
+    dedupe = UpdateDeduplicator(window=8)
+
+    assert not await dedupe.seen(100)
+    assert not await dedupe.seen(102)
+    assert await dedupe.seen(100)
+    assert not await dedupe.seen(101)
+
+    # Slots are recycled as the window slides forward.
+    assert not await dedupe.seen(108)
+    assert not await dedupe.seen(109)
+    assert await dedupe.seen(102)
+
+    await dedupe.release(109)
+    assert not await dedupe.seen(109)
+
+    # A late retry below the window counts as seen and keeps the ring intact.
+    assert await dedupe.seen(5)
+    assert await dedupe.seen(108)
+    assert not await dedupe.seen(110)
+
+    # Only after a quiet period does a low id (a re-seeded counter) start over.
+    reseeded = UpdateDeduplicator(window=8, idle_reset_seconds=0)
+    assert not await reseeded.seen(100)
+    assert not await reseeded.seen(5)
+    assert await reseeded.seen(5)
+
+
+def test_unhandled_update_types_are_dropped() -> None:
+    dispatcher = Dispatcher()
+    # No router included yet: nothing is known, so everything is accepted.
+    handled = handled_update_types(dispatcher)
+    assert not is_unhandled({"update_id": 1, "edited_message": {}}, handled)
+
+    router = Router()
+
+    @router.message()
+    async def on_message(message: object) -> None:
+        pass
+
+    dispatcher.include_router(router)
+    types = handled_update_types(dispatcher)
+    assert "message" in types
+    assert is_unhandled({"update_id": 1, "edited_message": {}}, types)
+    assert not is_unhandled({"update_id": 2, "message": {}}, types)
+
+
+@pytest.mark.asyncio()
+async def test_update_claim_released_when_queue_full() -> None:
+    def update(update_id: int) -> Update:
+        return Update.model_validate(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": 1, "type": "private"},
+                    "text": "hi",
+                },
+            }
+        )
+
+    dedupe = UpdateDeduplicator(window=64)
+    queue = UpdateQueue(object(), FakeBot(), workers=1, maxsize=1)  # type: ignore[arg-type]
+    assert queue.submit(update(1))
+
+    async def webhook(update_id: int) -> int:
+        # The webhook handler's shape: any exception inside the claim becomes an error response.
+        try:
+            async with dedupe.claim(update_id) as fresh:
+                if not fresh:
+                    return 200
+                if not queue.submit(update(update_id)):
+                    raise RuntimeError("queue full")
+                return 200
+        except RuntimeError:
+            return 503
+
+    assert await webhook(2) == 503
+    # Telegram retries once the queue has room: the update is accepted, not dropped.
+    queue._lanes[0].get_nowait()
+    assert await webhook(2) == 200
+    assert queue.pending == 1
+    assert await webhook(2) == 200
+    assert queue.pending == 1
+
+
+@pytest.mark.asyncio()
+async def test_stripe_events_apply_once(session_factory: async_sessionmaker[AsyncSession]) -> None:
+    event = {
+        "id": "evt_1",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": "cs_1", "payment_intent": "pi_1"}},
+    }
+    async with session_factory() as session:
+        user = await UserRepository(session).create_or_update(telegram_id=42)
+        await OrderRepository(session).create(
+            user_id=user.id,
+            sku="vip_month",
+            price_id="price_1",
+            stripe_checkout_id="cs_1",
+            extra_data={"telegram_id": "42"},
+        )
+        events = StripeEventRepository(session)
+        assert await events.record(event["id"], event["type"], event)
+        assert not await events.record(event["id"], event["type"], event)
+        await session.commit()
+
+    bot = FakeBot()
+    worker = StripeEventWorker(bot, session_factory=session_factory)  # type: ignore[arg-type]
+    assert await worker.recover() == 1
+    # Already queued: a redelivery must not enqueue it twice.
+    assert worker.submit("evt_1")
+    assert worker._queue.qsize() == 1
+
+    worker.start()
+    await worker.stop()
+    assert not await worker.process("evt_1")
+
+    async with session_factory() as session:
+        order = (await session.execute(select(Order))).scalar_one()
+        stored = await session.get(StripeEvent, "evt_1")
+        assert order.status == "paid"
+        assert stored is not None and stored.status == "processed"
+    assert bot.sent == [(42, "Payment received. Thank you!")]
+
+
+@pytest.mark.asyncio()
+async def test_checkout_goes_through_shared_gateway(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    gateway = FakeGateway()
+    async with session_factory() as session:
+        user = await UserRepository(session).create_or_update(telegram_id=42)
+        service = PaymentsService(session, gateway=gateway, checkouts=CheckoutSessionCache())  # type: ignore[arg-type]
+        service.settings = service.settings.model_copy(update={"price_id_vip_month": "price_1"})
+        checkout = await service.create_checkout_session(
+            user=user, sku="vip_month", success_url="https://ok", cancel_url="https://no"
+        )
+        await session.commit()
+
+        order = (await session.execute(select(Order))).scalar_one()
+    assert checkout == {"url": "https://checkout.test/1", "session_id": "cs_1"}
+    assert gateway.calls[0]["line_items"] == [{"price": "price_1", "quantity": 1}]
+    assert order.extra_data == {"user_id": str(user.id), "telegram_id": "42", "sku": "vip_month"}
+
+
+@pytest.mark.asyncio()
+async def test_repeated_buy_clicks_reuse_open_checkout(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    class SlowGateway(FakeGateway):
+        async def create_checkout_session(self, params: dict[str, object]) -> dict[str, str]:
+            await asyncio.sleep(0.01)
+            return await super().create_checkout_session(params)
+
+    gateway = SlowGateway()
+
+    async def buy(checkouts: CheckoutSessionCache) -> str:
+        async with session_factory() as session:
+            user = await UserRepository(session).create_or_update(telegram_id=42)
+            service = PaymentsService(session, gateway=gateway, checkouts=checkouts)  # type: ignore[arg-type]
+            service.settings = service.settings.model_copy(update={"price_id_vip_month": "price_1"})
+            checkout = await service.create_checkout_session(
+                user=user, sku="vip_month", success_url="https://ok", cancel_url="https://no"
+            )
+            await session.commit()
+            return checkout["url"]
+
+    checkouts = CheckoutSessionCache()
+    urls = await asyncio.gather(*(buy(checkouts) for _ in range(5)))
+    assert set(urls) == {"https://checkout.test/1"}
+    assert len(gateway.calls) == 1
+
+    # A fresh process finds the open session through the orders table.
+    assert await buy(CheckoutSessionCache()) == "https://checkout.test/1"
+    assert len(gateway.calls) == 1
+
+    async with session_factory() as session:
+        assert len((await session.execute(select(Order))).scalars().all()) == 1
+
+
+@pytest.mark.asyncio()
+async def test_checkout_is_shared_only_after_commit(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    checkouts = CheckoutSessionCache()
+    gateway = FakeGateway()
+
+    async def buy(session: AsyncSession) -> str:
+        user = await UserRepository(session).create_or_update(telegram_id=42)
+        service = PaymentsService(session, gateway=gateway, checkouts=checkouts)  # type: ignore[arg-type]
+        service.settings = service.settings.model_copy(update={"price_id_vip_month": "price_1"})
+        checkout = await service.create_checkout_session(
+            user=user, sku="vip_month", success_url="https://ok", cancel_url="https://no"
+        )
+        return checkout["url"]
+
+    async with session_factory() as session:
+        assert await buy(session) == "https://checkout.test/1"
+        key = next(iter(checkouts._inflight))
+        assert checkouts.get(key) is None
+        await session.rollback()
+    assert checkouts.get(key) is None
+    assert not checkouts._inflight
+
+    async with session_factory() as session:
+        assert await buy(session) == "https://checkout.test/2"
+        await session.commit()
+    assert checkouts.get(key) is not None
+
+    # Paid through a webhook another process handled: the hit is re-checked.
+    async with session_factory() as session:
+        order = await OrderRepository(session).get_by_checkout_id("cs_2")
+        await OrderRepository(session).mark_paid(order, "pi_2")
+        await session.commit()
+    async with session_factory() as session:
+        assert await buy(session) == "https://checkout.test/3"
+        await session.commit()
+    assert len(gateway.calls) == 3
+
+
+@pytest.mark.asyncio()
+async def test_counters_refresh_and_reconcile(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    worker = CounterWorker(session_factory=session_factory)
+    async with session_factory() as session:
+        users = UserRepository(session)
+        created = [await users.create_or_update(telegram_id=tid) for tid in range(1, 4)]
+        await session.commit()
+
+    assert await worker.refresh() == {"users": 3}
+    assert await worker.refresh() == {}
+
+    async with session_factory() as session:
+        session.add(Referral(referrer_id=created[0].id, referred_id=created[1].id))
+        await session.delete(await session.get(User, created[2].id))
+        await session.commit()
+
+    assert await worker.refresh() == {"referrals": 1}
+    # The delete is invisible to the high-water mark until the reconcile.
+    assert await worker.reconcile() == {"users": -1}
+
+    async with session_factory() as session:
+        counters = {c.name: c.value for c in (await session.execute(select(Counter))).scalars()}
+    assert counters == {"users": 2, "orders": 0, "referrals": 1}
+
+
+@pytest.mark.asyncio()
+async def test_message_archiver_moves_old_rows(
+    session_factory: async_sessionmaker[AsyncSession], tmp_path
+) -> None:
+    now = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+    async with session_factory() as session:
+        user = await UserRepository(session).create_or_update(telegram_id=1)
+        for days_ago in (40, 40, 35, 1):
+            session.add(
+                MessageRecord(
+                    user_id=user.id,
+                    command="broadcast",
+                    status="sent",
+                    created_at=now - timedelta(days=days_ago),
+                )
+            )
+        await session.commit()
+
+    archiver = MessageArchiver(
+        str(tmp_path), retention_days=30, batch_size=2, session_factory=session_factory
+    )
+    # Another archiver holds the lease: nothing moves until it is released.
+    async with session_factory() as session:
+        until = datetime.now(timezone.utc) + timedelta(hours=1)
+        assert await LeaseRepository(session).acquire(archiver.LEASE, "other", until)
+        await session.commit()
+    assert await archiver.archive(now) == 0
+    async with session_factory() as session:
+        assert await LeaseRepository(session).release(archiver.LEASE, "other")
+        await session.commit()
+
+    assert await archiver.archive(now) == 3
+    assert await archiver.archive(now) == 0
+
+    async with session_factory() as session:
+        remaining = (await session.execute(select(MessageRecord.id))).scalars().all()
+    assert len(remaining) == 1
+    assert archiver.path_for((now - timedelta(days=40)).date()).exists()
+
+    archived = await archiver.read(now - timedelta(days=41), now - timedelta(days=30))
+    assert [row["id"] for row in archived] == [1, 2, 3]
+    limited = await archiver.read(now - timedelta(days=41), now - timedelta(days=30), limit=2)
+    assert [row["id"] for row in limited] == [1, 2]
+    # A batch archived twice (crash before the delete) is read back once.
+    path = archiver.path_for((now - timedelta(days=40)).date())
+    path.write_bytes(path.read_bytes() * 2)
+    archived = await archiver.read(now - timedelta(days=41), now - timedelta(days=30))
+    assert [row["id"] for row in archived] == [1, 2, 3]
+    assert await archiver.read(now - timedelta(days=36), now, user_id=user.id + 1) == []
+
+
+@pytest.mark.asyncio()
+async def test_delivery_archiver_drains_finished_broadcasts(
+    session_factory: async_sessionmaker[AsyncSession], tmp_path
+) -> None:
+    now = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+    async with session_factory() as session:
+        repo_users = UserRepository(session)
+        users = [await repo_users.create_or_update(telegram_id=tid) for tid in range(1, 4)]
+        old = Broadcast(
+            text="old", status="completed", sent=2, failed=1, finished_at=now - timedelta(days=40)
+        )
+        recent = Broadcast(
+            text="new", status="completed", sent=3, finished_at=now - timedelta(days=1)
+        )
+        session.add_all([old, recent])
+        await session.flush()
+        repo = BroadcastRepository(session)
+        await repo.record_deliveries(
+            [
+                (old.id, users[0].id, "sent", None),
+                (old.id, users[1].id, "sent", None),
+                (old.id, users[2].id, "failed", 403),
+            ]
+            + [(recent.id, user.id, "sent", None) for user in users]
+        )
+        await session.commit()
+
+    archiver = DeliveryArchiver(
+        str(tmp_path), retention_days=30, batch_size=2, session_factory=session_factory
+    )
+    assert await archiver.archive(now) == 3
+    assert await archiver.archive(now) == 0
+
+    async with session_factory() as session:
+        kept = (await session.execute(select(BroadcastDelivery.broadcast_id))).scalars().all()
+        # The totals live on the broadcasts rows and survive the archive.
+        assert await BroadcastRepository(session).delivery_totals() == (5, 1)
+    assert set(kept) == {recent.id}
+
+    with gzip.open(archiver.path_for((now - timedelta(days=40)).date()), "rt") as archive:
+        rows = [json.loads(line) for line in archive]
+    assert [(row["user_id"], row["status"], row["error_code"]) for row in rows] == [
+        (users[0].id, "sent", None),
+        (users[1].id, "sent", None),
+        (users[2].id, "failed", 403),
+    ]
+
+
+@pytest.mark.asyncio()
+async def test_rollups_fold_incrementally_and_backfill(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    worker = RollupWorker(session_factory=session_factory, batch_size=2)
+    async with session_factory() as session:
+        users = UserRepository(session)
+        created = [await users.create_or_update(telegram_id=tid) for tid in range(1, 4)]
+        orders = OrderRepository(session)
+        for index, sku in enumerate(["vip_month", "vip_month", "founder_key"]):
+            await orders.create(
+                user_id=created[0].id, sku=sku, price_id="p", stripe_checkout_id=f"cs_{index}"
+            )
+        await session.commit()
+
+    assert await worker.refresh() == {"new_users": 3, "orders": 3}
+    assert await worker.refresh() == {}
+
+    async def day_totals(metric: str) -> dict[str, int]:
+        async with session_factory() as session:
+            since = datetime.now(timezone.utc) - timedelta(days=1)
+            rows = await RollupRepository(session).series(metric, "day", since)
+        return {row.dimension: row.value for row in rows}
+
+    assert await day_totals("new_users") == {"": 3}
+    assert await day_totals("orders") == {"vip_month": 2, "founder_key": 1}
+
+    async with session_factory() as session:
+        query = select(Order).where(Order.stripe_checkout_id == "cs_0")
+        order = (await session.execute(query)).scalar_one()
+        await OrderRepository(session).mark_paid(order, "pi_1")
+        await session.commit()
+
+    assert (await worker.backfill())["orders_paid"] == 1
+    assert await day_totals("orders") == {"vip_month": 2, "founder_key": 1}
+    assert await day_totals("orders_paid") == {"vip_month": 1}
+
+
+@pytest.mark.asyncio()
+async def test_referral_counts_fold_and_reconcile(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    worker = ReferralCountWorker(session_factory=session_factory, batch_size=3)
+    async with session_factory() as session:
+        users = UserRepository(session)
+        referrer = await users.create_or_update(telegram_id=1)
+        service = ReferralService(session)
+        for tid in range(2, 9):
+            invited = await users.create_or_update(telegram_id=tid)
+            await service.process_referral(invited, referrer.referral_code)
+            # A replayed /start must not count twice.
+            invited.referred_by_id = None
+            await service.process_referral(invited, referrer.referral_code)
+        await session.commit()
+
+    assert await worker.flush() == 7
+    assert await worker.flush() == 0
+
+    async with session_factory() as session:
+        users = UserRepository(session)
+        assert await users.get_referral_count(referrer.id) == 7
+        await users.increment_referral_counts({referrer.id: 5})
+        await session.commit()
+
+    assert await worker.reconcile() == 1
+    async with session_factory() as session:
+        assert await UserRepository(session).get_referral_count(referrer.id) == 7
+
+
+@pytest.mark.asyncio()
+async def test_referral_code_cache_answers_hot_and_junk_codes(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    class CountingUsers(UserRepository):
+        lookups = 0
+
+        async def get_by_referral_code(self, code: str) -> User | None:
+            CountingUsers.lookups += 1
+            return await super().get_by_referral_code(code)
+
+    codes = ReferralCodeCache()
+    async with session_factory() as session:
+        users = CountingUsers(session)
+        referrer = await users.create_or_update(telegram_id=1)
+        code = referrer.referral_code
+
+        assert [await codes.resolve(users, code) for _ in range(3)] == [referrer.id] * 3
+        assert await codes.resolve(users, f" {code[:6].lower()}-{code[6:]} ") == referrer.id
+        assert CountingUsers.lookups == 1
+
+        # Bad check character: rejected without a lookup or a cache entry.
+        assert await codes.resolve(users, code[:-1] + ("0" if code[-1] != "0" else "1")) is None
+        assert await codes.resolve(users, "<script>") is None
+        assert await codes.resolve(users, "ABCDEF123456") is None
+        assert CountingUsers.lookups == 1
+
+        # Well-formed but unknown: one lookup, then the negative cache answers.
+        assert await codes.resolve(users, "NOBODY01") is None
+        assert await codes.resolve(users, "NOBODY01") is None
+        assert CountingUsers.lookups == 2
+
+
+@pytest.mark.asyncio()
+async def test_downline_counts_follow_the_referral_tree(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> None:
+    worker = ReferralCountWorker(session_factory=session_factory, batch_size=2)
+
+    async def refer(child_tid: int, parent_tid: int) -> None:
+        async with session_factory() as session:
+            users = UserRepository(session)
+            parent = await users.create_or_update(telegram_id=parent_tid)
+            child = await users.create_or_update(telegram_id=child_tid)
+            await ReferralService(session).process_referral(child, parent.referral_code)
+            await session.commit()
+
+    # root <- a <- b <- c, plus root <- d; folded in batches that split the chain.
+    await refer(2, 1)
+    await refer(3, 2)
+    await worker.flush()
+    await refer(4, 3)
+    await refer(5, 1)
+    # Cycle: root cannot join the downline of its own descendant.
+    await refer(1, 4)
+    await worker.flush()
+
+    async with session_factory() as session:
+        users = UserRepository(session)
+        by_tid = {tid: await users.get_by_telegram_id(tid) for tid in range(1, 6)}
+        assert [by_tid[tid].downline_count for tid in range(1, 6)] == [4, 2, 1, 0, 0]
+        assert [u.telegram_id for u in await users.top_by_downline(2)] == [1, 2]
+
+        await users.set_downline_counts({by_tid[2].id: 9, by_tid[5].id: 3})
+        await session.commit()
+
+    assert await worker.reconcile() == 2
+    async with session_factory() as session:
+        users = UserRepository(session)
+        assert [(await users.get_by_telegram_id(tid)).downline_count for tid in (2, 5)] == [2, 0]